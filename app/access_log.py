@@ -0,0 +1,128 @@
+import os
+import sys
+import json
+import queue
+import random
+import threading
+import logging
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, TextIO
+
+from .metrics import incr
+
+logger = logging.getLogger("tienda-api")
+
+# Destino de las líneas JSON; vacío = stderr (journald en VM1)
+ACCESS_LOG_PATH = os.getenv("ACCESS_LOG_PATH", "")
+# Fracción de respuestas 2xx/3xx rápidas que se registran (los errores y las lentas siempre)
+ACCESS_LOG_SAMPLE = float(os.getenv("ACCESS_LOG_SAMPLE", "1.0"))
+ACCESS_LOG_SLOW_MS = int(os.getenv("ACCESS_LOG_SLOW_MS", "1000"))
+ACCESS_LOG_QUEUE_MAX = int(os.getenv("ACCESS_LOG_QUEUE_MAX", "10000"))
+ACCESS_LOG_BATCH = int(os.getenv("ACCESS_LOG_BATCH", "256"))
+
+_STOP = object()
+
+
+class AccessLog:
+    """Log de accesos no bloqueante.
+
+    El middleware solo encola una tupla (`record`); un hilo la serializa como
+    línea JSON y escribe los lotes de una vez. Si la cola se llena la entrada
+    se descarta y se cuenta en `access_log.dropped`: perder líneas de log es
+    preferible a frenar las peticiones.
+    """
+
+    def __init__(self, path: str = ACCESS_LOG_PATH, sample: float = ACCESS_LOG_SAMPLE,
+                 slow_ms: int = ACCESS_LOG_SLOW_MS, queue_max: int = ACCESS_LOG_QUEUE_MAX,
+                 batch: int = ACCESS_LOG_BATCH):
+        self.path = path
+        self.sample = sample
+        self.slow_ms = slow_ms
+        self.batch = max(1, batch)
+        self._q: "queue.Queue[Any]" = queue.Queue(maxsize=max(1, queue_max))
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def record(self, client: str, method: str, path: str, status: int, dur_ms: int) -> None:
+        if status < 400 and dur_ms < self.slow_ms and self.sample < 1.0 and random.random() >= self.sample:
+            incr("access_log.sampled_out")
+            return
+        try:
+            self._q.put_nowait((datetime.now(timezone.utc), client, method, path, status, dur_ms))
+        except queue.Full:
+            incr("access_log.dropped")
+            return
+        self._ensure_started()
+
+    def _ensure_started(self) -> None:
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="access-log", daemon=True)
+                self._thread.start()
+
+    def stop(self, timeout: float = 5.0) -> None:
+        """Vacía la cola y detiene el hilo (apagado ordenado)."""
+        t = self._thread
+        if t is None:
+            return
+        try:
+            self._q.put(_STOP, timeout=timeout)
+        except queue.Full:
+            pass
+        t.join(timeout)
+        self._thread = None
+
+    def _open(self) -> TextIO:
+        if not self.path:
+            return sys.stderr
+        return open(self.path, "a", encoding="utf-8")
+
+    def _run(self) -> None:
+        out = self._open()
+        stopping = False
+        while not stopping:
+            batch: List[Any] = [self._q.get()]
+            while len(batch) < self.batch:
+                try:
+                    batch.append(self._q.get_nowait())
+                except queue.Empty:
+                    break
+            lines = []
+            for item in batch:
+                if item is _STOP:
+                    stopping = True
+                    continue
+                lines.append(self._format(item))
+            if not lines:
+                continue
+            try:
+                out.write("".join(lines))
+                out.flush()
+                incr("access_log.written", len(lines))
+            except Exception:
+                incr("access_log.dropped", len(lines))
+                logger.exception("No se pudo escribir el log de accesos")
+        if out is not sys.stderr:
+            out.close()
+
+    @staticmethod
+    def _format(item: tuple) -> str:
+        ts, client, method, path, status, dur_ms = item
+        entry: Dict[str, Any] = {
+            "ts": ts.isoformat(timespec="milliseconds"),
+            "client": client,
+            "method": method,
+            "path": path,
+            "status": status,
+            "ms": dur_ms,
+        }
+        return json.dumps(entry, ensure_ascii=False, separators=(",", ":")) + "\n"
+
+    def stats(self) -> Dict[str, Any]:
+        return {"queue_depth": self._q.qsize(), "writer": self._thread is not None, "sample": self.sample}
+
+
+# Instancia compartida del proceso
+access_log = AccessLog()
@@ -0,0 +1,142 @@
+"""Control de admisión por clase de ruta (middleware de app/main.py).
+
+Cada petición se clasifica por su ruta en una clase (catalogo, checkout, auth,
+admin, reportes). Cada clase tiene un límite de peticiones en vuelo que se
+ajusta con la latencia observada (AIMD): si la latencia media de la ventana
+supera el objetivo de la clase el límite baja a la mitad; si no, y la clase
+estaba cerca del tope, sube de uno en uno.
+
+Además, según la ocupación del pool del primario (`pool_saturation`), se
+recortan primero los reportes (/stats, CSV) y después el resto del panel
+admin. El checkout nunca se recorta por saturación: solo tiene su propio tope,
+que parte alto, para que sea lo último en degradarse.
+"""
+import os
+from typing import Any, Dict, Optional
+
+from .db import pool_saturation, pool_stats
+from .metrics import incr, record_sample
+
+ADMISSION_ENABLED = os.getenv("ADMISSION_ENABLED", "1") not in ("0", "false", "no")
+# Ocupación del pool (0..1+) a partir de la cual se rechazan reportes / admin
+ADMISSION_SHED_REPORTES_AT = float(os.getenv("ADMISSION_SHED_REPORTES_AT", "0.75"))
+ADMISSION_SHED_ADMIN_AT = float(os.getenv("ADMISSION_SHED_ADMIN_AT", "1.0"))
+# Respuestas observadas antes de reajustar el límite de una clase
+ADMISSION_WINDOW = int(os.getenv("ADMISSION_WINDOW", "20"))
+
+# clase: (límite inicial, mínimo, máximo, latencia objetivo en ms, Retry-After en s)
+_CLASES: Dict[str, tuple] = {
+    "checkout": (64, 8, 128, 1500.0, 1),
+    "catalogo": (32, 4, 128, 300.0, 1),
+    "auth": (16, 2, 32, 1000.0, 2),
+    "admin": (4, 1, 8, 2000.0, 5),
+    "reportes": (2, 1, 4, 3000.0, 10),
+}
+
+# Presupuesto de tiempo por sentencia SQL (s) según clase; 0 = sin límite.
+# Se aplica con max_statement_time (ver `set_statement_budget` en app/db.py).
+# Las compras corren en el hilo del escritor de group commit, que no hereda el
+# ContextVar: el de checkout lo captura `writer.submit` y se aplica por trabajo.
+DB_BUDGETS: Dict[str, float] = {
+    name: float(os.getenv(f"DB_BUDGET_{name.upper()}_SEC", default))
+    for name, default in (
+        ("checkout", "5"),
+        ("catalogo", "2"),
+        ("auth", "3"),
+        ("admin", "10"),
+        ("reportes", "30"),
+    )
+}
+
+
+def clasificar(method: str, path: str) -> Optional[str]:
+    """Clase de admisión de una ruta; None = no se controla (docs, estáticos, /internal)."""
+    if path == "/stats" or path.startswith("/admin/ventas.csv"):
+        return "reportes"
+    if path.startswith("/admin"):
+        return "admin"
+    if path in ("/checkout", "/compras"):
+        return "checkout"
+    if path == "/productos/stream":
+        # conexión larga y ociosa: no debe ocupar un cupo de admisión
+        return None
+    if path.startswith(("/productos", "/categorias", "/cart")):
+        return "catalogo"
+    if path in ("/login", "/register", "/me", "/request-password-reset", "/reset-password", "/token/refresh", "/logout"):
+        return "auth"
+    return None
+
+
+class _Clase:
+    __slots__ = ("name", "limit", "min_limit", "max_limit", "target_ms", "retry_after",
+                 "in_flight", "_n", "_sum_ms", "_peak")
+
+    def __init__(self, name: str, limit: int, min_limit: int, max_limit: int, target_ms: float, retry_after: int):
+        self.name = name
+        self.limit = limit
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.target_ms = target_ms
+        self.retry_after = retry_after
+        self.in_flight = 0
+        self._n = 0
+        self._sum_ms = 0.0
+        self._peak = 0
+
+    def observe(self, ms: float) -> None:
+        self._n += 1
+        self._sum_ms += ms
+        if self._n < ADMISSION_WINDOW:
+            return
+        avg = self._sum_ms / self._n
+        if avg > self.target_ms:
+            self.limit = max(self.min_limit, self.limit // 2)
+        elif self._peak >= self.limit - 1:
+            self.limit = min(self.max_limit, self.limit + 1)
+        self._n = 0
+        self._sum_ms = 0.0
+        self._peak = self.in_flight
+
+
+class AdmissionController:
+    """Límites en vuelo por clase de ruta.
+
+    Todo se ejecuta en el event loop (middleware async), así que los contadores
+    no necesitan lock.
+    """
+
+    def __init__(self):
+        self.clases = {name: _Clase(name, *cfg) for name, cfg in _CLASES.items()}
+
+    def admit(self, clase: str) -> Optional[int]:
+        """Reserva un hueco; devuelve None si entra o los segundos de Retry-After si se rechaza."""
+        c = self.clases[clase]
+        sat = pool_saturation()
+        if (clase == "reportes" and sat >= ADMISSION_SHED_REPORTES_AT) or \
+                (clase == "admin" and sat >= ADMISSION_SHED_ADMIN_AT) or \
+                c.in_flight >= c.limit:
+            incr(f"admission.{clase}.shed")
+            return c.retry_after
+        c.in_flight += 1
+        c._peak = max(c._peak, c.in_flight)
+        return None
+
+    def release(self, clase: str, ms: float) -> None:
+        c = self.clases[clase]
+        c.in_flight -= 1
+        c.observe(ms)
+        record_sample(f"admission.{clase}.ms", ms)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": ADMISSION_ENABLED,
+            "pool": pool_stats(),
+            "clases": {
+                c.name: {"in_flight": c.in_flight, "limit": c.limit, "target_ms": c.target_ms}
+                for c in self.clases.values()
+            },
+        }
+
+
+# Instancia compartida del proceso
+admission = AdmissionController()
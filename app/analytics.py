@@ -0,0 +1,465 @@
+"""Analítica de ventas en columnas NumPy (cross-tabs y medias móviles para /admin).
+
+`compras` se carga una vez en arrays columnares (id, producto_id, cantidad,
+segundos) y se mantiene al día con el listener del escritor de group commit.
+Precio y categoría salen de tablas de búsqueda indexadas por producto_id
+(precio actual, igual que /admin/ventas/resumen), así que cada desglose es un
+`bincount` vectorizado en vez de otro `GROUP BY` sobre la tabla.
+
+Los datos viven en dos segmentos: una base de solo lectura mapeada desde
+snapshots `.npy` (arranque rápido, páginas compartidas entre workers) y una
+cola en memoria que crece con las compras nuevas. `save_snapshot` junta ambos.
+
+Las compras incrementales llegan desordenadas por id: las del propio worker
+por el escritor y las de otros ~200 ms después por el outbox, casi siempre con
+ids menores. Por eso el corte por id es solo contra la marca de la carga
+(`_max_id`) y por encima de ella se deduplica con los ids ya aplicados.
+
+NumPy es opcional: sin él `analytics.disponible()` es False y los endpoints
+responden 503.
+"""
+import os
+import json
+import threading
+import logging
+from datetime import date, datetime, timedelta
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+try:
+    import numpy as np
+except ImportError:  # dependencia opcional
+    np = None
+
+from .db import get_conn, schema_has
+from .filas import tuplas, por_columnas
+from .group_commit import writer
+from .outbox import compras_externas, dispatcher
+
+logger = logging.getLogger("tienda-api")
+
+ANALYTICS_SNAPSHOT_DIR = os.getenv(
+    "ANALYTICS_SNAPSHOT_DIR",
+    str(Path(__file__).resolve().parent.parent / "var" / "analytics"),
+)
+# Filas por fetchmany al cargar desde la BD
+ANALYTICS_LOAD_CHUNK = int(os.getenv("ANALYTICS_LOAD_CHUNK", "50000"))
+
+_COLUMNS = (("id", "int64"), ("producto_id", "int32"), ("cantidad", "int32"), ("ts", "int64"))
+_EPOCH = datetime(1970, 1, 1)
+SIN_CATEGORIA = ""
+
+DIMENSIONES = ("hora", "dia_semana", "dia", "mes", "categoria", "producto")
+MEDIDAS = ("compras", "unidades", "monto")
+_DIAS_SEMANA = ["lunes", "martes", "miércoles", "jueves", "viernes", "sábado", "domingo"]
+
+
+def _segundos(dt: datetime) -> int:
+    # `fecha` es DATETIME en hora local de la app: se guarda como segundos "de pared"
+    # (sin zona), de modo que hora y día salen directos con // y %.
+    return int((dt - _EPOCH).total_seconds())
+
+
+def _lookup(lut, idx, default):
+    """lut[idx] con `default` para ids fuera de la tabla (productos nuevos aún no cargados)."""
+    out = np.full(len(idx), default, dtype=lut.dtype)
+    ok = idx < len(lut)
+    out[ok] = lut[idx[ok]]
+    return out
+
+
+class _Tail:
+    """Columnas en memoria con capacidad que se duplica al llenarse (append amortizado O(1))."""
+
+    def __init__(self, capacity: int = 1024):
+        self.n = 0
+        self.cols = {name: np.empty(capacity, dtype=dt) for name, dt in _COLUMNS}
+
+    def append(self, data: Dict[str, Any]) -> None:
+        k = len(data["id"])
+        if k == 0:
+            return
+        cap = len(self.cols["id"])
+        if self.n + k > cap:
+            new_cap = max(cap * 2, self.n + k)
+            for name, dt in _COLUMNS:
+                grown = np.empty(new_cap, dtype=dt)
+                grown[:self.n] = self.cols[name][:self.n]
+                self.cols[name] = grown
+        for name, _ in _COLUMNS:
+            self.cols[name][self.n:self.n + k] = data[name]
+        self.n += k
+
+    def view(self) -> Dict[str, Any]:
+        # vistas hasta n: siguen siendo válidas aunque luego se realoje o se añada
+        return {name: arr[:self.n] for name, arr in self.cols.items()}
+
+
+class VentasColumnar:
+    def __init__(self, snapshot_dir: str = ANALYTICS_SNAPSHOT_DIR):
+        self.snapshot_dir = Path(snapshot_dir)
+        self._lock = threading.RLock()
+        self._loaded = False
+        self._loading = False
+        # Una sola carga a la vez: dos en paralelo se vaciarían `_pending` una a la otra
+        self._load_lock = threading.Lock()
+        self._pending: List[Dict[str, Any]] = []
+        self._base: Optional[Dict[str, Any]] = None
+        self._tail: Optional[_Tail] = None
+        # marca de la carga: todo id <= _max_id ya está en base o cola
+        self._max_id = 0
+        # ids > _max_id ya aplicados (la marca avanza mientras sean contiguos)
+        self._vistos: Set[int] = set()
+        # tablas de búsqueda por producto_id
+        self._precio = None
+        self._cat = None
+        self.categorias: List[str] = [SIN_CATEGORIA]
+
+    @staticmethod
+    def disponible() -> bool:
+        return np is not None
+
+    # -- Carga --
+    def ensure_loaded(self) -> None:
+        if self._loaded:
+            return
+        with self._load_lock:
+            if not self._loaded:
+                self._load()
+
+    def load(self) -> int:
+        """Carga el snapshot (si hay) y completa desde `compras` con id > último id. Devuelve nº de filas."""
+        with self._load_lock:
+            return self._load()
+
+    def _load(self) -> int:
+        if np is None:
+            raise RuntimeError("numpy no está instalado")
+        with self._lock:
+            self._loading = True
+            self._pending = []
+        try:
+            base, max_id = self._open_snapshot()
+            tail = _Tail()
+            # Primario: el corte por id debe ser coherente con el flujo de commits
+            conn = get_conn()
+            try:
+                # Tuplas -> listas por columna (zip en C), que NumPy copia de una vez
+                with tuplas(conn) as c:
+                    c.execute("SELECT COALESCE(MAX(id),0) FROM compras")
+                    hasta_id = int(c.fetchone()[0])
+                    c.execute(
+                        "SELECT id, producto_id, cantidad, TIMESTAMPDIFF(SECOND, '1970-01-01', fecha) AS ts "
+                        "FROM compras WHERE id > %s AND id <= %s ORDER BY id",
+                        (max_id, hasta_id),
+                    )
+                    while True:
+                        rows = c.fetchmany(ANALYTICS_LOAD_CHUNK)
+                        if not rows:
+                            break
+                        cols = por_columnas(rows, len(_COLUMNS))
+                        tail.append({name: col for (name, _), col in zip(_COLUMNS, cols)})
+                conn.commit()
+            finally:
+                conn.close()
+            self._load_productos()
+            with self._lock:
+                self._base = base
+                self._tail = tail
+                self._max_id = max(max_id, hasta_id)
+                self._vistos = set()
+                self._apply(self._pending)
+                self._loaded = True
+                return self._count()
+        finally:
+            with self._lock:
+                self._loading = False
+                self._pending = []
+
+    def _load_productos(self, ids: Optional[List[int]] = None) -> None:
+        has_categoria = schema_has("productos", "categoria")
+        sql = "SELECT id, precio" + (", categoria" if has_categoria else "") + " FROM productos"
+        args: List[Any] = []
+        if ids:
+            sql += " WHERE id IN (" + ",".join(["%s"] * len(ids)) + ")"
+            args = list(ids)
+        conn = get_conn(read=True)
+        try:
+            with conn.cursor() as c:
+                c.execute(sql, args)
+                rows = c.fetchall()
+            conn.commit()
+        finally:
+            conn.close()
+        with self._lock:
+            if ids is None or self._precio is None:
+                self._precio = np.zeros(0, dtype="float64")
+                self._cat = np.zeros(0, dtype="int32")
+                self.categorias = [SIN_CATEGORIA]
+            top = max([r["id"] for r in rows], default=-1) + 1
+            if top > len(self._precio):
+                self._precio = np.concatenate([self._precio, np.zeros(top - len(self._precio))])
+                self._cat = np.concatenate([self._cat, np.zeros(top - len(self._cat), dtype="int32")])
+            codes = {c: i for i, c in enumerate(self.categorias)}
+            for r in rows:
+                cat = r.get("categoria") or SIN_CATEGORIA
+                if cat not in codes:
+                    codes[cat] = len(self.categorias)
+                    self.categorias.append(cat)
+                self._precio[r["id"]] = float(r["precio"])
+                self._cat[r["id"]] = codes[cat]
+
+    # -- Alimentación --
+    def on_commit(self, rows: List[Dict[str, Any]]) -> None:
+        """Listener post-commit del escritor de group commit."""
+        if np is None:
+            return
+        with self._lock:
+            if self._loading:
+                self._pending.extend(rows)
+                return
+            if not self._loaded:
+                return
+            missing = sorted({r["producto_id"] for r in rows if r["producto_id"] >= len(self._precio)})
+        if missing:
+            self._load_productos(missing)
+        with self._lock:
+            self._apply(rows)
+
+    def _apply(self, rows: List[Dict[str, Any]]) -> None:
+        nuevas = []
+        for r in rows:
+            if r["id"] > self._max_id and r["id"] not in self._vistos:
+                self._vistos.add(r["id"])
+                nuevas.append(r)
+        rows = nuevas
+        if not rows:
+            return
+        self._tail.append({
+            "id": [r["id"] for r in rows],
+            "producto_id": [r["producto_id"] for r in rows],
+            "cantidad": [r["cantidad"] for r in rows],
+            "ts": [_segundos(r["fecha"]) for r in rows],
+        })
+        for r in rows:
+            if r["producto_id"] < len(self._precio):
+                self._precio[r["producto_id"]] = float(r["precio"])
+        # acota el conjunto; un hueco (id de un trabajo deshecho) la detiene hasta la próxima carga
+        while self._max_id + 1 in self._vistos:
+            self._max_id += 1
+            self._vistos.discard(self._max_id)
+
+    def _count(self) -> int:
+        base_n = len(self._base["id"]) if self._base else 0
+        return base_n + (self._tail.n if self._tail else 0)
+
+    # -- Snapshots --
+    def _open_snapshot(self) -> Tuple[Optional[Dict[str, Any]], int]:
+        meta_path = self.snapshot_dir / "ventas_meta.json"
+        if not meta_path.exists():
+            return None, 0
+        try:
+            meta = json.loads(meta_path.read_text())
+            base = {
+                name: np.load(self.snapshot_dir / f"ventas_{name}.npy", mmap_mode="r")
+                for name, _ in _COLUMNS
+            }
+            if any(len(a) != meta["n"] for a in base.values()):
+                raise ValueError("columnas de distinto largo")
+            return base, int(meta["max_id"])
+        except Exception:
+            logger.exception("Snapshot de analítica inválido en %s; se recarga desde la BD", self.snapshot_dir)
+            return None, 0
+
+    def save_snapshot(self) -> int:
+        """Escribe base + cola como nuevos `.npy` (reemplazo atómico) y remapea la base.
+
+        Solo entran las filas con id <= marca: el snapshot queda completo hasta
+        `max_id` y la siguiente carga sigue desde ahí sin duplicar.
+        """
+        self.ensure_loaded()
+        with self._lock:
+            segs = self._segments()
+            max_id = self._max_id
+        cols = {name: np.concatenate([s[name] for s in segs]) if segs else np.empty(0, dtype=dt)
+                for name, dt in _COLUMNS}
+        hasta = cols["id"] <= max_id
+        cols = {name: col[hasta] for name, col in cols.items()}
+        n = len(cols["id"])
+        self.snapshot_dir.mkdir(parents=True, exist_ok=True)
+        pid = os.getpid()
+        for name, _ in _COLUMNS:
+            tmp = self.snapshot_dir / f"ventas_{name}.{pid}.tmp.npy"
+            np.save(tmp, cols[name])
+            os.replace(tmp, self.snapshot_dir / f"ventas_{name}.npy")
+        meta_tmp = self.snapshot_dir / f"ventas_meta.{pid}.tmp"
+        meta_tmp.write_text(json.dumps({"n": n, "max_id": max_id, "created": datetime.now().isoformat()}))
+        os.replace(meta_tmp, self.snapshot_dir / "ventas_meta.json")
+        base = {name: np.load(self.snapshot_dir / f"ventas_{name}.npy", mmap_mode="r") for name, _ in _COLUMNS}
+        with self._lock:
+            # lo añadido a la cola mientras se escribía sigue en la cola nueva
+            rest = self._tail.view()
+            keep = rest["id"] > max_id
+            tail = _Tail()
+            tail.append({name: rest[name][keep] for name, _ in _COLUMNS})
+            self._base = base
+            self._tail = tail
+        return n
+
+    # -- Consultas --
+    def _segments(self) -> List[Dict[str, Any]]:
+        segs = []
+        if self._base is not None and len(self._base["id"]):
+            segs.append(self._base)
+        if self._tail is not None and self._tail.n:
+            segs.append(self._tail.view())
+        return segs
+
+    def _snapshot(self):
+        self.ensure_loaded()
+        with self._lock:
+            return self._segments(), self._precio, self._cat, list(self.categorias)
+
+    @staticmethod
+    def _mask(seg: Dict[str, Any], desde: Optional[date], hasta: Optional[date]):
+        ts = seg["ts"]
+        m = np.ones(len(ts), dtype=bool)
+        if desde:
+            m &= ts >= _segundos(datetime.combine(desde, datetime.min.time()))
+        if hasta:
+            m &= ts < _segundos(datetime.combine(hasta + timedelta(days=1), datetime.min.time()))
+        return m
+
+    @staticmethod
+    def _pesos(seg: Dict[str, Any], m, medida: str, precio):
+        cantidad = seg["cantidad"][m]
+        if medida == "compras":
+            return np.ones(len(cantidad), dtype="float64")
+        if medida == "unidades":
+            return cantidad.astype("float64")
+        return cantidad * _lookup(precio, seg["producto_id"][m], 0.0)
+
+    @staticmethod
+    def _codigos(dim: str, seg: Dict[str, Any], m, cat_lut):
+        """Códigos enteros sin compactar de la dimensión para las filas filtradas."""
+        ts = seg["ts"][m]
+        if dim == "hora":
+            return (ts // 3600) % 24
+        if dim == "dia_semana":
+            # 1970-01-01 fue jueves (3 con lunes=0)
+            return (ts // 86400 + 3) % 7
+        if dim == "dia":
+            return ts // 86400
+        if dim == "mes":
+            # meses desde 1970-01
+            return (ts // 86400).astype("datetime64[D]").astype("datetime64[M]").astype("int64")
+        pid = seg["producto_id"][m]
+        if dim == "categoria":
+            return _lookup(cat_lut, pid, 0).astype("int64")
+        return pid.astype("int64")  # producto
+
+    @staticmethod
+    def _etiqueta(dim: str, code: int, categorias: List[str]) -> Any:
+        if dim == "hora":
+            return int(code)
+        if dim == "dia_semana":
+            return _DIAS_SEMANA[int(code)]
+        if dim == "dia":
+            return (_EPOCH + timedelta(days=int(code))).date().isoformat()
+        if dim == "mes":
+            return f"{1970 + int(code) // 12:04d}-{int(code) % 12 + 1:02d}"
+        if dim == "categoria":
+            return categorias[int(code)] or None
+        return int(code)
+
+    def crosstab(self, filas: str, columnas: Optional[str] = None, medida: str = "unidades",
+                 desde: Optional[date] = None, hasta: Optional[date] = None,
+                 categoria: Optional[str] = None) -> Dict[str, Any]:
+        """Tabla filas x columnas de la medida (suma) con un bincount por segmento."""
+        segs, precio, cat_lut, categorias = self._snapshot()
+        cat_code = None
+        if categoria is not None:
+            cat_code = categorias.index(categoria) if categoria in categorias else -1
+        dims = [filas] + ([columnas] if columnas else [])
+        codes_por_dim: List[List[Any]] = [[] for _ in dims]
+        pesos = []
+        for seg in segs:
+            m = self._mask(seg, desde, hasta)
+            if cat_code is not None:
+                m &= _lookup(cat_lut, seg["producto_id"], -1) == cat_code
+            for i, dim in enumerate(dims):
+                codes_por_dim[i].append(self._codigos(dim, seg, m, cat_lut))
+            pesos.append(self._pesos(seg, m, medida, precio))
+
+        w = np.concatenate(pesos) if pesos else np.zeros(0)
+        # compactar cada dimensión a 0..k-1 (días y productos son dispersos)
+        labels, inversos = [], []
+        for parts in codes_por_dim:
+            raw = np.concatenate(parts) if parts else np.zeros(0, dtype="int64")
+            uniq, inv = np.unique(raw, return_inverse=True)
+            labels.append(uniq)
+            inversos.append(inv)
+        nr = len(labels[0])
+        nc = len(labels[1]) if columnas else 1
+        combined = inversos[0] * nc + (inversos[1] if columnas else 0)
+        tabla = np.bincount(combined, weights=w, minlength=nr * nc).reshape(nr, nc) if nr else np.zeros((0, nc))
+
+        redondeo = 2 if medida == "monto" else 0
+        valores = [[round(float(v), redondeo) if redondeo else int(v) for v in fila] for fila in tabla]
+        return {
+            "filas": filas,
+            "columnas": columnas,
+            "medida": medida,
+            "etiquetas_filas": [self._etiqueta(filas, c, categorias) for c in labels[0]],
+            "etiquetas_columnas": [self._etiqueta(columnas, c, categorias) for c in labels[1]] if columnas else [],
+            "valores": valores if columnas else [fila[0] for fila in valores],
+        }
+
+    def media_movil(self, desde: date, hasta: date, ventana: int = 7, medida: str = "unidades",
+                    categoria: Optional[str] = None) -> List[Dict[str, Any]]:
+        """Serie diaria (días sin ventas = 0) con media móvil de `ventana` días hacia atrás."""
+        # incluir los días previos que necesita la primera media
+        inicio = desde - timedelta(days=ventana - 1)
+        ct = self.crosstab("dia", None, medida, inicio, hasta, categoria)
+        d0 = (inicio - _EPOCH.date()).days
+        n = (hasta - inicio).days + 1
+        serie = np.zeros(n)
+        for etiqueta, v in zip(ct["etiquetas_filas"], ct["valores"]):
+            serie[(date.fromisoformat(etiqueta) - _EPOCH.date()).days - d0] = v
+        acum = np.cumsum(np.concatenate([[0.0], serie]))
+        medias = (acum[ventana:] - acum[:-ventana]) / ventana
+        out = []
+        for i, media in enumerate(medias):
+            dia = desde + timedelta(days=i)
+            v = serie[i + ventana - 1]
+            out.append({
+                "fecha": dia.isoformat(),
+                "valor": round(float(v), 2),
+                "media": round(float(media), 2),
+            })
+        return out
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "disponible": self.disponible(),
+                "cargado": self._loaded,
+                "filas": self._count() if self._loaded else 0,
+                "filas_mmap": len(self._base["id"]) if self._base else 0,
+                "max_id": self._max_id,
+            }
+
+
+# Instancia compartida del proceso, alimentada por cada lote confirmado
+analytics = VentasColumnar()
+writer.add_listener(analytics.on_commit)
+
+
+def _compras_de_otros_workers(eventos: List[Dict[str, Any]]) -> None:
+    rows = compras_externas(eventos)
+    if rows:
+        analytics.on_commit(rows)
+
+
+# Compras de otros workers (outbox): sin esto cada proceso solo ve las suyas hasta un rebuild
+dispatcher.subscribe(_compras_de_otros_workers)
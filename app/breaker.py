@@ -0,0 +1,133 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional, Tuple
+
+from pymysql.err import OperationalError
+
+from .metrics import incr
+
+# Fallos consecutivos (conexión / error operativo) que abren el circuito
+DB_BREAKER_THRESHOLD = int(os.getenv("DB_BREAKER_THRESHOLD", "5"))
+# Segundos en abierto antes de dejar pasar una petición de prueba (half-open)
+DB_BREAKER_RESET_SEC = float(os.getenv("DB_BREAKER_RESET_SEC", "10"))
+# Entradas del último resultado bueno que se guardan para servir en modo degradado
+LAST_GOOD_MAX_ENTRIES = int(os.getenv("LAST_GOOD_MAX_ENTRIES", "512"))
+
+
+class CircuitOpenError(OperationalError):
+    """El circuito está abierto: no se intenta conectar a la BD."""
+
+
+class CircuitBreaker:
+    """Circuit breaker clásico: cerrado -> abierto -> semiabierto -> cerrado.
+
+    - Cerrado: todo pasa; `failure()` cuenta fallos consecutivos y, al llegar
+      al umbral, abre el circuito.
+    - Abierto: `allow()` devuelve False (fallo inmediato, sin esperar al pool
+      ni al timeout de TCP) durante `reset_sec`.
+    - Semiabierto: pasa una sola petición de prueba; si va bien se cierra, si
+      falla vuelve a abrirse.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name: str, threshold: int = DB_BREAKER_THRESHOLD, reset_sec: float = DB_BREAKER_RESET_SEC):
+        self.name = name
+        self.threshold = max(1, threshold)
+        self.reset_sec = reset_sec
+        self._lock = threading.Lock()
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_sec:
+                return self.HALF_OPEN
+            return self._state
+
+    def is_open(self) -> bool:
+        return self.state == self.OPEN
+
+    def retry_after(self) -> int:
+        with self._lock:
+            left = self.reset_sec - (time.monotonic() - self._opened_at)
+        return max(1, int(left + 0.999))
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self._state == self.CLOSED:
+                return True
+            if self._state == self.OPEN:
+                if time.monotonic() - self._opened_at < self.reset_sec:
+                    incr(f"breaker.{self.name}.rejected")
+                    return False
+                self._state = self.HALF_OPEN
+                self._probing = False
+            # semiabierto: una sola prueba a la vez
+            if self._probing:
+                incr(f"breaker.{self.name}.rejected")
+                return False
+            self._probing = True
+            return True
+
+    def success(self) -> None:
+        with self._lock:
+            if self._state != self.CLOSED:
+                incr(f"breaker.{self.name}.closed")
+            self._state = self.CLOSED
+            self._failures = 0
+            self._probing = False
+
+    def abort(self) -> None:
+        """La prueba no llegó a tocar la BD (p. ej. pool agotado): no cambia el estado."""
+        with self._lock:
+            self._probing = False
+
+    def failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            if self._state == self.HALF_OPEN or self._failures >= self.threshold:
+                if self._state != self.OPEN:
+                    incr(f"breaker.{self.name}.opened")
+                self._state = self.OPEN
+                self._opened_at = time.monotonic()
+                self._probing = False
+
+    def stats(self) -> Dict[str, Any]:
+        return {"state": self.state, "consecutive_failures": self._failures}
+
+
+class LastGood:
+    """Último resultado bueno por clave (LRU acotado), para servir datos viejos si la BD cae."""
+
+    def __init__(self, max_entries: int = LAST_GOOD_MAX_ENTRIES):
+        self.max_entries = max(1, max_entries)
+        self._lock = threading.Lock()
+        self._data: "OrderedDict[Hashable, Tuple[Any, float]]" = OrderedDict()
+
+    def put(self, key: Hashable, value: Any) -> None:
+        with self._lock:
+            self._data[key] = (value, time.time())
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def get(self, key: Hashable) -> Optional[Tuple[Any, float]]:
+        """Devuelve (valor, antigüedad en s) o None."""
+        with self._lock:
+            hit = self._data.get(key)
+        if hit is None:
+            return None
+        return hit[0], time.time() - hit[1]
+
+
+# Instancias compartidas del proceso
+db_breaker = CircuitBreaker("db")
+last_good = LastGood()
@@ -0,0 +1,278 @@
+import os
+import mmap
+import pickle
+import struct
+import hashlib
+import threading
+import time
+import logging
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Hashable, Iterable, Optional, Tuple
+
+try:  # flock solo existe en POSIX (VM1 es Linux)
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
+logger = logging.getLogger("tienda-api")
+
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "2048"))
+CACHE_TTL_SEC = float(os.getenv("CACHE_TTL_SEC", "60"))
+# Tier en disco (opcional): vacío = deshabilitado
+CACHE_DISK_PATH = os.getenv("CACHE_DISK_PATH", "")
+CACHE_DISK_SLOTS = int(os.getenv("CACHE_DISK_SLOTS", "4096"))
+CACHE_DISK_SLOT_SIZE = int(os.getenv("CACHE_DISK_SLOT_SIZE", "16384"))
+
+_MISS = object()
+
+
+def _digest(data: str) -> bytes:
+    return hashlib.blake2b(data.encode("utf-8"), digest_size=16).digest()
+
+
+class _LocalTags:
+    """Generaciones de tags en memoria del proceso."""
+    def __init__(self):
+        self._gens: Dict[str, int] = {}
+
+    def gen(self, tag: str) -> int:
+        return self._gens.get(tag, 0)
+
+    def bump(self, tag: str) -> None:
+        self._gens[tag] = self._gens.get(tag, 0) + 1
+
+
+class DiskStore:
+    """Almacén mmap de slots fijos, compartido entre workers y persistente.
+
+    Estructura del archivo:
+      cabecera (64 B) | contadores de tags (ntags * 8 B) | slots (nslots * slot_size)
+    Cada slot: digest de la clave (16 B) | expira (f64) | largo (u32) | payload pickle.
+    El slot se elige por hash (mapeo directo): una colisión reemplaza la entrada
+    anterior. Las escrituras usan flock exclusivo y las lecturas flock compartido.
+    Los tags se versionan con contadores en el propio archivo, de modo que una
+    invalidación en un worker se ve en todos.
+    """
+
+    MAGIC = b"TIENDAC1"
+    _HDR = struct.Struct("<8sIII")
+    _SLOT_HDR = struct.Struct("<16sdI")
+    HEADER_SIZE = 64
+    NTAGS = 1024
+
+    def __init__(self, path: str, nslots: int = CACHE_DISK_SLOTS, slot_size: int = CACHE_DISK_SLOT_SIZE):
+        self.path = path
+        self.nslots = nslots
+        self.slot_size = slot_size
+        self._tags_off = self.HEADER_SIZE
+        self._slots_off = self._tags_off + self.NTAGS * 8
+        size = self._slots_off + nslots * slot_size
+        self._tlock = threading.Lock()
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        with self._flock(exclusive=True):
+            hdr_ok = False
+            if os.fstat(self._fd).st_size == size:
+                magic, _, ns, ss = self._HDR.unpack(os.pread(self._fd, self._HDR.size, 0))
+                hdr_ok = magic == self.MAGIC and ns == nslots and ss == slot_size
+            if not hdr_ok:
+                # Geometría distinta o archivo nuevo: reinicializar
+                os.ftruncate(self._fd, 0)
+                os.ftruncate(self._fd, size)
+                os.pwrite(self._fd, self._HDR.pack(self.MAGIC, 1, nslots, slot_size), 0)
+        self._mm = mmap.mmap(self._fd, size)
+
+    @contextmanager
+    def _flock(self, exclusive: bool):
+        # el lock de hilo cubre el proceso; flock coordina entre workers
+        with self._tlock:
+            if fcntl is not None:
+                fcntl.flock(self._fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def _tag_off(self, tag: str) -> int:
+        idx = int.from_bytes(_digest(tag)[:4], "little") % self.NTAGS
+        return self._tags_off + idx * 8
+
+    def gen(self, tag: str) -> int:
+        off = self._tag_off(tag)
+        return struct.unpack_from("<Q", self._mm, off)[0]
+
+    def bump(self, tag: str) -> None:
+        off = self._tag_off(tag)
+        with self._flock(exclusive=True):
+            cur = struct.unpack_from("<Q", self._mm, off)[0]
+            struct.pack_into("<Q", self._mm, off, cur + 1)
+
+    def _slot_off(self, kd: bytes) -> int:
+        return self._slots_off + (int.from_bytes(kd[:8], "little") % self.nslots) * self.slot_size
+
+    def get(self, key: str) -> Any:
+        """Devuelve (valor, generaciones de tags) o _MISS."""
+        kd = _digest(key)
+        off = self._slot_off(kd)
+        with self._flock(exclusive=False):
+            dig, expires, length = self._SLOT_HDR.unpack_from(self._mm, off)
+            if dig != kd or length == 0 or expires < time.time():
+                return _MISS
+            start = off + self._SLOT_HDR.size
+            raw = self._mm[start:start + length]
+        try:
+            stored_key, tag_gens, value = pickle.loads(raw)
+        except Exception:
+            return _MISS
+        if stored_key != key:
+            return _MISS
+        if any(self.gen(t) != g for t, g in tag_gens):
+            return _MISS
+        return value, tag_gens
+
+    def set(self, key: str, value: Any, ttl: float, tag_gens: Tuple[Tuple[str, int], ...]) -> bool:
+        try:
+            raw = pickle.dumps((key, tag_gens, value), protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            return False
+        if len(raw) > self.slot_size - self._SLOT_HDR.size:
+            return False
+        kd = _digest(key)
+        off = self._slot_off(kd)
+        with self._flock(exclusive=True):
+            self._SLOT_HDR.pack_into(self._mm, off, kd, time.time() + ttl, len(raw))
+            start = off + self._SLOT_HDR.size
+            self._mm[start:start + len(raw)] = raw
+        return True
+
+
+class TwoTierCache:
+    """Caché de dos niveles para resultados de consultas de lectura frecuente.
+
+    - L1: LRU acotado en memoria del proceso, con TTL por entrada.
+    - L2 (opcional): `DiskStore` mmap compartido entre workers y persistente.
+
+    Cada entrada guarda la generación de sus tags al momento de escribirse;
+    `invalidate(tag)` incrementa la generación y deja obsoletas todas las
+    entradas etiquetadas, en ambos niveles (y en todos los workers si hay L2).
+    """
+
+    def __init__(self, max_entries: int = CACHE_MAX_ENTRIES, default_ttl: float = CACHE_TTL_SEC,
+                 disk_path: str = CACHE_DISK_PATH):
+        self.max_entries = max(1, max_entries)
+        self.default_ttl = default_ttl
+        self._lock = threading.Lock()
+        self._lru: "OrderedDict[Hashable, Tuple[float, Tuple[Tuple[str, int], ...], Any]]" = OrderedDict()
+        self._disk: Optional[DiskStore] = None
+        if disk_path:
+            try:
+                self._disk = DiskStore(disk_path)
+            except Exception:
+                logger.exception("Caché: no se pudo abrir el tier en disco %s; solo memoria", disk_path)
+        self._tags = self._disk if self._disk is not None else _LocalTags()
+        self._stats = {"hits": 0, "misses": 0, "disk_hits": 0, "evictions": 0, "expired": 0,
+                       "invalidated": 0, "sets": 0}
+
+    @staticmethod
+    def _disk_key(key: Hashable) -> str:
+        return repr(key)
+
+    def _valid(self, tag_gens: Tuple[Tuple[str, int], ...]) -> bool:
+        return all(self._tags.gen(t) == g for t, g in tag_gens)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        now = time.monotonic()
+        with self._lock:
+            entry = self._lru.get(key)
+            if entry is not None:
+                expires, tag_gens, value = entry
+                if expires < now:
+                    del self._lru[key]
+                    self._stats["expired"] += 1
+                elif not self._valid(tag_gens):
+                    del self._lru[key]
+                    self._stats["invalidated"] += 1
+                else:
+                    self._lru.move_to_end(key)
+                    self._stats["hits"] += 1
+                    return value
+        if self._disk is not None:
+            found = self._disk.get(self._disk_key(key))
+            if found is not _MISS:
+                value, tag_gens = found
+                with self._lock:
+                    self._stats["hits"] += 1
+                    self._stats["disk_hits"] += 1
+                # promover a L1 con el TTL por defecto y los tags originales
+                self._set_local(key, value, self.default_ttl, tuple(tag_gens), now)
+                return value
+        with self._lock:
+            self._stats["misses"] += 1
+        return default
+
+    def _current_gens(self, tags: Iterable[str]) -> Tuple[Tuple[str, int], ...]:
+        return tuple((t, self._tags.gen(t)) for t in tags)
+
+    def _set_local(self, key: Hashable, value: Any, ttl: float, tag_gens, now: float) -> None:
+        with self._lock:
+            self._lru[key] = (now + ttl, tag_gens, value)
+            self._lru.move_to_end(key)
+            while len(self._lru) > self.max_entries:
+                self._lru.popitem(last=False)
+                self._stats["evictions"] += 1
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None, tags: Iterable[str] = (),
+            local_only: bool = False) -> None:
+        """Guarda un valor. `local_only=True` evita el tier en disco (datos sensibles)."""
+        ttl = self.default_ttl if ttl is None else ttl
+        tag_gens = self._current_gens(tags)
+        self._set_local(key, value, ttl, tag_gens, time.monotonic())
+        with self._lock:
+            self._stats["sets"] += 1
+        if self._disk is not None and not local_only:
+            self._disk.set(self._disk_key(key), value, ttl, tag_gens)
+
+    def get_or_set(self, key: Hashable, loader: Callable[[], Any], ttl: Optional[float] = None,
+                   tags: Iterable[str] = (), local_only: bool = False) -> Any:
+        """Devuelve el valor cacheado o lo calcula con `loader()` y lo guarda."""
+        value = self.get(key, _MISS)
+        if value is not _MISS:
+            return value
+        tags = tuple(tags)
+        # tomar generaciones antes de cargar: si se invalida mientras tanto,
+        # la entrada nace obsoleta en vez de guardar datos viejos
+        tag_gens = self._current_gens(tags)
+        value = loader()
+        ttl = self.default_ttl if ttl is None else ttl
+        self._set_local(key, value, ttl, tag_gens, time.monotonic())
+        with self._lock:
+            self._stats["sets"] += 1
+        if self._disk is not None and not local_only:
+            self._disk.set(self._disk_key(key), value, ttl, tag_gens)
+        return value
+
+    def invalidate(self, *tags: str) -> None:
+        """Invalida todas las entradas que llevan alguno de los tags."""
+        with self._lock:
+            for t in tags:
+                self._tags.bump(t)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._lru.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            out = dict(self._stats)
+            out["entries"] = len(self._lru)
+        total = out["hits"] + out["misses"]
+        out["hit_ratio"] = round(out["hits"] / total, 3) if total else 0.0
+        out["disk"] = self._disk is not None
+        return out
+
+
+# Instancia compartida del proceso
+cache = TwoTierCache()
@@ -0,0 +1,183 @@
+"""Sincronización incremental del catálogo (/productos/changes).
+
+`productos.updated_at` se actualiza solo (ON UPDATE current_timestamp(), también
+con cada compra que descuenta stock); con un índice `(updated_at, id)` se lee
+por keyset lo que cambió desde la marca del cliente. Los borrados no dejan fila:
+un trigger AFTER DELETE los anota en `productos_tombstones`.
+
+Productos y tombstones se recorren como un solo flujo ordenado por
+(ts, tipo, id), con tipo 0 = alta/cambio y 1 = borrado; la marca (`next`, opaca
+para el cliente) es la posición en ese flujo, así un borrado nunca llega antes
+que un cambio anterior del mismo producto. Solo se entregan filas con ts
+anterior a NOW() - CATALOG_CHANGES_LAG_SEC: una transacción todavía sin
+confirmar (o del mismo segundo) puede tener un updated_at menor que lo ya
+entregado, y sin ese margen quedaría detrás de la marca para siempre.
+
+El margen tiene que cubrir la transacción de escritura más larga sobre
+`productos`: las compras (updated_at se fija al descontar stock y el COMMIT
+llega al cerrar el lote del group commit, acotado por DB_BUDGET_CHECKOUT_SEC
+por sentencia y GROUP_COMMIT_WAIT_SEC) y las ediciones del panel
+(DB_BUDGET_ADMIN_SEC). Por defecto se deriva de esos valores; si se suben,
+el margen sube con ellos.
+
+Se lee del primario: en una réplica atrasada una fila anterior al corte podría
+no haber llegado aún y la marca la saltaría.
+"""
+import os
+import math
+import base64
+import logging
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+from .db import get_conn
+from .catalogo import producto_cols
+from .admission import DB_BUDGETS
+from .group_commit import GROUP_COMMIT_WAIT_SEC
+
+logger = logging.getLogger("tienda-api")
+
+# Transacción de escritura más larga esperable (s) + 2 s de holgura
+_LAG_MIN = math.ceil(max(GROUP_COMMIT_WAIT_SEC, DB_BUDGETS["checkout"], DB_BUDGETS["admin"])) + 2
+CATALOG_CHANGES_LAG_SEC = int(os.getenv("CATALOG_CHANGES_LAG_SEC", str(_LAG_MIN)))
+if CATALOG_CHANGES_LAG_SEC < _LAG_MIN:
+    logger.warning(
+        "CATALOG_CHANGES_LAG_SEC=%s es menor que la transacción de escritura más larga (%ss): "
+        "/productos/changes puede saltarse cambios", CATALOG_CHANGES_LAG_SEC, _LAG_MIN,
+    )
+# Tombstones más viejos se purgan (scripts/maintenance.py productos_tombstones);
+# una marca anterior a eso ya no puede saber qué se borró: 410 y recarga completa
+CATALOG_TOMBSTONE_DAYS = int(os.getenv("CATALOG_TOMBSTONE_DAYS", "30"))
+
+_FMT = "%Y-%m-%d %H:%M:%S"
+_ORIGEN = "1970-01-02 00:00:00"
+
+Posicion = Tuple[str, int, int]
+
+_schema_ready = False
+
+
+class MarcaInvalida(ValueError):
+    """El token `since` no es una marca emitida por este endpoint."""
+
+
+class MarcaExpirada(Exception):
+    """La marca es anterior a la retención de tombstones: hay que recargar todo."""
+
+
+def ensure_changes_schema() -> None:
+    global _schema_ready
+    if _schema_ready:
+        return
+    conn = get_conn()
+    try:
+        with conn.cursor() as c:
+            c.execute("CREATE INDEX IF NOT EXISTS idx_productos_updated ON productos (updated_at, id)")
+            c.execute("""
+            CREATE TABLE IF NOT EXISTS productos_tombstones (
+                id INT NOT NULL PRIMARY KEY,
+                deleted_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                KEY idx_tombstones_deleted (deleted_at, id)
+            ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+            """)
+            c.execute("""
+            CREATE TRIGGER IF NOT EXISTS trg_productos_tombstone AFTER DELETE ON productos
+            FOR EACH ROW
+                INSERT INTO productos_tombstones (id, deleted_at) VALUES (OLD.id, NOW())
+                ON DUPLICATE KEY UPDATE deleted_at = NOW()
+            """)
+        conn.commit()
+    finally:
+        conn.close()
+    _schema_ready = True
+
+
+def codificar_marca(pos: Posicion) -> str:
+    raw = "|".join(str(x) for x in pos)
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decodificar_marca(token: str) -> Posicion:
+    try:
+        raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)).decode()
+        ts, tipo, pid = raw.split("|")
+        # validar formato: los valores van como parámetros, pero una fecha rota daría 500
+        datetime.strptime(ts, _FMT)
+        return ts, int(tipo), int(pid)
+    except Exception as e:
+        raise MarcaInvalida(str(e)) from e
+
+
+def _ts(v: Any) -> str:
+    return v.strftime(_FMT) if isinstance(v, datetime) else str(v)
+
+
+def _despues_de(col: str, tipo: int, pos: Posicion) -> Tuple[str, List[Any]]:
+    """(col, tipo, id) > pos para una tabla de tipo fijo, como rango sobre el índice (col, id)."""
+    ts, ptipo, pid = pos
+    if tipo > ptipo:
+        return f"{col} >= %s", [ts]
+    if tipo < ptipo:
+        return f"{col} > %s", [ts]
+    return f"{col} >= %s AND ({col} > %s OR id > %s)", [ts, ts, pid]
+
+
+def cambios_desde(since: Optional[str], limit: int) -> Dict[str, Any]:
+    """Productos cambiados e ids borrados después de la marca `since` (None = todo).
+
+    `more=True` indica que hay más páginas: repetir con `since=next` de inmediato.
+    """
+    pos = decodificar_marca(since) if since else (_ORIGEN, 0, 0)
+    ensure_changes_schema()
+    cols_sql = ",".join(producto_cols())
+    conn = get_conn()
+    try:
+        with conn.cursor() as c:
+            c.execute(
+                "SELECT NOW() - INTERVAL %s SECOND AS corte, NOW() - INTERVAL %s DAY AS retencion",
+                (CATALOG_CHANGES_LAG_SEC, CATALOG_TOMBSTONE_DAYS),
+            )
+            row = c.fetchone()
+            corte, retencion = _ts(row["corte"]), _ts(row["retencion"])
+            if since and pos[0] < retencion:
+                raise MarcaExpirada()
+            where, args = _despues_de("updated_at", 0, pos)
+            c.execute(
+                f"SELECT {cols_sql}, updated_at AS _ts FROM productos"
+                f" WHERE {where} AND updated_at < %s ORDER BY updated_at, id LIMIT %s",
+                args + [corte, limit],
+            )
+            cambios = [(_ts(r.pop("_ts")), 0, r["id"], r) for r in c.fetchall()]
+            where, args = _despues_de("deleted_at", 1, pos)
+            c.execute(
+                f"SELECT id, deleted_at AS _ts FROM productos_tombstones"
+                f" WHERE {where} AND deleted_at < %s ORDER BY deleted_at, id LIMIT %s",
+                args + [corte, limit],
+            )
+            cambios += [(_ts(r["_ts"]), 1, r["id"], None) for r in c.fetchall()]
+        conn.commit()
+    finally:
+        conn.close()
+
+    cambios.sort(key=lambda e: e[:3])
+    more = len(cambios) >= limit
+    cambios = cambios[:limit]
+    # página completa: seguir desde el último evento; si no, desde el corte
+    siguiente = cambios[-1][:3] if more else (corte, 0, 0)
+
+    # aplicados en orden: cada id queda solo en la lista de su último evento
+    items: Dict[int, Dict[str, Any]] = {}
+    borrados: Dict[int, None] = {}
+    for _, tipo, pid, fila in cambios:
+        if tipo == 0:
+            items[pid] = fila
+            borrados.pop(pid, None)
+        else:
+            items.pop(pid, None)
+            borrados[pid] = None
+    return {
+        "items": list(items.values()),
+        "deleted": list(borrados),
+        "next": codificar_marca(siguiente),
+        "more": more,
+    }
@@ -0,0 +1,130 @@
+import math
+from typing import Any, Dict, Iterable, List
+
+from .db import get_conn, schema_has
+from .cache import cache
+from .filas import ObjetoJSON, json_float, json_int, json_str
+from .models import Producto
+
+# Tope de ids por consulta batch (un solo WHERE id IN (...))
+MAX_IDS_BATCH = 100
+
+# Reglas comerciales del carrito (mismas que `totals()` en frontend/js/cart.js)
+ENVIO_PCT = 0.02
+ENVIO_MAX = 4990
+DESCUENTO_UMBRAL = 50000
+DESCUENTO_PCT = 0.05
+
+
+def producto_cols() -> List[str]:
+    """Columnas de `productos` que existen en el esquema, en el orden de `Producto`."""
+    select_cols = ["id", "nombre", "precio", "stock"]
+    if schema_has("productos", "categoria"):
+        select_cols.append("categoria")
+    # Image columns: imagen_url is common; optionally include imagen_srcset, imagen_width, imagen_height
+    if schema_has("productos", "imagen_url"):
+        select_cols.append("imagen_url")
+    if schema_has("productos", "imagen_srcset"):
+        select_cols.append("imagen_srcset")
+    if schema_has("productos", "imagen_width"):
+        select_cols.append("imagen_width")
+    if schema_has("productos", "imagen_height"):
+        select_cols.append("imagen_height")
+    if schema_has("productos", "descripcion"):
+        select_cols.append("descripcion")
+    return select_cols
+
+
+# Campos de `Producto` en orden, con la conversión que haría el modelo
+_JSON_POR_TIPO = {int: json_int, float: json_float, str: json_str}
+PRODUCTO_CAMPOS = [(nombre, _JSON_POR_TIPO[f.type_]) for nombre, f in Producto.__fields__.items()]
+PRODUCTO_JSON = ObjetoJSON(PRODUCTO_CAMPOS)
+
+
+def producto_select() -> str:
+    """Todos los campos de `Producto` en orden (NULL si la columna no existe), para `PRODUCTO_JSON`."""
+    existentes = set(producto_cols())
+    return ",".join(c if c in existentes else f"NULL AS {c}" for c, _ in PRODUCTO_CAMPOS)
+
+
+def productos_por_ids(ids: Iterable[int]) -> Dict[int, Dict[str, Any]]:
+    """Devuelve {id: fila} para los ids pedidos (los inexistentes no aparecen).
+
+    Primero se consulta la caché por producto (tag 'catalogo'); los que faltan
+    se resuelven con una sola consulta `WHERE id IN (...)` por la PK.
+    """
+    wanted = list(dict.fromkeys(int(i) for i in ids))
+    found: Dict[int, Dict[str, Any]] = {}
+    missing: List[int] = []
+    for pid in wanted:
+        row = cache.get(("producto", pid))
+        if row is None:
+            missing.append(pid)
+        else:
+            found[pid] = row
+    if missing:
+        cols_sql = ",".join(producto_cols())
+        marks = ",".join(["%s"] * len(missing))
+        conn = get_conn(read=True)
+        try:
+            with conn.cursor() as c:
+                c.execute(f"SELECT {cols_sql} FROM productos WHERE id IN ({marks})", missing)
+                rows = c.fetchall()
+            conn.commit()
+        finally:
+            conn.close()
+        for row in rows:
+            found[row["id"]] = row
+            cache.set(("producto", row["id"]), row, tags=("catalogo",))
+    return found
+
+
+def _redondear(x: float) -> int:
+    # Igual que Math.round en JS (mitades hacia arriba), no el redondeo bancario de Python
+    return int(math.floor(x + 0.5))
+
+
+def totales_carrito(subtotal: float) -> Dict[str, float]:
+    envio = _redondear(min(ENVIO_MAX, subtotal * ENVIO_PCT)) if subtotal > 0 else 0
+    descuento = _redondear(subtotal * DESCUENTO_PCT) if subtotal >= DESCUENTO_UMBRAL else 0
+    return {
+        "subtotal": round(subtotal, 2),
+        "envio": envio,
+        "descuento": descuento,
+        "total": max(0, round(subtotal + envio - descuento, 2)),
+    }
+
+
+def cotizar(items: List[Any]) -> Dict[str, Any]:
+    """Cotiza un carrito (lista de CheckoutItem) con precios y stock actuales."""
+    pedidos: Dict[int, int] = {}
+    for it in items:
+        pedidos[it.producto_id] = pedidos.get(it.producto_id, 0) + it.cantidad
+    prods = productos_por_ids(pedidos.keys())
+
+    lineas = []
+    subtotal = 0.0
+    ok = True
+    for pid, cantidad in pedidos.items():
+        p = prods.get(pid)
+        if p is None:
+            ok = False
+            lineas.append({"producto_id": pid, "cantidad": cantidad, "existe": False, "disponible": False})
+            continue
+        precio = float(p["precio"])
+        stock = int(p["stock"])
+        disponible = stock >= cantidad
+        ok = ok and disponible
+        linea_sub = round(precio * cantidad, 2)
+        subtotal += linea_sub
+        lineas.append({
+            "producto_id": pid,
+            "nombre": p["nombre"],
+            "cantidad": cantidad,
+            "precio_unit": precio,
+            "subtotal": linea_sub,
+            "stock": stock,
+            "existe": True,
+            "disponible": disponible,
+        })
+    return {"ok": ok, "items": lineas, **totales_carrito(subtotal)}
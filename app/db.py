@@ -10,15 +10,23 @@ import secrets
 import queue
 import threading
 import time
+import logging
 import smtplib
+from contextvars import ContextVar
 from email.message import EmailMessage
 from datetime import datetime, timezone, timedelta
 
+from .cache import cache
+from .pending_tokens import pending_tokens
+from .breaker import db_breaker, CircuitOpenError
+
 # Cargar variables de entorno preferentemente desde el archivo `app/.env` (si existe),
 # y luego cargar cualquier `.env` en el directorio de trabajo como fallback.
 load_dotenv(os.path.join(os.path.dirname(__file__), '.env'))
 load_dotenv()
 
+logger = logging.getLogger("tienda-api")
+
 DB_HOST = os.getenv("DB_HOST", "127.0.0.1")
 DB_USER = os.getenv("DB_USER", "root")
 DB_PASS = os.getenv("DB_PASS", "")
@@ -32,35 +40,108 @@ SMTP_PORT = int(os.getenv("SMTP_PORT", "0") or 0)
 SMTP_USER = os.getenv("SMTP_USER", "")
 SMTP_PASS = os.getenv("SMTP_PASS", "")
 SMTP_FROM = os.getenv("SMTP_FROM", "no-reply@tienda.local")
+# Desactivar STARTTLS para relays locales sin TLS (p. ej. servidor SMTP de depuración)
+SMTP_STARTTLS = os.getenv("SMTP_STARTTLS", "1") not in ("0", "false", "no")
 FRONTEND_URL = os.getenv("FRONTEND_URL", "http://127.0.0.1:8000/app")
 
 JWT_SECRET = os.getenv("JWT_SECRET", "dev-secret-change")
 JWT_EXPIRE_MIN = int(os.getenv("JWT_EXPIRE_MIN", "60"))
+# Vida de un refresh token; cada uso lo rota (el nuevo vuelve a durar esto)
+REFRESH_EXPIRE_DAYS = int(os.getenv("REFRESH_EXPIRE_DAYS", "30"))
+# Segundos en que un refresh token recién rotado aún se acepta (pestañas que
+# renuevan a la vez) sin tratarlo como reuso; 0 = desactivado
+REFRESH_REUSE_GRACE_SEC = int(os.getenv("REFRESH_REUSE_GRACE_SEC", "10"))
 
 # Connection pool (simple, local, thread-safe)
 POOL_MAX = int(os.getenv("DB_POOL_MAX", "8"))
 POOL_MIN = int(os.getenv("DB_POOL_MIN", "1"))
 _pool_lock = threading.Lock()
 _conn_pool: "queue.Queue[pymysql.connections.Connection]" = queue.Queue(maxsize=POOL_MAX)
+# Conexiones extra permitidas al primario cuando el pool está agotado (antes no tenía tope)
+DB_POOL_OVERFLOW_MAX = int(os.getenv("DB_POOL_OVERFLOW_MAX", str(POOL_MAX)))
+_primary_in_use = 0
+_in_use_lock = threading.Lock()
+
+# Réplica de solo lectura (opcional). Si DB_READ_HOST está vacío todo va al primario.
+DB_READ_HOST = os.getenv("DB_READ_HOST", "")
+DB_READ_PORT = int(os.getenv("DB_READ_PORT", str(DB_PORT)))
+DB_READ_USER = os.getenv("DB_READ_USER", DB_USER)
+DB_READ_PASS = os.getenv("DB_READ_PASS", DB_PASS)
+DB_READ_POOL_MAX = int(os.getenv("DB_READ_POOL_MAX", "8"))
+# Segundos durante los que un cliente lee del primario tras escribir (read-your-writes)
+DB_READ_STICKY_SEC = float(os.getenv("DB_READ_STICKY_SEC", "5"))
+# Segundos que se evita la réplica tras un fallo antes de reintentar
+DB_READ_RETRY_SEC = float(os.getenv("DB_READ_RETRY_SEC", "30"))
+# Máximo de lecturas concurrentes desviadas al primario cuando la réplica cae,
+# para que los reportes no agoten el pool que usan los checkouts
+DB_READ_FAILOVER_MAX = int(os.getenv("DB_READ_FAILOVER_MAX", "2"))
+_read_pool: "queue.Queue[pymysql.connections.Connection]" = queue.Queue(maxsize=DB_READ_POOL_MAX)
+_read_down_until = 0.0
+_failover_sem = threading.BoundedSemaphore(max(1, DB_READ_FAILOVER_MAX))
+
+# Timeouts del cliente (s). DB_READ_TIMEOUT es el tope de socket cuando la petición
+# no trae presupuesto; con presupuesto se usa presupuesto + DB_TIMEOUT_MARGIN_SEC,
+# de modo que normalmente sea el servidor (max_statement_time) quien corte antes.
+DB_CONNECT_TIMEOUT = float(os.getenv("DB_CONNECT_TIMEOUT", "5"))
+DB_READ_TIMEOUT = float(os.getenv("DB_READ_TIMEOUT", "60"))
+DB_WRITE_TIMEOUT = float(os.getenv("DB_WRITE_TIMEOUT", "30"))
+DB_TIMEOUT_MARGIN_SEC = float(os.getenv("DB_TIMEOUT_MARGIN_SEC", "2"))
+# Presupuesto de tiempo por sentencia de la petición actual (lo fija el middleware)
+_stmt_budget: ContextVar[Optional[float]] = ContextVar("db_stmt_budget", default=None)
+_stmt_budget_supported = True
+
+# Cliente de la petición actual (lo fija el middleware) y últimas escrituras por cliente
+_client_key: ContextVar[Optional[str]] = ContextVar("db_client_key", default=None)
+_last_write: Dict[str, float] = {}
+_last_write_lock = threading.Lock()
+
+
+class _Connection(pymysql.connections.Connection):
+    """Conexión que recuerda el error de socket con el que se cerró (ver `_PooledConnection.close`)."""
+    _tienda_error: Optional[BaseException] = None
+
+    def _read_bytes(self, num_bytes):
+        try:
+            return super()._read_bytes(num_bytes)
+        except BaseException as e:
+            self._tienda_error = e
+            raise
+
+    def _write_bytes(self, data):
+        try:
+            return super()._write_bytes(data)
+        except BaseException as e:
+            self._tienda_error = e
+            raise
 
 
-def _create_raw_conn():
+def _fallo_de_conexion(e: Optional[BaseException]) -> bool:
+    """Conexión perdida por la BD/red (2003/2006/2013), no por agotar el presupuesto de la petición."""
+    if not isinstance(e, OperationalError) or not e.args or e.args[0] not in (2003, 2006, 2013):
+        return False
+    return db_timeout_status(e) is None
+
+
+def _create_raw_conn(read: bool = False):
     # Construir argumentos SSL si se proporcionó CA
     ssl_args = None
     if DB_SSL_CA:
         # pymysql espera un dict con clave 'ca' apuntando al archivo PEM
         ssl_args = {"ca": DB_SSL_CA}
 
-    return pymysql.connect(
-        host=DB_HOST,
-        user=DB_USER,
-        password=DB_PASS,
+    return _Connection(
+        host=DB_READ_HOST if read else DB_HOST,
+        user=DB_READ_USER if read else DB_USER,
+        password=DB_READ_PASS if read else DB_PASS,
         database=DB_NAME,
-        port=DB_PORT,
+        port=DB_READ_PORT if read else DB_PORT,
         cursorclass=DictCursor,
         autocommit=False,
         charset="utf8mb4",
         ssl=ssl_args,
+        connect_timeout=DB_CONNECT_TIMEOUT,
+        read_timeout=DB_READ_TIMEOUT,
+        write_timeout=DB_WRITE_TIMEOUT,
     )
 
 
@@ -77,16 +158,47 @@ def _init_pool():
 # Initialize pool lazily
 _init_pool()
 
+
+# ----------------------------
+# Read-your-writes
+# ----------------------------
+def set_client_key(key: Optional[str]):
+    """Asocia la petición en curso a un cliente (IP). Devuelve el token del ContextVar."""
+    return _client_key.set(key)
+
+
+def reset_client_key(token) -> None:
+    _client_key.reset(token)
+
+
+def mark_write() -> None:
+    """Marca que el cliente actual acaba de escribir: sus lecturas irán al primario
+    durante DB_READ_STICKY_SEC."""
+    key = _client_key.get()
+    if not key or not DB_READ_HOST:
+        return
+    now = time.monotonic()
+    with _last_write_lock:
+        _last_write[key] = now
+        if len(_last_write) > 10_000:
+            for k in [k for k, t in _last_write.items() if now - t > DB_READ_STICKY_SEC]:
+                del _last_write[k]
+
+
+def _sticky_to_primary() -> bool:
+    key = _client_key.get()
+    if not key:
+        return False
+    t = _last_write.get(key)
+    return t is not None and time.monotonic() - t <= DB_READ_STICKY_SEC
+
+
 # ----------------------------
 # Conexión MySQL (VM2)
 # ----------------------------
-def get_conn(timeout: float = 5.0):
-    """
-    Obtener una conexión desde el pool (si está disponible) o crear una nueva.
-    Devuelve una conexión que debe cerrarse por quien la recibe (conn.close()).
-    """
+def _checkout(pool: "queue.Queue", read: bool, timeout: float):
     try:
-        conn = _conn_pool.get(block=True, timeout=timeout)
+        conn = pool.get(block=True, timeout=timeout)
         # test connection
         try:
             with conn.cursor() as c:
@@ -96,23 +208,168 @@ def get_conn(timeout: float = 5.0):
                 conn.close()
             except Exception:
                 pass
-            conn = _create_raw_conn()
-        return _PooledConnection(conn)
+            conn = _create_raw_conn(read)
     except queue.Empty:
-        # pool agotado, crear conexión temporal
-        raw = _create_raw_conn()
-        return _PooledConnection(raw)
+        # pool agotado, crear conexión temporal (acotada en el primario)
+        if not read and _primary_in_use >= POOL_MAX + DB_POOL_OVERFLOW_MAX:
+            raise OperationalError(1040, "Pool de conexiones agotado")
+        conn = _create_raw_conn(read)
+    try:
+        _apply_budget(conn)
+    except Exception:
+        conn.close()
+        raise
+    return conn
+
+
+def set_statement_budget(seconds: Optional[float]):
+    """Fija el presupuesto (s) de cada sentencia SQL de la petición actual; 0/None = sin límite."""
+    return _stmt_budget.set(seconds)
+
+
+def reset_statement_budget(token) -> None:
+    _stmt_budget.reset(token)
+
+
+def statement_budget() -> Optional[float]:
+    """Presupuesto (s) de la petición actual, para capturarlo antes de pasar trabajo a otro hilo."""
+    return _stmt_budget.get()
+
+
+def apply_statement_budget(conn, seconds: Optional[float]) -> None:
+    """Aplica a una conexión ya tomada del pool un presupuesto capturado en otro contexto.
+
+    Los hilos de fondo no heredan el ContextVar de la petición (p. ej. el escritor
+    de group commit, que aplica el de cada compra antes de ejecutarla).
+    """
+    token = _stmt_budget.set(seconds)
+    try:
+        _apply_budget(getattr(conn, "_conn", conn))
+    finally:
+        _stmt_budget.reset(token)
+
+
+def _apply_budget(conn) -> None:
+    """Ajusta max_statement_time y el timeout de socket de la conexión al presupuesto actual.
+
+    El SET solo se envía cuando el presupuesto cambia respecto al último que tuvo
+    esa conexión (se recuerda en el propio objeto).
+    """
+    global _stmt_budget_supported
+    budget = float(_stmt_budget.get() or 0)
+    if _stmt_budget_supported and getattr(conn, "_tienda_stmt_budget", 0.0) != budget:
+        try:
+            with conn.cursor() as c:
+                c.execute("SET SESSION max_statement_time = %s", (budget,))
+            conn._tienda_stmt_budget = budget
+        except (OperationalError, ProgrammingError) as e:
+            if e.args and e.args[0] == 1193:  # variable desconocida: MySQL, no MariaDB
+                _stmt_budget_supported = False
+                logger.warning("El servidor no soporta max_statement_time; solo se aplican timeouts del cliente")
+            else:
+                raise
+    # pymysql aplica _read_timeout al socket en cada lectura
+    conn._read_timeout = budget + DB_TIMEOUT_MARGIN_SEC if budget else DB_READ_TIMEOUT
+
+
+def db_timeout_status(e: Exception) -> Optional[int]:
+    """503 si el servidor canceló la sentencia por presupuesto, 504 si venció el timeout del cliente."""
+    code = e.args[0] if getattr(e, "args", None) else None
+    if code in (1969, 3024):  # MariaDB max_statement_time / MySQL max_execution_time
+        return 503
+    if code == 2013 and "timed out" in str(e):
+        return 504
+    return None
+
+
+def pool_stats() -> Dict[str, int]:
+    """Ocupación del pool del primario (la usa el control de admisión)."""
+    return {"max": POOL_MAX, "overflow_max": DB_POOL_OVERFLOW_MAX, "in_use": _primary_in_use}
+
+
+def pool_saturation() -> float:
+    """Fracción del pool del primario en uso (puede superar 1.0 con conexiones extra)."""
+    return _primary_in_use / POOL_MAX if POOL_MAX > 0 else 0.0
+
+
+def _track_primary(delta: int) -> None:
+    global _primary_in_use
+    with _in_use_lock:
+        _primary_in_use += delta
+
+
+def get_conn(timeout: float = 5.0, read: bool = False):
+    """
+    Obtener una conexión desde el pool (si está disponible) o crear una nueva.
+    Devuelve una conexión que debe cerrarse por quien la recibe (conn.close()).
+
+    Con `read=True` la consulta es de solo lectura y se envía a la réplica
+    (DB_READ_HOST) salvo que el cliente haya escrito hace poco o la réplica
+    esté caída; en ese caso se usa el primario con concurrencia acotada.
+    """
+    global _read_down_until
+    if read and DB_READ_HOST and not _sticky_to_primary():
+        if time.monotonic() >= _read_down_until:
+            try:
+                return _PooledConnection(_checkout(_read_pool, True, timeout), _read_pool)
+            except Exception:
+                _read_down_until = time.monotonic() + DB_READ_RETRY_SEC
+                logger.warning(
+                    "Réplica %s no disponible; lecturas al primario por %ss", DB_READ_HOST, DB_READ_RETRY_SEC
+                )
+        # failover: leer del primario sin acaparar su pool
+        if not _failover_sem.acquire(timeout=timeout):
+            raise OperationalError(2013, "Réplica no disponible y cupo de failover agotado")
+        try:
+            conn = _checkout_primary(timeout)
+        except Exception:
+            _failover_sem.release()
+            raise
+        return _PooledConnection(conn, _conn_pool, on_close=_failover_sem.release)
+    return _PooledConnection(_checkout_primary(timeout), _conn_pool)
+
+
+def _checkout_primary(timeout: float):
+    """Checkout del primario a través del circuit breaker (app/breaker.py)."""
+    if not db_breaker.allow():
+        raise CircuitOpenError(2003, "Base de datos no disponible (circuito abierto)")
+    try:
+        conn = _checkout(_conn_pool, False, timeout)
+    except OperationalError as e:
+        # pool agotado no indica que la BD esté caída
+        if e.args and e.args[0] == 1040:
+            db_breaker.abort()
+        else:
+            db_breaker.failure()
+        raise
+    db_breaker.success()
+    return conn
 
 
 class _PooledConnection:
     """Wrapper que devuelve la conexión al pool cuando se cierra."""
-    def __init__(self, conn: pymysql.connections.Connection):
+    def __init__(self, conn: pymysql.connections.Connection, pool: "queue.Queue" = _conn_pool, on_close=None):
         self._conn = conn
+        self._pool = pool
+        self._on_close = on_close
+        self._tracked = pool is _conn_pool
+        if self._tracked:
+            _track_primary(1)
 
     def __getattr__(self, item):
         return getattr(self._conn, item)
 
     def close(self):
+        if self._on_close is not None:
+            cb, self._on_close = self._on_close, None
+            cb()
+        if self._tracked:
+            self._tracked = False
+            _track_primary(-1)
+            # una conexión del primario que murió durante una consulta cuenta como fallo,
+            # salvo que la cerrara el timeout de socket de una consulta lenta (presupuesto)
+            if not self._conn.open and _fallo_de_conexion(getattr(self._conn, "_tienda_error", None)):
+                db_breaker.failure()
         # en lugar de cerrar, intentamos devolver al pool
         try:
             if self._conn.open:
@@ -122,7 +379,7 @@ class _PooledConnection:
                 except Exception:
                     pass
                 try:
-                    _conn_pool.put(self._conn, block=False)
+                    self._pool.put(self._conn, block=False)
                     return
                 except Exception:
                     pass
@@ -153,11 +410,22 @@ def ensure_schema():
             ALTER TABLE usuarios ADD COLUMN IF NOT EXISTS password_reset_required TINYINT(1) NOT NULL DEFAULT 0;
             """)
         conn.commit()
+        cache.invalidate("schema")
     finally:
         conn.close()
 
 def schema_has(table: str, column: Optional[str] = None, db: Optional[str] = None) -> bool:
-    conn = get_conn()
+    # El esquema casi nunca cambia: cachear en memoria (no en disco) 5 minutos
+    return cache.get_or_set(
+        ("schema_has", db or DB_NAME, table, column),
+        lambda: _schema_has_db(table, column, db),
+        ttl=300,
+        tags=("schema",),
+        local_only=True,
+    )
+
+def _schema_has_db(table: str, column: Optional[str] = None, db: Optional[str] = None) -> bool:
+    conn = get_conn(read=True)
     try:
         with conn.cursor() as c:
             if column:
@@ -207,7 +475,12 @@ def create_user(email: str, nombre: str, password: str, rol: str = "user") -> in
             params = (email, nombre, pwd, salt, db_rol)
             c.execute(sql, params)
             user_id = c.lastrowid
+            from .outbox import emit
+            emit(c, "usuario.creado", user_id, {"id": user_id, "rol": rol})
         conn.commit()
+        # solo su propia clave (por si quedó un None cacheado para ese id); el resto
+        # de principales no puede depender de un usuario que no existía
+        cache.invalidate(f"usuario:{user_id}")
         return user_id
     finally:
         conn.close()
@@ -268,7 +541,9 @@ def ensure_password_resets_table():
                 used TINYINT(1) NOT NULL DEFAULT 0,
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                 FOREIGN KEY (user_id) REFERENCES usuarios(id) ON DELETE CASCADE,
-                UNIQUE KEY uq_token_hash (token_hash)
+                UNIQUE KEY uq_token_hash (token_hash),
+                KEY idx_password_resets_expires (expires_at),
+                KEY idx_password_resets_used (used)
             ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
             """)
         conn.commit()
@@ -321,13 +596,7 @@ def verify_password_reset_token(token: str) -> Optional[Dict[str, Any]]:
         except Exception:
             return None
         if datetime.now(timezone.utc) > expires_dt:
-            # token expirado; limpiar
-            try:
-                with conn.cursor() as c:
-                    c.execute("DELETE FROM password_resets WHERE id=%s", (row['id'],))
-                conn.commit()
-            except Exception:
-                pass
+            # token expirado; lo borra el mantenimiento por lotes (scripts/cleanup_password_resets.py)
             return None
         return row
     finally:
@@ -342,6 +611,7 @@ def consume_password_reset_token(token: str, new_password: str) -> bool:
     user_id = row['user_id']
     # generar hash nuevo
     pwd, salt = hash_password(new_password)
+    ensure_refresh_tokens_table()
 
     conn = get_conn()
     try:
@@ -351,7 +621,12 @@ def consume_password_reset_token(token: str, new_password: str) -> bool:
                 (pwd, salt, user_id),
             )
             c.execute("UPDATE password_resets SET used=1 WHERE id=%s", (row['id'],))
+            # cerrar todas las sesiones abiertas con la contraseña anterior
+            _revoke_user_refresh_tokens(c, user_id)
+            from .outbox import emit
+            emit(c, "usuario.password_reset", user_id, {"id": user_id})
         conn.commit()
+        cache.invalidate(f"usuario:{user_id}")
         return True
     except Exception:
         conn.rollback()
@@ -360,12 +635,149 @@ def consume_password_reset_token(token: str, new_password: str) -> bool:
         conn.close()
 
 
-def send_reset_email(to_email: str, to_name: str, token: str) -> bool:
-    """Enviar email con enlace de reseteo. Requiere variables SMTP configuradas en env.
-    Retorna True si se envió, False en caso de error o si SMTP no está configurado.
+# ----------------------------
+# Refresh tokens (rotativos)
+# ----------------------------
+_refresh_table_ready = False
+
+
+def ensure_refresh_tokens_table():
+    # Está en la ruta caliente de /token/refresh: el DDL se ejecuta una vez por proceso
+    global _refresh_table_ready
+    if _refresh_table_ready:
+        return
+    conn = get_conn()
+    try:
+        with conn.cursor() as c:
+            # family_id agrupa la cadena de rotaciones de un mismo login
+            c.execute("""
+            CREATE TABLE IF NOT EXISTS refresh_tokens (
+                id INT AUTO_INCREMENT PRIMARY KEY,
+                user_id INT NOT NULL,
+                token_hash CHAR(64) NOT NULL,
+                family_id CHAR(32) NOT NULL,
+                expires_at DATETIME NOT NULL,
+                revoked TINYINT(1) NOT NULL DEFAULT 0,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (user_id) REFERENCES usuarios(id) ON DELETE CASCADE,
+                UNIQUE KEY uq_refresh_token_hash (token_hash),
+                KEY idx_refresh_tokens_family (family_id),
+                KEY idx_refresh_tokens_user (user_id, revoked),
+                KEY idx_refresh_tokens_expires (expires_at)
+            ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+            """)
+            # UTC como expires_at; NULL = revocado por logout/reuso (sin gracia)
+            c.execute("ALTER TABLE refresh_tokens ADD COLUMN IF NOT EXISTS rotated_at DATETIME NULL")
+        conn.commit()
+    finally:
+        conn.close()
+    _refresh_table_ready = True
+
+
+def _refresh_hash(token: str) -> str:
+    # El token tiene 256 bits aleatorios: un SHA-256 simple basta (no hace falta PBKDF2)
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+
+def _insert_refresh_token(c, user_id: int, family_id: str) -> str:
+    token = secrets.token_urlsafe(32)
+    expires_at = (datetime.now(timezone.utc) + timedelta(days=REFRESH_EXPIRE_DAYS)).strftime('%Y-%m-%d %H:%M:%S')
+    c.execute(
+        "INSERT INTO refresh_tokens (user_id, token_hash, family_id, expires_at) VALUES (%s, %s, %s, %s)",
+        (user_id, _refresh_hash(token), family_id, expires_at),
+    )
+    return token
+
+
+def _revoke_user_refresh_tokens(c, user_id: int) -> None:
+    c.execute("UPDATE refresh_tokens SET revoked=1 WHERE user_id=%s AND revoked=0", (user_id,))
+
+
+def create_refresh_token(user_id: int) -> str:
+    """Crea el refresh token de un login nuevo (familia nueva). Devuelve el token en claro."""
+    ensure_refresh_tokens_table()
+    conn = get_conn()
+    try:
+        with conn.cursor() as c:
+            token = _insert_refresh_token(c, user_id, secrets.token_hex(16))
+        conn.commit()
+        return token
+    finally:
+        conn.close()
+
+
+def rotate_refresh_token(token: str) -> Optional[Dict[str, Any]]:
+    """Canjea un refresh token por uno nuevo de la misma familia.
+
+    Devuelve {"user_id", "refresh_token"} o None si no es válido. Presentar un
+    token ya rotado (revocado) indica robo o reuso: se revoca toda la familia.
+    Excepción: dentro de REFRESH_REUSE_GRACE_SEC desde su rotación (dos pestañas
+    que renuevan a la vez) se emite otro token de la familia si sigue activa.
     """
-    if not SMTP_HOST or not SMTP_PORT:
-        return False
+    ensure_refresh_tokens_table()
+    conn = get_conn()
+    try:
+        with conn.cursor() as c:
+            c.execute(
+                "SELECT id, user_id, family_id, expires_at, revoked, rotated_at FROM refresh_tokens"
+                " WHERE token_hash=%s FOR UPDATE",
+                (_refresh_hash(token),),
+            )
+            row = c.fetchone()
+            if not row:
+                conn.commit()
+                return None
+            now = datetime.now(timezone.utc)
+            if row["revoked"] and row["rotated_at"] and \
+                    now - row["rotated_at"].replace(tzinfo=timezone.utc) <= timedelta(seconds=REFRESH_REUSE_GRACE_SEC):
+                c.execute(
+                    "SELECT 1 FROM refresh_tokens WHERE family_id=%s AND revoked=0 LIMIT 1 FOR UPDATE",
+                    (row["family_id"],),
+                )
+                activa = c.fetchone() is not None
+                nuevo = _insert_refresh_token(c, row["user_id"], row["family_id"]) if activa else None
+                conn.commit()
+                return {"user_id": row["user_id"], "refresh_token": nuevo} if nuevo else None
+            if row["revoked"]:
+                c.execute("UPDATE refresh_tokens SET revoked=1 WHERE family_id=%s AND revoked=0", (row["family_id"],))
+                conn.commit()
+                return None
+            expires = row["expires_at"].replace(tzinfo=timezone.utc)
+            if now > expires:
+                conn.commit()
+                return None
+            c.execute(
+                "UPDATE refresh_tokens SET revoked=1, rotated_at=%s WHERE id=%s",
+                (now.strftime('%Y-%m-%d %H:%M:%S'), row["id"]),
+            )
+            nuevo = _insert_refresh_token(c, row["user_id"], row["family_id"])
+        conn.commit()
+        return {"user_id": row["user_id"], "refresh_token": nuevo}
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+
+def revoke_refresh_token(token: str) -> None:
+    """Cierra la sesión del token (toda su familia de rotaciones)."""
+    ensure_refresh_tokens_table()
+    conn = get_conn()
+    try:
+        with conn.cursor() as c:
+            c.execute(
+                "UPDATE refresh_tokens r JOIN refresh_tokens t ON t.family_id=r.family_id "
+                "SET r.revoked=1 WHERE t.token_hash=%s AND r.revoked=0",
+                (_refresh_hash(token),),
+            )
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def build_reset_email(to_email: str, to_name: str, token: str) -> EmailMessage:
+    """Construye el email con el enlace de reseteo."""
     reset_link = f"{FRONTEND_URL}/reset-password?token={token}"
     msg = EmailMessage()
     msg["Subject"] = "Restablece tu contraseña en Tienda"
@@ -373,11 +785,28 @@ def send_reset_email(to_email: str, to_name: str, token: str) -> bool:
     msg["To"] = to_email
     body = f"Hola {to_name or ''},\n\nPara restablecer tu contraseña haz clic en el siguiente enlace: {reset_link}\n\nSi no solicitaste este cambio, ignora este email.\n\nGracias,\nEquipo Tienda"
     msg.set_content(body)
-    try:
-        s = smtplib.SMTP(SMTP_HOST, SMTP_PORT, timeout=10)
+    return msg
+
+
+def smtp_connect(host: str = "", port: int = 0, timeout: float = 10) -> smtplib.SMTP:
+    """Abre una sesión SMTP (STARTTLS y login según configuración)."""
+    s = smtplib.SMTP(host or SMTP_HOST, port or SMTP_PORT, timeout=timeout)
+    if SMTP_STARTTLS:
         s.starttls()
-        if SMTP_USER:
-            s.login(SMTP_USER, SMTP_PASS)
+    if SMTP_USER:
+        s.login(SMTP_USER, SMTP_PASS)
+    return s
+
+
+def send_reset_email(to_email: str, to_name: str, token: str) -> bool:
+    """Enviar email con enlace de reseteo. Requiere variables SMTP configuradas en env.
+    Retorna True si se envió, False en caso de error o si SMTP no está configurado.
+    """
+    if not SMTP_HOST or not SMTP_PORT:
+        return False
+    msg = build_reset_email(to_email, to_name, token)
+    try:
+        s = smtp_connect()
         s.send_message(msg)
         s.quit()
         return True
@@ -388,18 +817,10 @@ def send_reset_email(to_email: str, to_name: str, token: str) -> bool:
 def write_pending_token(to_email: str, token: str) -> bool:
     """Guardar token en CSV en el repo `docs/db/` para envío manual por un operador.
     Este archivo se crea con nombre `pending_reset_tokens_YYYYMMDD.csv` y se append.
+    La escritura es diferida: ver `app/pending_tokens.py` (buffer, flock y fsync por lote).
     """
     try:
-        from pathlib import Path
-        import csv
-        date = datetime.now(timezone.utc).strftime('%Y%m%d')
-        outdir = Path(__file__).resolve().parent.parent / 'docs' / 'db'
-        outdir.mkdir(parents=True, exist_ok=True)
-        fname = outdir / f'pending_reset_tokens_{date}.csv'
-        # token no se guarda en claro en BD, aquí queda como último recurso para operador
-        with open(fname, 'a', newline='') as fh:
-            writer = csv.writer(fh)
-            writer.writerow([datetime.now(timezone.utc).isoformat(), to_email, token])
+        pending_tokens.append(to_email, token)
         return True
     except Exception:
         return False
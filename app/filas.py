@@ -0,0 +1,64 @@
+"""Lectura de filas con pocas asignaciones para las consultas calientes.
+
+Las conexiones usan DictCursor (un dict por fila) y así sigue todo lo demás.
+Las consultas calientes piden un cursor de tuplas con `tuplas(conn)` (opt-in
+por consulta, sin tocar `_create_raw_conn`) y consumen las filas:
+
+- desempaquetando por posición (`for pid, f, n in rows`), sin objeto intermedio;
+- como listas por columna (`por_columnas`, un `zip` en C), p. ej. para NumPy;
+- serializándolas directo a JSON con `ObjetoJSON`, sin dict ni modelo pydantic
+  por fila: mismas claves, orden y formato que el JSONResponse de FastAPI.
+"""
+import json
+from typing import Any, Callable, List, Sequence, Tuple
+
+from pymysql.cursors import Cursor
+
+# El de C (el mismo que usa json.dumps con ensure_ascii=False)
+_str = json.encoder.encode_basestring
+
+
+def tuplas(conn):
+    """Cursor que devuelve tuplas en el orden del SELECT."""
+    return conn.cursor(Cursor)
+
+
+def por_columnas(rows: Sequence[tuple], n: int) -> List[tuple]:
+    """Filas -> una tupla por columna (n = nº de columnas, por si no hay filas)."""
+    return list(zip(*rows)) if rows else [()] * n
+
+
+def json_str(v: Any) -> str:
+    return "null" if v is None else _str(v if isinstance(v, str) else str(v))
+
+
+def json_int(v: Any) -> str:
+    return "null" if v is None else int.__repr__(int(v))
+
+
+def json_float(v: Any) -> str:
+    # Decimal -> float como haría el modelo (precio: float) antes de serializar
+    return "null" if v is None else float.__repr__(float(v))
+
+
+class ObjetoJSON:
+    """Serializa tuplas como objetos JSON de claves fijas.
+
+    Los prefijos `{"id":` / `,"nombre":` se arman una vez; por fila solo se
+    convierte cada valor y se concatena.
+    """
+
+    __slots__ = ("_campos",)
+
+    def __init__(self, campos: Sequence[Tuple[str, Callable[[Any], str]]]):
+        pares = []
+        for i, (nombre, conv) in enumerate(campos):
+            pares.append((("{" if i == 0 else ",") + _str(nombre) + ":", conv))
+        self._campos = tuple(pares)
+
+    def fila(self, row: Sequence[Any]) -> str:
+        return "".join([p + conv(v) for (p, conv), v in zip(self._campos, row)]) + "}"
+
+    def filas(self, rows: Sequence[Sequence[Any]]) -> str:
+        fila = self.fila
+        return "[" + ",".join([fila(r) for r in rows]) + "]"
@@ -30,18 +30,81 @@ export async function initApiBase() {
 }
 
 // ===== Auth (token en localStorage) =====
-let AUTH = { token: null, exp: null, user: null };
+// token/exp: access token (JWT corto); refresh/refreshExp: refresh token rotativo
+let AUTH = { token: null, exp: null, user: null, refresh: null, refreshExp: null };
 
 export function loadAuth() {
   try {
     const raw = localStorage.getItem('auth');
     AUTH = raw ? JSON.parse(raw) : { token:null, exp:null, user:null };
-    // exp opcional: si está vencido, limpiar
-    if (AUTH?.exp && Date.now() > Number(AUTH.exp)) clearAuth();
+    // Sesión vencida solo si tampoco se puede renovar
+    const refreshable = AUTH?.refresh && (!AUTH.refreshExp || Date.now() < Number(AUTH.refreshExp));
+    if (AUTH?.exp && Date.now() > Number(AUTH.exp) && !refreshable) clearAuth();
   } catch { AUTH = { token:null, exp:null, user:null }; }
   return AUTH;
 }
 
+// Guarda la respuesta de /login o /token/refresh
+export function saveTokens(res) {
+  const now = Date.now();
+  return saveAuth({
+    token: res.access_token,
+    exp: res.expires_in ? now + Number(res.expires_in) * 1000 : null,
+    refresh: res.refresh_token || null,
+    refreshExp: res.refresh_expires_in ? now + Number(res.refresh_expires_in) * 1000 : null,
+  });
+}
+
+// Otra pestaña pudo rotar el refresh token: presentar el viejo sería un reuso
+// y el servidor revocaría toda la sesión. Adopta lo guardado si es distinto.
+function syncAuthFromStorage() {
+  try {
+    const stored = JSON.parse(localStorage.getItem('auth') || 'null');
+    if (stored?.refresh && stored.refresh !== AUTH?.refresh) AUTH = { ...AUTH, ...stored };
+  } catch { /* se sigue con lo que hay en memoria */ }
+}
+
+function accessVigente() {
+  return AUTH?.token && AUTH.exp && Date.now() < Number(AUTH.exp) - REFRESH_SKEW_MS;
+}
+
+// Una sola renovación en vuelo: las peticiones concurrentes esperan la misma
+let refreshing = null;
+async function refreshAccess() {
+  const tokenAntes = AUTH?.token;
+  syncAuthFromStorage();
+  if (!AUTH?.refresh) return false;
+  // la otra pestaña ya dejó un access token nuevo y vigente: no hace falta renovar
+  if (AUTH.token !== tokenAntes && accessVigente()) return true;
+  if (!refreshing) {
+    refreshing = (async () => {
+      try {
+        const enviado = AUTH.refresh;
+        const r = await fetch(`${API_BASE}/token/refresh`, {
+          method: 'POST',
+          headers: { 'Content-Type': 'application/json' },
+          body: JSON.stringify({ refresh_token: enviado }),
+        });
+        if (r.status === 401 || r.status === 403) {
+          // rotado por otra pestaña mientras tanto: usar el suyo en vez de cerrar sesión
+          syncAuthFromStorage();
+          if (AUTH?.refresh && AUTH.refresh !== enviado) return true;
+          clearAuth();
+          return false;
+        }
+        if (!r.ok) return false; // 5xx: se conserva la sesión y se reintenta más tarde
+        saveTokens(await r.json());
+        return true;
+      } catch { return false; }
+      finally { refreshing = null; }
+    })();
+  }
+  return refreshing;
+}
+
+// Margen para renovar antes de que el JWT venza en vuelo
+const REFRESH_SKEW_MS = 30000;
+
 export function saveAuth(data) {
   AUTH = { ...AUTH, ...data };
   localStorage.setItem('auth', JSON.stringify(AUTH));
@@ -84,14 +147,20 @@ async function getErrMsg(r) {
 }
 
 export async function fetchJSON(url, opts = {}, retries = 2) {
+  const authed = needsAuthHeader(url) && AUTH?.refresh;
+  if (authed && AUTH.exp && Date.now() > Number(AUTH.exp) - REFRESH_SKEW_MS) await refreshAccess();
   const ctrl = new AbortController();
   const t = setTimeout(() => ctrl.abort(), 12000);
   try {
-    const r = await fetch(url, {
+    let r = await fetch(url, {
       ...opts,
       headers: buildHeaders(url, opts.headers),
       signal: ctrl.signal,
     });
+    // JWT rechazado (revocado/vencido por reloj): renovar una vez y repetir
+    if (r.status === 401 && authed && await refreshAccess()) {
+      r = await fetch(url, { ...opts, headers: buildHeaders(url, opts.headers), signal: ctrl.signal });
+    }
     if (!r.ok) throw new Error(await getErrMsg(r));
     return r.json();
   } catch (err) {
@@ -113,6 +182,20 @@ export const getProductos = (page = 1, size = 12, q = '', cat = '') => {
   return fetchJSON(`${API_BASE}/productos?${p}`);
 };
 export const getCategorias = () => fetchJSON(`${API_BASE}/categorias`);
+export const getProductosBatch = (ids) =>
+  fetchJSON(`${API_BASE}/productos/batch?${new URLSearchParams({ ids: ids.join(',') })}`);
+
+// Stock/precio en vivo (SSE). El navegador reconecta solo y reenvía Last-Event-ID.
+// onStock recibe [{id, stock, precio}], onResync indica que hay que recargar.
+export const openStockStream = ({ onStock, onResync } = {}) => {
+  if (typeof EventSource === 'undefined') return null;
+  const es = new EventSource(`${API_BASE}/productos/stream`);
+  es.addEventListener('stock', (ev) => {
+    try { onStock?.(JSON.parse(ev.data)); } catch { /* evento malformado: ignorar */ }
+  });
+  es.addEventListener('resync', () => onResync?.());
+  return es;
+};
 
 // Compras
 export const postCheckout = (payload) =>
@@ -122,6 +205,14 @@ export const postCheckout = (payload) =>
     body: JSON.stringify(payload),
   });
 
+// Cotización autoritativa del carrito (precios/stock actuales, despacho y descuento)
+export const postCartQuote = (items) =>
+  fetchJSON(`${API_BASE}/cart/quote`, {
+    method: 'POST',
+    headers: { 'Content-Type': 'application/json' },
+    body: JSON.stringify({ items }),
+  });
+
 export const postCompra = (producto_id, cantidad) =>
   fetchJSON(`${API_BASE}/compras`, {
     method: 'POST',
@@ -145,10 +236,27 @@ export const apiLogin = ({ email, password }) =>
   });
 
 export const apiMe = () => fetchJSON(`${API_BASE}/me`, { method:'GET' });
+export const apiLogout = (refresh_token) =>
+  fetchJSON(`${API_BASE}/logout`, {
+    method: 'POST',
+    headers: { 'Content-Type': 'application/json' },
+    body: JSON.stringify({ refresh_token }),
+  }, 0);
 
 // ===== Admin (ejemplos; usarán Authorization automáticamente) =====
 export const getVentasResumen = () => fetchJSON(`${API_BASE}/admin/ventas/resumen`);
 export const getVentasSerie = () => fetchJSON(`${API_BASE}/admin/ventas/serie`);
+export const getVentasTop = (k = 10, por = 'unidades', fecha = '', categoria = '') => {
+  const p = new URLSearchParams({ k, por });
+  if (fecha) p.set('fecha', fecha);
+  if (categoria) p.set('categoria', categoria);
+  return fetchJSON(`${API_BASE}/admin/ventas/top?${p}`);
+};
+export const getVentasCategorias = (por = 'unidades', fecha = '') => {
+  const p = new URLSearchParams({ por });
+  if (fecha) p.set('fecha', fecha);
+  return fetchJSON(`${API_BASE}/admin/ventas/categorias?${p}`);
+};
 export const getVentasCSV = () => fetchJSON(`${API_BASE}/admin/ventas.csv`);
 
 // Explicit named exports to satisfy bundlers that may not detect all hoisted exports
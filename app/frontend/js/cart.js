@@ -21,3 +21,30 @@ export const totals = ()=>{
   const total = Math.max(0, subtotal + ship - disc);
   return {subtotal, ship, disc, total};
 };
+// Deltas en vivo (/productos/stream): ajusta stock/precio y recorta cantidades.
+// Devuelve true si cambió algo del carrito.
+export const applyStock = (deltas)=>{
+  let changed = false;
+  for(const d of deltas||[]){
+    const it = carrito.find(i=>i.id===d.id); if(!it) continue;
+    it.stock = d.stock;
+    if(d.precio != null) it.precio = d.precio;
+    if(it.cant > it.stock) it.cant = Math.max(1, it.stock);
+    changed = true;
+  }
+  if(changed) save();
+  return changed;
+};
+// Aplica una cotización del servidor (/cart/quote): precios y stock actuales.
+// Devuelve las líneas que ya no se pueden comprar tal cual.
+export const applyQuote = (quote)=>{
+  const problems = [];
+  for(const line of quote.items||[]){
+    const it = carrito.find(i=>i.id===line.producto_id); if(!it) continue;
+    if(!line.existe){ problems.push({...line, nombre: it.nombre}); continue; }
+    it.precio = line.precio_unit; it.stock = line.stock;
+    if(!line.disponible) problems.push(line);
+  }
+  save();
+  return problems;
+};
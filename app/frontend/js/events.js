@@ -3,11 +3,12 @@
 // app/frontend/js/events.js
 // Listeners y flujo principal del frontend (sin frameworks)
 import {
-  initApiBase, getCategorias, getProductos, postCheckout, postCompra, API_BASE,
-  apiLogin, apiRegister, apiMe, loadAuth, saveAuth, clearAuth
+  initApiBase, getCategorias, getProductos, getProductosBatch, postCheckout, postCompra, postCartQuote, API_BASE,
+  openStockStream,
+  apiLogin, apiRegister, apiMe, apiLogout, loadAuth, saveAuth, saveTokens, clearAuth
 } from './api.js';
-import { renderGrid, renderCart, byId, alerta, fmt, showLoading, hideLoading, updateListFooter } from './ui.js';
-import { carrito, addItem, removeItem, changeQty, clearCart, totals } from './cart.js';
+import { renderGrid, renderCart, byId, alerta, fmt, showLoading, hideLoading, updateListFooter, applyStockToGrid } from './ui.js';
+import { carrito, addItem, removeItem, changeQty, clearCart, totals, applyQuote, applyStock } from './cart.js';
 
 /* Estado de la lista/paginación */
 let state = {
@@ -129,6 +130,29 @@ async function boot(){
   }
 
   await reloadProducts();
+  startStockStream();
+}
+
+// Stock en vivo: las compras de otros clientes llegan por SSE sin volver a pedir /productos
+function startStockStream(){
+  openStockStream({
+    onStock: (deltas)=>{
+      applyStockToGrid(deltas);
+      if(applyStock(deltas)) renderCart();
+    },
+    // nos quedamos atrás (reconexión o cliente lento): releer lo visible en una llamada
+    onResync: async ()=>{
+      const ids = [...document.querySelectorAll('.card[data-id]')].map(c=>Number(c.dataset.id));
+      for(const it of carrito) if(!ids.includes(it.id)) ids.push(it.id);
+      if(!ids.length) return;
+      try{
+        const r = await getProductosBatch(ids.slice(0, 100));
+        const deltas = (r.items||[]).map(p=>({ id:p.id, stock:p.stock, precio:p.precio }));
+        applyStockToGrid(deltas);
+        if(applyStock(deltas)) renderCart();
+      }catch{ /* sin conexión: el próximo evento lo corrige */ }
+    },
+  });
 }
 
 function renderSession(){
@@ -163,9 +187,8 @@ async function doLogin(){
   }
 
   try{
-    const res = await apiLogin({ email, password }); // { access_token, token_type, expires_in? }
-    const exp = res?.expires_in ? Date.now() + Number(res.expires_in)*1000 : null;
-    saveAuth({ token: res.access_token, exp });
+    const res = await apiLogin({ email, password }); // { access_token, expires_in, refresh_token, refresh_expires_in }
+    saveTokens(res);
 
     const me = await apiMe(); // carga perfil + rol
     saveAuth({ user: me });
@@ -201,6 +224,9 @@ async function doRegister(){
 }
 
 function doLogout(silent=false){
+  // revocar la sesión en el servidor (best effort; el JWT vence solo)
+  const refresh = loadAuth()?.refresh;
+  if(refresh && !silent) apiLogout(refresh).catch(()=>{});
   clearAuth();
   renderSession();
   if(!silent) alerta('Sesión cerrada');
@@ -309,23 +335,43 @@ function openSummary(){
     empty.style.display=''; content.style.display='none';
   }else{
     empty.style.display='none'; content.style.display='';
-    const {subtotal, ship, disc, total} = totals();
-    box.innerHTML = `
-      <h4>Detalle</h4>
-      ${carrito.map(i=>`<div class="rline"><span>${i.nombre} × ${i.cant}</span><strong>${fmt(i.precio*i.cant)}</strong></div>`).join('')}
-      <hr style="border:none;border-top:1px dashed #e5e7eb;margin:8px 0"/>
-      <div class="rline"><span>Subtotal</span><strong>${fmt(subtotal)}</strong></div>
-      <div class="rline"><span>Despacho (estimado)</span><strong>${fmt(ship)}</strong></div>
-      <div class="rline"><span>Descuentos</span><strong>${disc?('− '+fmt(disc)):fmt(0)}</strong></div>
-      <div class="rline"><span>Total</span><strong>${fmt(total)}</strong></div>
-    `;
+    renderReceipt(box, totals());
     const mem = JSON.parse(localStorage.getItem('cliente')||'{}');
     byId('inpNombre').value = mem?.nombre || '';
     byId('inpEmail').value  = mem?.email  || '';
+    revalidateCart(box, err);
   }
   openOverlay('ovSummary');
 }
 
+function renderReceipt(box, {subtotal, ship, disc, total}){
+  box.innerHTML = `
+    <h4>Detalle</h4>
+    ${carrito.map(i=>`<div class="rline"><span>${i.nombre} × ${i.cant}</span><strong>${fmt(i.precio*i.cant)}</strong></div>`).join('')}
+    <hr style="border:none;border-top:1px dashed #e5e7eb;margin:8px 0"/>
+    <div class="rline"><span>Subtotal</span><strong>${fmt(subtotal)}</strong></div>
+    <div class="rline"><span>Despacho (estimado)</span><strong>${fmt(ship)}</strong></div>
+    <div class="rline"><span>Descuentos</span><strong>${disc?('− '+fmt(disc)):fmt(0)}</strong></div>
+    <div class="rline"><span>Total</span><strong>${fmt(total)}</strong></div>
+  `;
+}
+
+// Revalida precios/stock contra el servidor en una sola llamada (/cart/quote)
+async function revalidateCart(box, err){
+  try{
+    const quote = await postCartQuote(carrito.map(i=>({ producto_id:i.id, cantidad:i.cant })));
+    const problems = applyQuote(quote);
+    renderCart();
+    renderReceipt(box, { subtotal:quote.subtotal, ship:quote.envio, disc:quote.descuento, total:quote.total });
+    if(problems.length){
+      err.textContent = problems.map(p => p.existe
+        ? `${p.nombre}: solo quedan ${p.stock} unidades`
+        : `${p.nombre || ('Producto '+p.producto_id)} ya no está disponible`).join(' · ');
+      err.style.display='';
+    }
+  }catch{ /* sin conexión: se mantiene el cálculo local */ }
+}
+
 async function pay(){
   if(!carrito.length){ alerta('Carrito vacío','err'); return; }
   const err = byId('sumErr'); err.textContent=''; err.style.display='none';
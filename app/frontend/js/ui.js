@@ -82,6 +82,19 @@ export function renderGrid(items, {append=false} = {}){
   else cont.innerHTML = html;
 }
 
+/* Aplica deltas de stock/precio a las tarjetas ya renderizadas */
+export function applyStockToGrid(deltas){
+  for(const d of deltas||[]){
+    const card = document.querySelector(`.card[data-id="${Number(d.id)}"]`);
+    if(!card) continue;
+    card.dataset.stock = d.stock;
+    const st = card.querySelector('.stock');
+    if(st) st.textContent = d.stock > 0 ? `Stock: ${d.stock}` : 'Sin stock';
+    const pr = card.querySelector('.price');
+    if(pr && d.precio != null) pr.textContent = fmt(d.precio);
+  }
+}
+
 /* === Carrito (aside) === */
 export function renderCart(){
   const c = byId('cart');
@@ -0,0 +1,286 @@
+import os
+import queue
+import threading
+import time
+import logging
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+from .db import (get_conn, apply_statement_budget, db_timeout_status, statement_budget,
+                 DBIntegrityError, DBOperationalError, DBProgrammingError)
+from .metrics import incr, record_sample
+from .outbox import emit_many
+
+logger = logging.getLogger("tienda-api")
+
+# Ventana máxima (ms) que espera el escritor para agrupar compras concurrentes
+# en una sola transacción (un solo COMMIT/fsync en VM2).
+GROUP_COMMIT_MAX_DELAY_MS = float(os.getenv("GROUP_COMMIT_MAX_DELAY_MS", "5"))
+GROUP_COMMIT_MAX_BATCH = int(os.getenv("GROUP_COMMIT_MAX_BATCH", "64"))
+# Segundos que una petición espera la confirmación de su compra
+GROUP_COMMIT_WAIT_SEC = float(os.getenv("GROUP_COMMIT_WAIT_SEC", "10"))
+
+_LOCK_WAIT_TIMEOUT = 1205  # solo se deshace la sentencia: se reintenta el trabajo
+_DEADLOCK = 1213  # InnoDB deshace toda la transacción: se reintenta el lote
+
+
+# ----------------------------
+# Errores de negocio por compra
+# ----------------------------
+class CompraRechazada(Exception):
+    """Compra rechazada por reglas de negocio; solo afecta a su propio trabajo."""
+    def __init__(self, producto_id: int):
+        super().__init__(producto_id)
+        self.producto_id = producto_id
+
+
+class ProductoNoEncontrado(CompraRechazada):
+    pass
+
+
+class StockInsuficiente(CompraRechazada):
+    pass
+
+
+class CompraSinConfirmar(Exception):
+    """El escritor no confirmó la compra en GROUP_COMMIT_WAIT_SEC.
+
+    `en_curso=False`: seguía en cola y se retiró sin aplicarse (se puede reintentar).
+    `en_curso=True`: ya se estaba aplicando y puede haberse confirmado.
+    """
+    def __init__(self, en_curso: bool):
+        super().__init__(en_curso)
+        self.en_curso = en_curso
+
+
+def _codigo(e: BaseException) -> Optional[int]:
+    return e.args[0] if getattr(e, "args", None) else None
+
+
+class _Job:
+    __slots__ = ("items", "future", "budget")
+
+    def __init__(self, items: Sequence[Tuple[int, int]], future: Future, budget: Optional[float]):
+        self.items = items
+        self.future = future
+        # presupuesto SQL de la petición que la encoló (DB_BUDGET_CHECKOUT_SEC)
+        self.budget = budget
+
+
+class GroupCommitWriter:
+    """Escritor write-behind para `compras`.
+
+    Un único hilo de fondo toma trabajos de la cola, espera como máximo
+    `max_delay_ms` a que lleguen más y aplica todo el lote en una transacción.
+    Cada trabajo corre dentro de su propio SAVEPOINT: si falla (producto
+    inexistente, stock insuficiente) solo se deshace ese trabajo y el resto
+    del lote se confirma con un único COMMIT.
+
+    La fecha de la compra es la del reloj de la BD (un `SELECT NOW()` por lote,
+    el mismo que usaría el DEFAULT de la columna) y se inserta explícitamente,
+    de modo que la respuesta no necesita releer la fila tras el commit.
+
+    Un lock wait timeout deshace solo la sentencia: se vuelve al SAVEPOINT y se
+    reintenta ese trabajo una vez. Un deadlock deshace toda la transacción: se
+    reintenta el lote completo una vez.
+
+    El hilo escritor no hereda el presupuesto SQL de la petición (ContextVar):
+    `submit` lo captura y se aplica a las sentencias de cada trabajo. Si una
+    sentencia lo agota, el servidor la cancela y solo se deshace ese trabajo.
+    """
+
+    def __init__(self, max_delay_ms: float = GROUP_COMMIT_MAX_DELAY_MS, max_batch: int = GROUP_COMMIT_MAX_BATCH):
+        self.max_delay = max(0.0, max_delay_ms) / 1000.0
+        self.max_batch = max(1, max_batch)
+        self._q: "queue.Queue[Optional[_Job]]" = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._listeners: List[Callable[[List[Dict[str, Any]]], None]] = []
+
+    # -- API pública --
+    def add_listener(self, fn: Callable[[List[Dict[str, Any]]], None]) -> None:
+        """Registra una función que recibe las filas de `compras` de cada lote
+        confirmado (se llama en el hilo escritor, tras el COMMIT)."""
+        self._listeners.append(fn)
+
+    def submit(self, items: Sequence[Tuple[int, int]]) -> Future:
+        """Encola una compra (lista de (producto_id, cantidad)) y devuelve un Future
+        que se resuelve con la lista de filas insertadas o con la excepción."""
+        self._ensure_started()
+        fut: Future = Future()
+        self._q.put(_Job(list(items), fut, statement_budget()))
+        return fut
+
+    def stop(self, timeout: float = 5.0) -> None:
+        """Vacía la cola pendiente y detiene el hilo escritor."""
+        with self._lock:
+            t = self._thread
+            if t is None:
+                return
+            self._q.put(None)
+        t.join(timeout)
+        with self._lock:
+            self._thread = None
+
+    def pending(self) -> int:
+        return self._q.qsize()
+
+    # -- Internos --
+    def _ensure_started(self) -> None:
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="group-commit", daemon=True)
+                self._thread.start()
+
+    def _run(self) -> None:
+        stopping = False
+        while not stopping:
+            first = self._q.get()
+            if first is None:
+                break
+            batch = [first]
+            deadline = time.monotonic() + self.max_delay
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                try:
+                    job = self._q.get(timeout=remaining) if remaining > 0 else self._q.get_nowait()
+                except queue.Empty:
+                    break
+                if job is None:
+                    stopping = True
+                    break
+                batch.append(job)
+            self._flush(batch)
+
+    def _flush(self, batch: List[_Job]) -> None:
+        # las que la petición ya retiró por timeout (Future cancelado) no se aplican
+        batch = [job for job in batch if job.future.set_running_or_notify_cancel()]
+        if not batch:
+            return
+        start = time.perf_counter()
+        try:
+            conn = get_conn()
+        except Exception as e:
+            for job in batch:
+                job.future.set_exception(e)
+            return
+
+        try:
+            for intento in range(2):
+                try:
+                    results = self._transaction(conn, batch)
+                    break
+                except Exception as e:
+                    try:
+                        conn.rollback()
+                    except Exception:
+                        pass
+                    if intento == 0 and _codigo(e) == _DEADLOCK:
+                        incr("group_commit.batch_retries")
+                        logger.warning("Group commit: deadlock, se reintenta el lote (%d trabajos)", len(batch))
+                        continue
+                    logger.exception("Group commit: fallo del lote (%d trabajos)", len(batch))
+                    for job in batch:
+                        job.future.set_exception(e)
+                    return
+        finally:
+            conn.close()
+
+        flush_ms = (time.perf_counter() - start) * 1000.0
+        record_sample("group_commit.batch_size", float(len(batch)))
+        record_sample("group_commit.flush_ms", flush_ms)
+        incr("group_commit.batches")
+        incr("group_commit.jobs", len(batch))
+
+        committed: List[Dict[str, Any]] = []
+        for job, rows, err in results:
+            if err is not None:
+                job.future.set_exception(err)
+            else:
+                job.future.set_result(rows)
+                committed.extend(rows)
+        if committed:
+            for fn in list(self._listeners):
+                try:
+                    fn(committed)
+                except Exception:
+                    logger.exception("Group commit: error en listener post-commit")
+
+    def _transaction(self, conn, batch: List[_Job]) -> List[Tuple[_Job, Optional[List[Dict[str, Any]]], Optional[BaseException]]]:
+        results: List[Tuple[_Job, Optional[List[Dict[str, Any]]], Optional[BaseException]]] = []
+        with conn.cursor() as c:
+            c.execute("SELECT NOW() AS ahora")
+            fecha = c.fetchone()["ahora"]
+            for job in batch:
+                apply_statement_budget(conn, job.budget)
+                for intento in range(2):
+                    rows, err = self._job(c, job, fecha)
+                    if err is None or intento or _codigo(err) != _LOCK_WAIT_TIMEOUT:
+                        break
+                    incr("group_commit.job_retries")
+                results.append((job, rows, err))
+        conn.commit()
+        return results
+
+    def _job(self, c, job: _Job, fecha: datetime) -> Tuple[Optional[List[Dict[str, Any]]], Optional[BaseException]]:
+        """Aplica un trabajo en su SAVEPOINT; (filas, None) o (None, error que solo afecta a ese trabajo)."""
+        c.execute("SAVEPOINT gc_job")
+        try:
+            return self._apply(c, job.items, fecha), None
+        except (CompraRechazada, DBIntegrityError, DBProgrammingError) as e:
+            err: BaseException = e
+        except DBOperationalError as e:
+            # cancelada por presupuesto o por espera de lock: solo se deshizo la sentencia
+            if db_timeout_status(e) != 503 and _codigo(e) != _LOCK_WAIT_TIMEOUT:
+                raise
+            err = e
+        c.execute("ROLLBACK TO SAVEPOINT gc_job")
+        return None, err
+
+    @staticmethod
+    def _apply(c, items: Sequence[Tuple[int, int]], fecha: datetime) -> List[Dict[str, Any]]:
+        rows: List[Dict[str, Any]] = []
+        for producto_id, cantidad in items:
+            c.execute("SELECT id, stock, precio FROM productos WHERE id=%s FOR UPDATE", (producto_id,))
+            prod = c.fetchone()
+            if not prod:
+                raise ProductoNoEncontrado(producto_id)
+            if prod["stock"] < cantidad:
+                raise StockInsuficiente(producto_id)
+            c.execute("UPDATE productos SET stock=stock-%s WHERE id=%s", (cantidad, producto_id))
+            c.execute(
+                "INSERT INTO compras (producto_id, cantidad, fecha) VALUES (%s,%s,%s)",
+                (producto_id, cantidad, fecha),
+            )
+            rows.append({
+                "id": c.lastrowid,
+                "producto_id": producto_id,
+                "cantidad": cantidad,
+                "fecha": fecha,
+                "precio": float(prod["precio"]),
+                # stock tras esta compra (los listeners lo difunden, ver stream.py)
+                "stock": prod["stock"] - cantidad,
+            })
+        # Dentro del SAVEPOINT del trabajo: si se deshace, sus eventos también
+        emit_many(c, [("compra", r["producto_id"], r) for r in rows])
+        return rows
+
+
+# Instancia compartida por el proceso (un escritor por worker de uvicorn)
+writer = GroupCommitWriter()
+
+
+def registrar_compras(items: Sequence[Tuple[int, int]]) -> List[Dict[str, Any]]:
+    """Registra una compra (uno o varios ítems) vía group commit y espera el resultado.
+
+    Si no se confirma en GROUP_COMMIT_WAIT_SEC lanza CompraSinConfirmar.
+    """
+    fut = writer.submit(items)
+    try:
+        return fut.result(timeout=GROUP_COMMIT_WAIT_SEC)
+    except FutureTimeout:
+        incr("group_commit.timeouts")
+        raise CompraSinConfirmar(en_curso=not fut.cancel()) from None
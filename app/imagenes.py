@@ -0,0 +1,235 @@
+"""Variantes de imágenes de productos (WebP/JPEG a anchos estándar) para srcset.
+
+Se ejecuta offline (ver scripts/image_variants.py): lee `productos.imagen_url`,
+genera las variantes en paralelo con un pool de procesos y escribe
+`imagen_srcset`, `imagen_width` e `imagen_height` en lotes. Los archivos llevan
+el hash del original en el nombre y un manifiesto guarda el último hash por
+producto, así que las imágenes que no cambiaron no se reprocesan.
+
+Pillow es opcional (solo lo necesita esta herramienta).
+"""
+import os
+import io
+import json
+import hashlib
+import urllib.request
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+from .db import get_conn, schema_has
+from .cache import cache
+
+IMAGES_SRC_DIR = os.getenv("IMAGES_SRC_DIR", str(Path(__file__).resolve().parent / "frontend"))
+IMAGES_OUT_DIR = os.getenv("IMAGES_OUT_DIR", str(Path(__file__).resolve().parent / "frontend" / "img" / "variants"))
+IMAGES_URL_PREFIX = os.getenv("IMAGES_URL_PREFIX", "/app/img/variants")
+IMAGES_WIDTHS = [int(w) for w in os.getenv("IMAGES_WIDTHS", "320,640,960,1280").split(",") if w.strip()]
+IMAGES_FORMATS = [f.strip() for f in os.getenv("IMAGES_FORMATS", "webp,jpeg").split(",") if f.strip()]
+IMAGES_QUALITY = int(os.getenv("IMAGES_QUALITY", "80"))
+# Filas por UPDATE (una transacción por lote)
+IMAGES_UPDATE_BATCH = 200
+
+_EXT = {"webp": "webp", "jpeg": "jpg"}
+_MANIFEST = "manifest.json"
+
+Progress = Callable[[str], None]
+
+
+def pillow_disponible() -> bool:
+    try:
+        import PIL  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def anchos_variantes(ancho_original: int, anchos: Sequence[int] = IMAGES_WIDTHS) -> List[int]:
+    """Anchos estándar menores que el original, más el original si es más chico que el mayor estándar.
+    Nunca se amplía la imagen."""
+    out = sorted({w for w in anchos if w < ancho_original})
+    if not out or (ancho_original < max(anchos) and ancho_original not in out):
+        out.append(ancho_original)
+    return out
+
+
+def _leer_origen(url: str, src_dir: str) -> bytes:
+    if url.startswith(("http://", "https://")):
+        with urllib.request.urlopen(url, timeout=20) as r:
+            return r.read()
+    # rutas públicas del frontend (/app/img/x.jpg) o relativas a IMAGES_SRC_DIR
+    rel = url.split("?", 1)[0]
+    if rel.startswith("/app/"):
+        rel = rel[len("/app/"):]
+    path = (Path(src_dir) / rel.lstrip("/")).resolve()
+    if Path(src_dir).resolve() not in path.parents:
+        raise ValueError(f"ruta fuera de IMAGES_SRC_DIR: {url}")
+    return path.read_bytes()
+
+
+def procesar(job: Dict[str, Any]) -> Dict[str, Any]:
+    """Genera las variantes de un producto. Corre en un proceso del pool."""
+    from PIL import Image, ImageOps
+
+    pid = job["id"]
+    try:
+        data = _leer_origen(job["url"], job["src_dir"])
+    except Exception as e:
+        return {"id": pid, "error": f"no se pudo leer {job['url']}: {e}"}
+    digest = hashlib.sha256(data).hexdigest()
+    if digest == job.get("hash_previo") and job.get("srcset_previo"):
+        return {"id": pid, "hash": digest, "sin_cambios": True}
+    if job.get("dry_run"):
+        return {"id": pid, "hash": digest, "dry_run": True}
+
+    try:
+        img = ImageOps.exif_transpose(Image.open(io.BytesIO(data)))
+        if img.mode not in ("RGB", "RGBA"):
+            img = img.convert("RGBA" if "transparency" in img.info else "RGB")
+        ancho, alto = img.size
+        out_dir = Path(job["out_dir"])
+        out_dir.mkdir(parents=True, exist_ok=True)
+        srcset = []
+        w = h = 0
+        for w in anchos_variantes(ancho, job["widths"]):
+            h = max(1, round(alto * w / ancho))
+            var = img if w == ancho else img.resize((w, h), Image.LANCZOS)
+            for fmt in job["formats"]:
+                name = f"{pid}-{digest[:12]}-{w}.{_EXT[fmt]}"
+                dest = out_dir / name
+                if not dest.exists():
+                    tmp = out_dir / f".{name}.tmp"
+                    im = var.convert("RGB") if fmt == "jpeg" and var.mode != "RGB" else var
+                    im.save(tmp, format=fmt.upper(), quality=job["quality"], optimize=True)
+                    os.replace(tmp, dest)
+                # srcset con el primer formato (WebP por defecto); el resto queda de respaldo
+                if fmt == job["formats"][0]:
+                    srcset.append(f"{job['url_prefix'].rstrip('/')}/{name} {w}w")
+    except Exception as e:
+        return {"id": pid, "error": f"imagen inválida {job['url']}: {e}"}
+    # dimensiones de la variante mayor: es lo más grande que se sirve (reserva el alto y evita CLS)
+    return {"id": pid, "hash": digest, "srcset": ", ".join(srcset), "width": w, "height": h}
+
+
+def ensure_columns() -> None:
+    """Crea las columnas de variantes en `productos` si faltan."""
+    faltan = [
+        (col, ddl) for col, ddl in (
+            ("imagen_srcset", "VARCHAR(2048) NULL"),
+            ("imagen_width", "INT NULL"),
+            ("imagen_height", "INT NULL"),
+        ) if not schema_has("productos", col)
+    ]
+    if not faltan:
+        return
+    conn = get_conn()
+    try:
+        with conn.cursor() as c:
+            for col, ddl in faltan:
+                c.execute(f"ALTER TABLE productos ADD COLUMN IF NOT EXISTS {col} {ddl}")
+        conn.commit()
+    finally:
+        conn.close()
+    cache.invalidate("schema")
+
+
+def _guardar(resultados: List[Dict[str, Any]]) -> None:
+    conn = get_conn()
+    try:
+        for i in range(0, len(resultados), IMAGES_UPDATE_BATCH):
+            lote = resultados[i:i + IMAGES_UPDATE_BATCH]
+            with conn.cursor() as c:
+                c.executemany(
+                    "UPDATE productos SET imagen_srcset=%s, imagen_width=%s, imagen_height=%s WHERE id=%s",
+                    [(r["srcset"], r["width"], r["height"], r["id"]) for r in lote],
+                )
+            conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+
+def generar_variantes(
+    ids: Optional[Sequence[int]] = None,
+    jobs: int = 0,
+    force: bool = False,
+    dry_run: bool = False,
+    src_dir: str = IMAGES_SRC_DIR,
+    out_dir: str = IMAGES_OUT_DIR,
+    url_prefix: str = IMAGES_URL_PREFIX,
+    widths: Sequence[int] = IMAGES_WIDTHS,
+    formats: Sequence[str] = IMAGES_FORMATS,
+    progress: Optional[Progress] = print,
+) -> Dict[str, int]:
+    """Procesa las imágenes de los productos (todos o `ids`). Devuelve contadores."""
+    if not pillow_disponible():
+        raise RuntimeError("Pillow no está instalado (pip install Pillow)")
+    for fmt in formats:
+        if fmt not in _EXT:
+            raise ValueError(f"formato no soportado: {fmt}")
+    if not dry_run:
+        ensure_columns()
+
+    sql = "SELECT id, imagen_url FROM productos WHERE imagen_url IS NOT NULL AND imagen_url<>''"
+    args: List[Any] = []
+    if ids:
+        sql += " AND id IN (" + ",".join(["%s"] * len(ids)) + ")"
+        args = list(ids)
+    conn = get_conn(read=True)
+    try:
+        with conn.cursor() as c:
+            c.execute(sql + " ORDER BY id", args)
+            productos = c.fetchall()
+        conn.commit()
+    finally:
+        conn.close()
+
+    manifest_path = Path(out_dir) / _MANIFEST
+    manifest: Dict[str, Any] = {}
+    if manifest_path.exists():
+        manifest = json.loads(manifest_path.read_text())
+    previo = {} if force else manifest
+
+    trabajos = [{
+        "id": p["id"],
+        "url": p["imagen_url"],
+        "src_dir": src_dir,
+        "out_dir": out_dir,
+        "url_prefix": url_prefix,
+        "widths": list(widths),
+        "formats": list(formats),
+        "quality": IMAGES_QUALITY,
+        "dry_run": dry_run,
+        "hash_previo": previo.get(str(p["id"]), {}).get("hash"),
+        "srcset_previo": previo.get(str(p["id"]), {}).get("srcset"),
+    } for p in productos]
+
+    cont = {"total": len(trabajos), "procesadas": 0, "sin_cambios": 0, "errores": 0}
+    cambios: List[Dict[str, Any]] = []
+    with ProcessPoolExecutor(max_workers=jobs or None) as pool:
+        for fut in as_completed([pool.submit(procesar, t) for t in trabajos]):
+            r = fut.result()
+            if "error" in r:
+                cont["errores"] += 1
+                if progress:
+                    progress(f"producto {r['id']}: {r['error']}")
+            elif r.get("sin_cambios"):
+                cont["sin_cambios"] += 1
+            else:
+                cont["procesadas"] += 1
+                if not r.get("dry_run"):
+                    cambios.append(r)
+                    manifest[str(r["id"])] = {"hash": r["hash"], "srcset": r["srcset"]}
+
+    if cambios:
+        _guardar(sorted(cambios, key=lambda r: r["id"]))
+        Path(out_dir).mkdir(parents=True, exist_ok=True)
+        tmp = manifest_path.with_suffix(".tmp")
+        tmp.write_text(json.dumps(manifest, indent=1, sort_keys=True))
+        os.replace(tmp, manifest_path)
+        # workers con tier de disco compartido ven la invalidación; el resto expira por TTL
+        cache.invalidate("catalogo")
+    if progress:
+        progress(f"imágenes: {cont}")
+    return cont
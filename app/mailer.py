@@ -0,0 +1,253 @@
+import os
+import json
+import time
+import sqlite3
+import smtplib
+import threading
+import logging
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from .db import SMTP_HOST, SMTP_PORT, build_reset_email, smtp_connect, write_pending_token
+from .metrics import incr, record_sample
+
+logger = logging.getLogger("tienda-api")
+
+# Cola persistente local (SQLite); el archivo guarda tokens en claro hasta enviarse,
+# por eso se crea con permisos 0600.
+MAIL_QUEUE_PATH = os.getenv(
+    "MAIL_QUEUE_PATH",
+    str(Path(__file__).resolve().parent.parent / "var" / "mail_queue.sqlite3"),
+)
+MAIL_MAX_ATTEMPTS = int(os.getenv("MAIL_MAX_ATTEMPTS", "6"))
+MAIL_BACKOFF_BASE_SEC = float(os.getenv("MAIL_BACKOFF_BASE_SEC", "5"))
+MAIL_BACKOFF_MAX_SEC = float(os.getenv("MAIL_BACKOFF_MAX_SEC", "900"))
+# Segundos sin mensajes tras los que se cierra la sesión SMTP reutilizada
+MAIL_IDLE_SEC = float(os.getenv("MAIL_IDLE_SEC", "30"))
+MAIL_BATCH = 20
+# Tiempo que un worker reserva un mensaje mientras lo envía
+_CLAIM_SEC = 120
+
+
+def smtp_configured() -> bool:
+    return bool(SMTP_HOST and SMTP_PORT)
+
+
+class MailQueue:
+    """Cola de emails salientes persistida en SQLite y despachada en segundo plano.
+
+    - `enqueue_reset` solo inserta la fila y despierta al despachador.
+    - El despachador reserva lotes de filas vencidas (BEGIN IMMEDIATE), de modo
+      que varios workers de uvicorn pueden compartir el archivo sin duplicar envíos.
+    - La sesión SMTP se reutiliza entre mensajes y se cierra tras MAIL_IDLE_SEC.
+    - Los fallos se reintentan con backoff exponencial; agotados los intentos,
+      el token pasa al CSV de pendientes (`write_pending_token`) para el operador.
+    """
+
+    def __init__(self, path: str = MAIL_QUEUE_PATH, smtp_host: str = "", smtp_port: int = 0):
+        self.path = path
+        self.smtp_host = smtp_host
+        self.smtp_port = smtp_port
+        self._db_lock = threading.Lock()
+        self._db: Optional[sqlite3.Connection] = None
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._start_lock = threading.Lock()
+        self._smtp: Optional[smtplib.SMTP] = None
+        self._smtp_last_used = 0.0
+
+    # -- Almacenamiento --
+    def _conn(self) -> sqlite3.Connection:
+        if self._db is None:
+            Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+            os.close(fd)
+            db = sqlite3.connect(self.path, timeout=10, check_same_thread=False, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute(
+                """
+                CREATE TABLE IF NOT EXISTS mail_queue (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    kind TEXT NOT NULL,
+                    payload TEXT NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    next_attempt_at REAL NOT NULL,
+                    claimed_until REAL NOT NULL DEFAULT 0,
+                    created_at REAL NOT NULL,
+                    last_error TEXT
+                )
+                """
+            )
+            db.execute("CREATE INDEX IF NOT EXISTS idx_mail_queue_next ON mail_queue (next_attempt_at)")
+            self._db = db
+        return self._db
+
+    def enqueue_reset(self, to_email: str, to_name: str, token: str) -> int:
+        """Encola un email de reseteo y devuelve su id."""
+        payload = json.dumps({"to_email": to_email, "to_name": to_name or "", "token": token})
+        now = time.time()
+        with self._db_lock:
+            cur = self._conn().execute(
+                "INSERT INTO mail_queue (kind, payload, next_attempt_at, created_at) VALUES (?,?,?,?)",
+                ("password_reset", payload, now, now),
+            )
+            mail_id = cur.lastrowid
+        incr("mail.enqueued")
+        self._ensure_started()
+        self._wake.set()
+        return mail_id
+
+    def depth(self) -> int:
+        with self._db_lock:
+            return self._conn().execute("SELECT COUNT(*) FROM mail_queue").fetchone()[0]
+
+    def _claim(self) -> List[tuple]:
+        now = time.time()
+        with self._db_lock:
+            db = self._conn()
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                rows = db.execute(
+                    "SELECT id, kind, payload, attempts FROM mail_queue "
+                    "WHERE next_attempt_at <= ? AND claimed_until <= ? ORDER BY id LIMIT ?",
+                    (now, now, MAIL_BATCH),
+                ).fetchall()
+                if rows:
+                    db.executemany(
+                        "UPDATE mail_queue SET claimed_until=? WHERE id=?",
+                        [(now + _CLAIM_SEC, r[0]) for r in rows],
+                    )
+                db.execute("COMMIT")
+            except Exception:
+                db.execute("ROLLBACK")
+                raise
+        return rows
+
+    def _next_due_in(self) -> float:
+        with self._db_lock:
+            row = self._conn().execute("SELECT MIN(MAX(next_attempt_at, claimed_until)) FROM mail_queue").fetchone()
+        if not row or row[0] is None:
+            return MAIL_IDLE_SEC
+        return max(0.0, min(MAIL_IDLE_SEC, row[0] - time.time()))
+
+    def _done(self, mail_id: int) -> None:
+        with self._db_lock:
+            self._conn().execute("DELETE FROM mail_queue WHERE id=?", (mail_id,))
+
+    def _retry(self, mail_id: int, attempts: int, error: str) -> None:
+        delay = min(MAIL_BACKOFF_MAX_SEC, MAIL_BACKOFF_BASE_SEC * (2 ** (attempts - 1)))
+        with self._db_lock:
+            self._conn().execute(
+                "UPDATE mail_queue SET attempts=?, next_attempt_at=?, claimed_until=0, last_error=? WHERE id=?",
+                (attempts, time.time() + delay, error[:500], mail_id),
+            )
+
+    # -- SMTP --
+    def _session(self) -> smtplib.SMTP:
+        if self._smtp is not None:
+            try:
+                if self._smtp.noop()[0] == 250:
+                    return self._smtp
+            except Exception:
+                pass
+            self._close_session()
+        self._smtp = smtp_connect(self.smtp_host, self.smtp_port)
+        incr("mail.smtp_connects")
+        return self._smtp
+
+    def _close_session(self) -> None:
+        if self._smtp is None:
+            return
+        try:
+            self._smtp.quit()
+        except Exception:
+            try:
+                self._smtp.close()
+            except Exception:
+                pass
+        self._smtp = None
+
+    def _send(self, kind: str, payload: Dict[str, Any]) -> None:
+        if kind != "password_reset":
+            raise ValueError(f"tipo de email desconocido: {kind}")
+        msg = build_reset_email(payload["to_email"], payload["to_name"], payload["token"])
+        start = time.perf_counter()
+        self._session().send_message(msg)
+        self._smtp_last_used = time.monotonic()
+        record_sample("mail.send_ms", (time.perf_counter() - start) * 1000.0)
+
+    # -- Despachador --
+    def _ensure_started(self) -> None:
+        if self._thread is not None:
+            return
+        with self._start_lock:
+            if self._thread is None:
+                self._stop.clear()
+                self._thread = threading.Thread(target=self._run, name="mail-dispatcher", daemon=True)
+                self._thread.start()
+
+    def start(self) -> None:
+        """Arranca el despachador (p. ej. al iniciar la app, para drenar pendientes)."""
+        self._ensure_started()
+        self._wake.set()
+
+    def stop(self, timeout: float = 5.0) -> None:
+        t = self._thread
+        if t is None:
+            return
+        self._stop.set()
+        self._wake.set()
+        t.join(timeout)
+        self._thread = None
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            # antes de procesar: un set() que llegue durante el lote no se pierde
+            self._wake.clear()
+            try:
+                self.process_once()
+                wait = self._next_due_in()
+            except Exception:
+                logger.exception("Mail: error en el despachador")
+                wait = MAIL_BACKOFF_BASE_SEC
+            if self._smtp is not None and time.monotonic() - self._smtp_last_used > MAIL_IDLE_SEC:
+                self._close_session()
+            self._wake.wait(wait)
+        self._close_session()
+
+    def process_once(self) -> int:
+        """Envía un lote de mensajes vencidos. Devuelve cuántos se enviaron."""
+        sent = 0
+        for mail_id, kind, payload_raw, attempts in self._claim():
+            payload = json.loads(payload_raw)
+            try:
+                self._send(kind, payload)
+            except Exception as e:
+                self._close_session()
+                attempts += 1
+                incr("mail.failures")
+                if attempts >= MAIL_MAX_ATTEMPTS:
+                    logger.error("Mail %s descartado tras %d intentos: %s", mail_id, attempts, e)
+                    if kind == "password_reset":
+                        write_pending_token(payload["to_email"], payload["token"])
+                    incr("mail.dropped")
+                    self._done(mail_id)
+                else:
+                    self._retry(mail_id, attempts, str(e))
+                continue
+            self._done(mail_id)
+            incr("mail.sent")
+            sent += 1
+        return sent
+
+    def stats(self) -> Dict[str, Any]:
+        try:
+            depth = self.depth()
+        except Exception:
+            depth = -1
+        return {"queue_depth": depth, "dispatcher": self._thread is not None}
+
+
+# Instancia compartida del proceso
+mail_queue = MailQueue()
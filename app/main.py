@@ -1,6 +1,5 @@
 import logging
 import time
-from pathlib import Path
 from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
@@ -9,6 +8,16 @@ from fastapi.responses import RedirectResponse, JSONResponse
 from fastapi.exceptions import RequestValidationError
 from swagger_ui_bundle import swagger_ui_path
 from .routes import router as api
+from .group_commit import writer as group_commit_writer
+from .outbox import dispatcher as outbox_dispatcher
+from .db import set_client_key, reset_client_key, set_statement_budget, reset_statement_budget, db_timeout_status, DBError
+from .mailer import mail_queue, smtp_configured
+from .pending_tokens import pending_tokens
+from .admission import admission, clasificar, ADMISSION_ENABLED, DB_BUDGETS
+from .access_log import access_log
+from .breaker import CircuitOpenError, db_breaker
+from .static_assets import frontend_app
+from .profiling import PROFILE_HEADER, profile_allowed, begin_request_profile, end_request_profile
 
 # ============================
 #  Logging básico (VM1)
@@ -54,6 +63,97 @@ async def validation_exception_handler(request: Request, exc: RequestValidationE
         },
     )
 
+# ============================
+#  Errores de BD no capturados en las rutas
+# ============================
+@app.exception_handler(DBError)
+async def db_exception_handler(request: Request, exc: DBError):
+    if isinstance(exc, CircuitOpenError):
+        return JSONResponse(status_code=503, content={"detail": "Base de datos no disponible"},
+                            headers={"Retry-After": str(db_breaker.retry_after())})
+    status = db_timeout_status(exc)
+    if status == 503:
+        logger.warning("Consulta cancelada por presupuesto en %s %s: %s", request.method, request.url.path, exc)
+        return JSONResponse(status_code=503, content={"detail": "La consulta excedió el tiempo máximo"},
+                            headers={"Retry-After": "5"})
+    if status == 504:
+        logger.warning("Timeout de BD en %s %s: %s", request.method, request.url.path, exc)
+        return JSONResponse(status_code=504, content={"detail": "La base de datos no respondió a tiempo"})
+    logger.error("Error de BD en %s %s", request.method, request.url.path, exc_info=exc)
+    return JSONResponse(status_code=500, content={"detail": "Error interno de base de datos"})
+
+# ============================
+#  Perfilado por petición (cabecera X-Debug-Profile, app/profiling.py)
+# ============================
+@app.middleware("http")
+async def request_profiler(request: Request, call_next):
+    client = request.client.host if request.client else "-"
+    if not profile_allowed(client, request.headers.get(PROFILE_HEADER)):
+        return await call_next(request)
+    start = time.time()
+    token = begin_request_profile()
+    if token is None:
+        response = await call_next(request)
+        response.headers["X-Profile-Skipped"] = "busy"
+        return response
+    response = None
+    try:
+        response = await call_next(request)
+        return response
+    finally:
+        pid = end_request_profile(token, request.method, request.url.path, int((time.time() - start) * 1000))
+        if response is not None:
+            response.headers["X-Profile-Id"] = str(pid)
+
+# ============================
+#  Control de admisión (app/admission.py)
+# ============================
+@app.middleware("http")
+async def admission_control(request: Request, call_next):
+    clase = clasificar(request.method, request.url.path)
+    if clase is None:
+        return await call_next(request)
+    # Presupuesto de tiempo de las sentencias SQL de esta petición (app/db.py)
+    budget_token = set_statement_budget(DB_BUDGETS.get(clase))
+    try:
+        if not ADMISSION_ENABLED:
+            return await call_next(request)
+        retry_after = admission.admit(clase)
+        if retry_after is not None:
+            return JSONResponse(
+                status_code=503,
+                content={"detail": "Servicio saturado, reintenta en unos segundos"},
+                headers={"Retry-After": str(retry_after)},
+            )
+        start = time.perf_counter()
+        try:
+            response = await call_next(request)
+        except BaseException:
+            admission.release(clase, (time.perf_counter() - start) * 1000.0)
+            raise
+        # El hueco se libera al terminar de enviar el cuerpo (el CSV es streaming)
+        return _ReleaseOnSend(response, clase, start)
+    finally:
+        reset_statement_budget(budget_token)
+
+
+class _ReleaseOnSend:
+    """Envuelve la respuesta para liberar el hueco de admisión al terminar de enviarla."""
+
+    def __init__(self, response, clase: str, start: float):
+        self.response = response
+        self.clase = clase
+        self.start = start
+
+    def __getattr__(self, item):
+        return getattr(self.response, item)
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await self.response(scope, receive, send)
+        finally:
+            admission.release(self.clase, (time.perf_counter() - self.start) * 1000.0)
+
 # ============================
 #  Middleware de auditoría
 # ============================
@@ -64,20 +164,46 @@ async def access_logger(request: Request, call_next):
     method = request.method
     path = request.url.path
 
+    # Identifica al cliente para el read-your-writes de la réplica (app/db.py)
+    ctx_token = set_client_key(client)
     status_code = 500
     try:
         response = await call_next(request)
         status_code = response.status_code
         return response
     finally:
+        reset_client_key(ctx_token)
         dur_ms = int((time.time() - start) * 1000)
-        logger.info(f"{client} {method} {path} -> {status_code} ({dur_ms} ms)")
+        # Se encola y lo escribe un hilo en lotes (app/access_log.py)
+        access_log.record(client, method, path, status_code, dur_ms)
 
 # ============================
 #  Rutas principales (API)
 # ============================
 app.include_router(api)
 
+# ============================
+#  Arranque / apagado ordenado
+# ============================
+@app.on_event("startup")
+def _start_mail_dispatcher():
+    # Drenar emails pendientes de ejecuciones anteriores
+    if smtp_configured():
+        mail_queue.start()
+
+@app.on_event("startup")
+def _start_outbox_dispatcher():
+    outbox_dispatcher.start()
+
+@app.on_event("shutdown")
+def _flush_group_commit():
+    # Confirmar las compras que queden en la cola del escritor antes de salir
+    group_commit_writer.stop()
+    outbox_dispatcher.stop()
+    mail_queue.stop()
+    pending_tokens.flush()
+    access_log.stop()
+
 # ============================
 #  Swagger local (sin Internet)
 # ============================
@@ -107,8 +233,8 @@ def redoc_ui():
 # ============================
 #  Frontend estático
 # ============================
-FRONTEND_DIR = Path(__file__).parent / "frontend"
-app.mount("/app", StaticFiles(directory=str(FRONTEND_DIR), html=True), name="frontend")
+# dist/ (npm run build) con .br/.gz precomprimidos; si no hay build, app/frontend
+app.mount("/app", frontend_app(), name="frontend")
 
 # ============================
 #  Página de inicio
@@ -0,0 +1,221 @@
+"""Tareas de mantenimiento por lotes (cron / systemd timer).
+
+Cada tarea borra (y opcionalmente archiva) filas en lotes cortos ordenados por
+clave primaria, con commit y pausa entre lotes, para no mantener bloqueos ni
+transacciones largas en VM2. Para añadir una tarea basta con registrarla en
+`TASKS` (ver `register_task`).
+"""
+import os
+import time
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+from .db import get_conn
+
+MAINT_BATCH_SIZE = int(os.getenv("MAINT_BATCH_SIZE", "500"))
+MAINT_SLEEP_SEC = float(os.getenv("MAINT_SLEEP_SEC", "0.2"))
+
+Progress = Callable[[str, int, int], None]
+
+
+def _print_progress(label: str, chunk: int, total: int) -> None:
+    print(f"{label}: +{chunk} (total {total})", flush=True)
+
+
+def chunked_delete(
+    table: str,
+    where_sql: str,
+    args: Sequence[Any] = (),
+    order_by: str = "id",
+    batch_size: int = MAINT_BATCH_SIZE,
+    sleep_sec: float = MAINT_SLEEP_SEC,
+    archive_table: Optional[str] = None,
+    dry_run: bool = False,
+    label: Optional[str] = None,
+    progress: Optional[Progress] = _print_progress,
+) -> int:
+    """Borra las filas de `table` que cumplen `where_sql`, en lotes.
+
+    Cada lote selecciona hasta `batch_size` ids (en el orden del índice que
+    soporta `where_sql`/`order_by`) y los borra por PK en orden ascendente, en
+    su propia transacción. Con `archive_table` las filas se copian antes
+    (INSERT ... SELECT) en la misma transacción. Devuelve el total procesado;
+    con `dry_run` solo cuenta las filas afectadas.
+    """
+    label = label or table
+    if dry_run:
+        return _count(table, where_sql, args, label, progress)
+    total = 0
+    while True:
+        conn = get_conn()
+        try:
+            with conn.cursor() as c:
+                c.execute(
+                    f"SELECT id FROM {table} WHERE {where_sql} ORDER BY {order_by} LIMIT %s",
+                    list(args) + [batch_size],
+                )
+                ids: List[int] = sorted(r["id"] for r in c.fetchall())
+                if ids:
+                    marks = ",".join(["%s"] * len(ids))
+                    if archive_table:
+                        c.execute(f"INSERT IGNORE INTO {archive_table} SELECT * FROM {table} WHERE id IN ({marks})", ids)
+                    c.execute(f"DELETE FROM {table} WHERE id IN ({marks})", ids)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+        if not ids:
+            break
+        total += len(ids)
+        if progress:
+            progress(label, len(ids), total)
+        if len(ids) < batch_size:
+            break
+        if sleep_sec > 0:
+            time.sleep(sleep_sec)
+    return total
+
+
+def _count(table: str, where_sql: str, args: Sequence[Any], label: str, progress: Optional[Progress]) -> int:
+    conn = get_conn()
+    try:
+        with conn.cursor() as c:
+            c.execute(f"SELECT COUNT(*) AS n FROM {table} WHERE {where_sql}", list(args))
+            n = int(c.fetchone()["n"])
+        conn.commit()
+    finally:
+        conn.close()
+    if progress:
+        progress(f"{label} (dry-run)", n, n)
+    return n
+
+
+def ensure_indexes(statements: Sequence[str]) -> None:
+    conn = get_conn()
+    try:
+        with conn.cursor() as c:
+            for sql in statements:
+                c.execute(sql)
+        conn.commit()
+    finally:
+        conn.close()
+
+
+# ----------------------------
+# Registro de tareas
+# ----------------------------
+TASKS: Dict[str, Callable[..., int]] = {}
+
+
+def register_task(name: str):
+    def deco(fn: Callable[..., int]) -> Callable[..., int]:
+        TASKS[name] = fn
+        return fn
+    return deco
+
+
+@register_task("password_resets")
+def cleanup_password_resets(batch_size: int = MAINT_BATCH_SIZE, sleep_sec: float = MAINT_SLEEP_SEC,
+                            dry_run: bool = False, progress: Optional[Progress] = _print_progress) -> int:
+    """Borra tokens de reseteo usados o expirados."""
+    ensure_indexes([
+        "CREATE INDEX IF NOT EXISTS idx_password_resets_expires ON password_resets (expires_at)",
+        "CREATE INDEX IF NOT EXISTS idx_password_resets_used ON password_resets (used)",
+    ])
+    # Dos pasadas, cada una servida por su índice (un OR impediría usarlos).
+    # expires_at se escribe en UTC desde Python (create_password_reset_token): UTC_TIMESTAMP()
+    expired = chunked_delete(
+        "password_resets", "expires_at < UTC_TIMESTAMP()", order_by="expires_at, id",
+        batch_size=batch_size, sleep_sec=sleep_sec, dry_run=dry_run,
+        label="password_resets expirados", progress=progress,
+    )
+    used = chunked_delete(
+        "password_resets", "used = 1", order_by="id",
+        batch_size=batch_size, sleep_sec=sleep_sec, dry_run=dry_run,
+        label="password_resets usados", progress=progress,
+    )
+    return expired + used
+
+
+@register_task("refresh_tokens")
+def cleanup_refresh_tokens(batch_size: int = MAINT_BATCH_SIZE, sleep_sec: float = MAINT_SLEEP_SEC,
+                           dry_run: bool = False, progress: Optional[Progress] = _print_progress) -> int:
+    """Borra refresh tokens expirados (los revocados se guardan hasta expirar para detectar reuso)."""
+    from .db import ensure_refresh_tokens_table
+    ensure_refresh_tokens_table()
+    # expires_at se escribe en UTC desde Python (_insert_refresh_token): UTC_TIMESTAMP()
+    return chunked_delete(
+        "refresh_tokens", "expires_at < UTC_TIMESTAMP()", order_by="expires_at, id",
+        batch_size=batch_size, sleep_sec=sleep_sec, dry_run=dry_run,
+        label="refresh_tokens expirados", progress=progress,
+    )
+
+
+@register_task("outbox")
+def cleanup_outbox(batch_size: int = MAINT_BATCH_SIZE, sleep_sec: float = MAINT_SLEEP_SEC,
+                   dry_run: bool = False, progress: Optional[Progress] = _print_progress) -> int:
+    """Borra eventos del outbox con más de OUTBOX_RETENTION_HOURS (los consumidores ya los leyeron)."""
+    from .outbox import ensure_outbox_table, OUTBOX_RETENTION_HOURS
+    ensure_outbox_table()
+    ensure_indexes(["CREATE INDEX IF NOT EXISTS idx_outbox_created ON outbox_events (created_at)"])
+    # created_at es DEFAULT CURRENT_TIMESTAMP: se lee en la zona de la sesión, como NOW()
+    return chunked_delete(
+        "outbox_events", "created_at < NOW() - INTERVAL %s HOUR", args=(OUTBOX_RETENTION_HOURS,),
+        order_by="created_at, id", batch_size=batch_size, sleep_sec=sleep_sec, dry_run=dry_run,
+        label="outbox_events", progress=progress,
+    )
+
+
+@register_task("productos_tombstones")
+def cleanup_productos_tombstones(batch_size: int = MAINT_BATCH_SIZE, sleep_sec: float = MAINT_SLEEP_SEC,
+                                 dry_run: bool = False, progress: Optional[Progress] = _print_progress) -> int:
+    """Purga borrados de productos más viejos que CATALOG_TOMBSTONE_DAYS (/productos/changes)."""
+    from .cambios import ensure_changes_schema, CATALOG_TOMBSTONE_DAYS
+    ensure_changes_schema()
+    return chunked_delete(
+        "productos_tombstones", "deleted_at < NOW() - INTERVAL %s DAY", args=(CATALOG_TOMBSTONE_DAYS,),
+        order_by="deleted_at, id", batch_size=batch_size, sleep_sec=sleep_sec, dry_run=dry_run,
+        label="productos_tombstones", progress=progress,
+    )
+
+
+@register_task("analytics_snapshot")
+def analytics_snapshot(dry_run: bool = False, progress: Optional[Progress] = _print_progress, **_ignored) -> int:
+    """Regenera los snapshots `.npy` de la analítica (arranque rápido de los workers).
+
+    Se ejecuta desde cron y no desde los workers para que haya un solo escritor.
+    """
+    from .analytics import analytics
+    if not analytics.disponible():
+        raise RuntimeError("numpy no está instalado")
+    n = analytics.load() if dry_run else analytics.save_snapshot()
+    if progress:
+        progress("analytics_snapshot", n, n)
+    return n
+
+
+@register_task("compras_particionar")
+def compras_particionar(dry_run: bool = False, progress: Optional[Progress] = _print_progress, **_ignored) -> int:
+    """Conversión inicial de `compras` a particiones mensuales (una sola vez; reescribe la tabla).
+
+    Elimina las FKs de `compras` (fk_compras_producto, fk_compras_usuario): InnoDB
+    no admite claves foráneas en tablas particionadas y no se recrean.
+    """
+    from .particiones import migrar
+    return migrar(dry_run=dry_run, progress=progress)
+
+
+@register_task("compras_particiones")
+def compras_particiones(batch_size: int = MAINT_BATCH_SIZE, sleep_sec: float = MAINT_SLEEP_SEC,
+                        dry_run: bool = False, progress: Optional[Progress] = _print_progress) -> int:
+    """Crea las particiones de los próximos meses y archiva las que pasaron la retención."""
+    from .particiones import crear_adelantadas, archivar
+    crear_adelantadas(dry_run=dry_run, progress=progress)
+    return archivar(batch_size=batch_size, sleep_sec=sleep_sec, dry_run=dry_run, progress=progress)
+
+
+def run_task(name: str, **kwargs) -> int:
+    if name not in TASKS:
+        raise KeyError(f"tarea desconocida: {name} (disponibles: {', '.join(sorted(TASKS))})")
+    return TASKS[name](**kwargs)
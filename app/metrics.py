@@ -1,3 +1,4 @@
+import threading
 import time
 from typing import Dict, List, Tuple
 
@@ -47,3 +48,53 @@ def latency_snapshot() -> dict:
 
 # CI helper: harmless marker to ensure file is present in commits for CI environments.
 # Do not remove — used by CI runs to avoid ModuleNotFoundError when checkouts are shallow.
+
+
+# Contadores y muestras de subsistemas internos (group commit, caché, ...)
+_metrics_lock = threading.Lock()
+counters: Dict[str, int] = {}
+sample_store: Dict[str, List[float]] = {}
+
+
+def incr(name: str, n: int = 1) -> None:
+    """Incrementa un contador con nombre."""
+    with _metrics_lock:
+        counters[name] = counters.get(name, 0) + n
+
+
+def record_sample(name: str, value: float) -> None:
+    """Registra una muestra numérica (últimas N) bajo el nombre dado."""
+    with _metrics_lock:
+        arr = sample_store.setdefault(name, [])
+        arr.append(value)
+        if len(arr) > _MAX_SAMPLES:
+            del arr[: len(arr) - _MAX_SAMPLES]
+
+
+def sample_summary(name: str) -> dict:
+    """Resumen (conteo, media, p50/p95/p99, máx) de las muestras de un nombre."""
+    with _metrics_lock:
+        arr = sorted(sample_store.get(name, []))
+    if not arr:
+        return {"count": 0, "avg": 0.0, "p50": 0.0, "p95": 0.0, "p99": 0.0, "max": 0.0}
+
+    def pct(p: float) -> float:
+        k = max(0, min(len(arr) - 1, int(round((p / 100.0) * (len(arr) - 1)))))
+        return float(arr[k])
+
+    return {
+        "count": len(arr),
+        "avg": round(sum(arr) / len(arr), 2),
+        "p50": round(pct(50.0), 2),
+        "p95": round(pct(95.0), 2),
+        "p99": round(pct(99.0), 2),
+        "max": round(arr[-1], 2),
+    }
+
+
+def metrics_snapshot() -> dict:
+    """Snapshot de contadores y resúmenes de muestras internas."""
+    with _metrics_lock:
+        cnt = dict(counters)
+        names = list(sample_store.keys())
+    return {"counters": cnt, "samples": {n: sample_summary(n) for n in names}}
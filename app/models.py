@@ -1,4 +1,4 @@
-from typing import Optional, List, Literal
+from typing import Any, Optional, List, Literal
 from pydantic import BaseModel, EmailStr, Field
 from datetime import datetime, date
 
@@ -25,6 +25,19 @@ class ProductosResponse(BaseModel):
     size: int
     items: List[Producto]
 
+class ProductosBatchRequest(BaseModel):
+    ids: List[int] = Field(min_items=1)
+
+class ProductosBatchResponse(BaseModel):
+    items: List[Producto]
+    missing: List[int] = []
+
+class ProductosChangesResponse(BaseModel):
+    items: List[Producto]
+    deleted: List[int] = []
+    next: str
+    more: bool = False
+
 # =========
 # Compras
 # =========
@@ -62,6 +75,30 @@ class CheckoutResponse(BaseModel):
     compras: List[CheckoutResultItem]
     detalle: Optional[str] = None
 
+# =========
+# Carrito (cotización)
+# =========
+class CartQuoteRequest(BaseModel):
+    items: List[CheckoutItem]
+
+class CartQuoteLine(BaseModel):
+    producto_id: int
+    nombre: Optional[str] = None
+    cantidad: int
+    precio_unit: Optional[float] = None
+    subtotal: float = 0.0
+    stock: Optional[int] = None
+    existe: bool
+    disponible: bool
+
+class CartQuoteResponse(BaseModel):
+    ok: bool
+    items: List[CartQuoteLine]
+    subtotal: float
+    envio: float
+    descuento: float
+    total: float
+
 # =========
 # Auth / Users
 # =========
@@ -75,6 +112,10 @@ class LoginRequest(BaseModel):
     password: str
 
 
+class RefreshRequest(BaseModel):
+    refresh_token: str = Field(..., min_length=20, max_length=200)
+
+
 class PasswordResetRequest(BaseModel):
     email: EmailStr
 
@@ -87,6 +128,8 @@ class TokenResponse(BaseModel):
     access_token: str
     token_type: str = "bearer"
     expires_in: int
+    refresh_token: Optional[str] = None
+    refresh_expires_in: Optional[int] = None
 
 class MeResponse(BaseModel):
     id: int
@@ -113,8 +156,49 @@ class SerieItem(BaseModel):
     monto_total: float
 
 class VentasSerie(BaseModel):
+    # 'dia' | 'semana' | 'mes'; cada item.fecha es el inicio del bucket
+    granularidad: str = "dia"
     items: List[SerieItem]
 
+class TopProductoItem(BaseModel):
+    producto_id: int
+    nombre: Optional[str] = None
+    categoria: Optional[str] = None
+    compras: int
+    unidades: int
+    monto_total: float
+
+class VentasTopProductos(BaseModel):
+    items: List[TopProductoItem]
+
+class CategoriaVentasItem(BaseModel):
+    categoria: Optional[str] = None
+    compras: int
+    unidades: int
+    monto_total: float
+
+class VentasCategorias(BaseModel):
+    items: List[CategoriaVentasItem]
+
+class VentasCrossTab(BaseModel):
+    filas: str
+    columnas: Optional[str] = None
+    medida: str
+    etiquetas_filas: List[Any]
+    etiquetas_columnas: List[Any] = []
+    # lista de filas (con columnas) o lista plana (sin columnas)
+    valores: List[Any]
+
+class MediaMovilItem(BaseModel):
+    fecha: date
+    valor: float
+    media: float
+
+class VentasMediaMovil(BaseModel):
+    ventana: int
+    medida: str
+    items: List[MediaMovilItem]
+
 # =========
 # Stats
 # =========
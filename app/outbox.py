@@ -0,0 +1,381 @@
+"""Outbox transaccional y feed de cambios (/internal/events).
+
+Las mutaciones escriben su evento en `outbox_events` dentro de la misma
+transacción (`emit(c, ...)` con el cursor de la operación): si la transacción
+se deshace, el evento tampoco existe. Un hilo por proceso (`dispatcher`) lee la
+tabla por id en lotes, entrega los eventos a los handlers registrados con
+`subscribe()` y los deja en un buffer en memoria para el long-poll.
+
+Ids fuera de orden: con varias transacciones concurrentes el id N+1 puede
+confirmarse antes que el N. Si aparece un hueco, el dispatcher no avanza más
+allá de él durante OUTBOX_GAP_SEC (lo normal es que se llene enseguida). Si
+sigue vacío avanza, pero el id queda anotado como hueco y se vuelve a buscar
+(`WHERE id IN (...)`) en cada sondeo: una transacción lenta (esperando locks)
+entrega su evento tarde, no lo pierde. La dueña de un id empezó antes de que
+se insertara la fila siguiente; si en INNODB_TRX ya no queda ninguna transacción
+tan vieja y la fila sigue sin aparecer, hizo rollback y el hueco se descarta. Sin
+permiso para ver INNODB_TRX se descarta tras OUTBOX_GAP_MAX_SEC.
+
+Los handlers en proceso reciben los eventos tardíos fuera de orden; el feed
+/internal/events no entrega nada más allá del primer hueco abierto
+(`safe_id`), así un consumidor que guarda su offset no se lo salta.
+"""
+import os
+import json
+import time
+import socket
+import logging
+import threading
+from collections import deque
+from datetime import datetime, timedelta
+from typing import Any, Callable, Deque, Dict, List, Optional, Sequence, Tuple
+
+from .db import get_conn
+from .cache import cache
+from .metrics import incr
+
+logger = logging.getLogger("tienda-api")
+
+OUTBOX_POLL_MS = float(os.getenv("OUTBOX_POLL_MS", "200"))
+OUTBOX_BATCH = int(os.getenv("OUTBOX_BATCH", "500"))
+# Eventos recientes que se sirven desde memoria en /internal/events
+OUTBOX_BUFFER = int(os.getenv("OUTBOX_BUFFER", "5000"))
+# Espera máxima a que se llene un hueco de ids antes de saltarlo
+OUTBOX_GAP_SEC = float(os.getenv("OUTBOX_GAP_SEC", "2"))
+# Tope para seguir buscando un hueco si no se puede consultar INNODB_TRX
+# (por encima de innodb_lock_wait_timeout, lo que puede esperar un lote del escritor)
+OUTBOX_GAP_MAX_SEC = float(os.getenv("OUTBOX_GAP_MAX_SEC", "300"))
+OUTBOX_RETENTION_HOURS = int(os.getenv("OUTBOX_RETENTION_HOURS", "72"))
+
+# Identifica al proceso que emitió el evento (los handlers pueden ignorar los propios)
+ORIGEN = f"{socket.gethostname()}:{os.getpid()}"
+
+Handler = Callable[[List[Dict[str, Any]]], None]
+
+_table_ready = False
+
+
+def ensure_outbox_table() -> None:
+    global _table_ready
+    if _table_ready:
+        return
+    conn = get_conn()
+    try:
+        with conn.cursor() as c:
+            c.execute("""
+            CREATE TABLE IF NOT EXISTS outbox_events (
+                id BIGINT AUTO_INCREMENT PRIMARY KEY,
+                tipo VARCHAR(64) NOT NULL,
+                clave VARCHAR(64) NULL,
+                payload LONGTEXT NOT NULL,
+                origen VARCHAR(128) NOT NULL,
+                created_at TIMESTAMP(3) NOT NULL DEFAULT CURRENT_TIMESTAMP(3)
+            ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+            """)
+        conn.commit()
+    finally:
+        conn.close()
+    _table_ready = True
+
+
+def _json(payload: Dict[str, Any]) -> str:
+    return json.dumps(payload, separators=(",", ":"), default=str)
+
+
+def emit(c, tipo: str, clave: Any, payload: Dict[str, Any]) -> None:
+    """Registra un evento con el cursor `c` de la transacción en curso."""
+    emit_many(c, [(tipo, clave, payload)])
+
+
+def emit_many(c, eventos: Sequence[Tuple[str, Any, Dict[str, Any]]]) -> None:
+    if not eventos:
+        return
+    ensure_outbox_table()
+    c.executemany(
+        "INSERT INTO outbox_events (tipo, clave, payload, origen) VALUES (%s, %s, %s, %s)",
+        [(tipo, None if clave is None else str(clave), _json(payload), ORIGEN) for tipo, clave, payload in eventos],
+    )
+
+
+def _row_to_event(r: Dict[str, Any]) -> Dict[str, Any]:
+    ts = r["created_at"]
+    return {
+        "id": int(r["id"]),
+        "tipo": r["tipo"],
+        "clave": r["clave"],
+        "payload": json.loads(r["payload"]),
+        "origen": r["origen"],
+        "ts": ts.isoformat(timespec="milliseconds") if isinstance(ts, datetime) else str(ts),
+    }
+
+
+_SELECT = "SELECT id, tipo, clave, payload, origen, created_at FROM outbox_events"
+
+
+def leer_desde(after: int, limit: int) -> List[Dict[str, Any]]:
+    """Eventos con id > after directo de la tabla (offsets fuera del buffer)."""
+    ensure_outbox_table()
+    conn = get_conn(read=True)
+    try:
+        with conn.cursor() as c:
+            c.execute(f"{_SELECT} WHERE id > %s ORDER BY id LIMIT %s", (after, limit))
+            rows = c.fetchall()
+        conn.commit()
+    finally:
+        conn.close()
+    return [_row_to_event(r) for r in rows]
+
+
+class OutboxDispatcher:
+    def __init__(self, poll_ms: float = OUTBOX_POLL_MS, batch: int = OUTBOX_BATCH,
+                 buffer: int = OUTBOX_BUFFER, gap_sec: float = OUTBOX_GAP_SEC,
+                 gap_max_sec: float = OUTBOX_GAP_MAX_SEC):
+        self.poll = max(0.01, poll_ms / 1000.0)
+        self.batch = max(1, batch)
+        self.gap_sec = gap_sec
+        self.gap_max_sec = gap_max_sec
+        # id -> (instante monotonic en que se vio, created_at de la fila siguiente)
+        self._huecos: Dict[int, Tuple[float, datetime]] = {}
+        # None = aún no se sabe si hay permiso para leer INNODB_TRX
+        self._trx_visible: Optional[bool] = None
+        self._buf: Deque[Dict[str, Any]] = deque(maxlen=max(1, buffer))
+        self._handlers: List[Handler] = []
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self._last = 0
+        # el buffer tiene todo lo posterior a este id (posición inicial o lo desalojado)
+        self._floor = 0
+        self._gap_since: Optional[float] = None
+        self._errors = 0
+
+    # -- API pública --
+    def subscribe(self, fn: Handler) -> None:
+        """Registra un handler que recibe cada lote de eventos (en el hilo del dispatcher)."""
+        self._handlers.append(fn)
+
+    def start(self) -> None:
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="outbox", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout: float = 5.0) -> None:
+        self._stop.set()
+        t = self._thread
+        if t is not None:
+            t.join(timeout)
+        self._thread = None
+
+    @property
+    def last_id(self) -> int:
+        return self._last
+
+    @property
+    def safe_id(self) -> int:
+        """Hasta dónde el feed es completo: justo antes del primer hueco abierto."""
+        with self._lock:
+            return min(self._huecos) - 1 if self._huecos else self._last
+
+    def desde(self, after: int, limit: int) -> Optional[List[Dict[str, Any]]]:
+        """Eventos con after < id <= safe_id desde memoria; None si `after` es anterior al buffer."""
+        tope = self.safe_id
+        with self._lock:
+            if after >= tope:
+                return []
+            if after < self._floor:
+                return None
+            return [e for e in self._buf if after < e["id"] <= tope][:limit]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "running": self._thread is not None and self._thread.is_alive(),
+            "last_id": self._last,
+            "buffered": len(self._buf),
+            "waiting_gap": self._gap_since is not None,
+            "open_gaps": len(self._huecos),
+            "errors": self._errors,
+        }
+
+    # -- Internos --
+    def _run(self) -> None:
+        # Arranca en el último id: los handlers en proceso no reprocesan historia
+        while not self._stop.is_set():
+            try:
+                ensure_outbox_table()
+                conn = get_conn()
+                try:
+                    with conn.cursor() as c:
+                        c.execute("SELECT COALESCE(MAX(id),0) AS m FROM outbox_events")
+                        m = int(c.fetchone()["m"])
+                        # transacciones en vuelo al arrancar: sus ids (< MAX) se buscan como huecos
+                        c.execute("SELECT id, created_at FROM outbox_events WHERE id > %s ORDER BY id",
+                                  (max(0, m - self.batch),))
+                        presentes = [(int(r["id"]), r["created_at"]) for r in c.fetchall()]
+                    now = time.monotonic()
+                    with self._lock:
+                        self._last = self._floor = m
+                        esperado = max(1, m - self.batch + 1)
+                        for rid, ts in presentes:
+                            for hid in range(esperado, rid):
+                                self._huecos.setdefault(hid, (now, ts))
+                            esperado = rid + 1
+                    conn.commit()
+                finally:
+                    conn.close()
+                break
+            except Exception:
+                self._errors += 1
+                logger.exception("Outbox: no se pudo leer la posición inicial")
+                self._stop.wait(5.0)
+        while not self._stop.is_set():
+            try:
+                n = self._poll_once()
+            except Exception:
+                self._errors += 1
+                incr("outbox.errors")
+                logger.exception("Outbox: error leyendo eventos")
+                self._stop.wait(min(5.0, self.poll * 10))
+                continue
+            if n < self.batch:
+                self._stop.wait(self.poll)
+
+    def _poll_once(self) -> int:
+        conn = get_conn()
+        try:
+            with conn.cursor() as c:
+                tardios = self._revisar_huecos(c) if self._huecos else []
+                c.execute(f"{_SELECT} WHERE id > %s ORDER BY id LIMIT %s", (self._last, self.batch))
+                rows = c.fetchall()
+            conn.commit()
+        finally:
+            conn.close()
+        if tardios:
+            self._entregar(tardios, tardios=True)
+        aceptados: List[Dict[str, Any]] = []
+        esperado = self._last + 1
+        for r in rows:
+            rid = int(r["id"])
+            if rid != esperado:
+                now = time.monotonic()
+                if self._gap_since is None:
+                    self._gap_since = now
+                if now - self._gap_since < self.gap_sec:
+                    break
+                # avanzar sin perderlo: los ids faltantes se siguen buscando
+                with self._lock:
+                    for hueco in range(esperado, rid):
+                        self._huecos.setdefault(hueco, (now, r["created_at"]))
+                incr("outbox.gaps_open", rid - esperado)
+            self._gap_since = None
+            aceptados.append(_row_to_event(r))
+            esperado = rid + 1
+        if aceptados:
+            self._entregar(aceptados)
+        # bloqueado por un hueco cuenta como "nada nuevo": espera poll antes de releer
+        return len(aceptados)
+
+    def _trx_mas_vieja(self, c) -> Tuple[bool, Optional[datetime]]:
+        """(visible, inicio de la transacción activa más vieja o None si no hay ninguna)."""
+        if self._trx_visible is False:
+            return False, None
+        try:
+            c.execute("SELECT MIN(trx_started) AS t FROM information_schema.INNODB_TRX")
+            self._trx_visible = True
+            return True, c.fetchone()["t"]
+        except Exception:
+            # sin privilegio PROCESS: queda solo el tope por tiempo
+            self._trx_visible = False
+            logger.warning("Outbox: sin acceso a INNODB_TRX; los huecos se descartan tras %ss", self.gap_max_sec)
+            return False, None
+
+    def _revisar_huecos(self, c) -> List[Dict[str, Any]]:
+        """Busca los ids pendientes; devuelve los que aparecieron y descarta los muertos."""
+        with self._lock:
+            huecos = dict(self._huecos)
+        # Antes de buscarlos: así, si la dueña confirma entre las dos consultas, la fila aparece
+        visible, mas_vieja = self._trx_mas_vieja(c)
+        marks = ",".join(["%s"] * len(huecos))
+        c.execute(f"{_SELECT} WHERE id IN ({marks}) ORDER BY id", list(huecos))
+        encontrados = [_row_to_event(r) for r in c.fetchall()]
+        vistos = {e["id"] for e in encontrados}
+        now = time.monotonic()
+        muertos = []
+        for hid, (desde, siguiente) in huecos.items():
+            if hid in vistos:
+                continue
+            # 1 s de margen por la resolución de trx_started
+            sin_duena = visible and (mas_vieja is None or mas_vieja > siguiente + timedelta(seconds=1))
+            if sin_duena or now - desde >= self.gap_max_sec:
+                muertos.append(hid)
+        with self._lock:
+            for hid in vistos:
+                self._huecos.pop(hid, None)
+            for hid in muertos:
+                self._huecos.pop(hid, None)
+        if encontrados:
+            incr("outbox.gaps_filled", len(encontrados))
+        if muertos:
+            incr("outbox.gaps_expired", len(muertos))
+            logger.warning("Outbox: ids %s descartados (rollback o sin fila tras %ss)", muertos, self.gap_max_sec)
+        return encontrados
+
+    def _entregar(self, eventos: List[Dict[str, Any]], tardios: bool = False) -> None:
+        with self._lock:
+            for e in eventos:
+                if tardios and e["id"] <= self._floor:
+                    # anterior a lo que guarda el buffer: desde() ya lo lee de la tabla
+                    continue
+                if len(self._buf) == self._buf.maxlen:
+                    self._floor = self._buf.popleft()["id"]
+                if tardios:
+                    # el buffer se mantiene ordenado por id (desde() corta con [:limit])
+                    i = len(self._buf)
+                    while i > 0 and self._buf[i - 1]["id"] > e["id"]:
+                        i -= 1
+                    self._buf.insert(i, e)
+                else:
+                    self._buf.append(e)
+            if not tardios:
+                self._last = eventos[-1]["id"]
+        incr("outbox.dispatched", len(eventos))
+        for fn in list(self._handlers):
+            try:
+                fn(eventos)
+            except Exception:
+                logger.exception("Outbox: error en handler")
+
+
+def compras_externas(eventos: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Compras confirmadas por otros procesos, como las filas del listener del escritor.
+
+    Las propias ya llegaron por `writer.add_listener` sin esperar al sondeo. En el
+    payload fecha y precio viajan como texto (json con default=str): se restauran.
+    """
+    rows = []
+    for e in eventos:
+        if e["tipo"] != "compra" or e["origen"] == ORIGEN:
+            continue
+        r = dict(e["payload"])
+        r["fecha"] = datetime.fromisoformat(r["fecha"])
+        r["precio"] = float(r["precio"])
+        rows.append(r)
+    return rows
+
+
+def _invalidar_caches(eventos: List[Dict[str, Any]]) -> None:
+    # Señal de invalidación entre workers: los cambios propios ya se invalidaron en línea
+    for e in eventos:
+        if e["origen"] == ORIGEN:
+            continue
+        if e["tipo"] == "compra":
+            cache.invalidate("catalogo")
+        elif e["tipo"].startswith("usuario.") and e["clave"]:
+            cache.invalidate(f"usuario:{e['clave']}")
+
+
+# Instancia compartida del proceso
+dispatcher = OutboxDispatcher()
+dispatcher.subscribe(_invalidar_caches)
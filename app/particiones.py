@@ -0,0 +1,379 @@
+"""Particionado mensual de `compras` y archivo de los meses viejos.
+
+`compras` se particiona por RANGE sobre UNIX_TIMESTAMP(fecha), una partición
+por mes (`pAAAAMM`) más `pmax` (MAXVALUE) para que un insert nunca falle si el
+cron se atrasa. Las consultas por rango de fecha (`c.fecha >= X AND c.fecha < Y`)
+solo leen las particiones del rango.
+
+- `migrar()`: conversión inicial (una vez). Reconstruye la tabla: fecha pasa
+  a NOT NULL y la PK a (id, fecha). InnoDB no admite claves foráneas en tablas
+  particionadas, así que se eliminan `fk_compras_producto` y
+  `fk_compras_usuario` (y cualquier otra FK de `compras`) y no se vuelven a
+  crear: la integridad referencial queda a cargo de la aplicación.
+- `crear_adelantadas()`: parte `pmax` para tener COMPRAS_PARTICIONES_ADELANTE
+  meses futuros listos (pmax está vacía, es instantáneo).
+- `archivar()`: los meses más viejos que COMPRAS_RETENCION_MESES se separan con
+  `CONVERT PARTITION ... TO TABLE` (instantáneo, MariaDB >= 10.7), se copian a
+  `compras_archivo` (o a un .csv.gz si hay COMPRAS_ARCHIVE_DIR) en lotes y la
+  tabla temporal se borra. Si se corta a medias, la siguiente corrida retoma
+  la copia desde la tabla temporal.
+
+Lo archivado deja de verse en /admin/ventas/* y en los rankings.
+"""
+import os
+import csv
+import gzip
+import time
+from datetime import date, datetime
+from pathlib import Path
+from typing import Any, Callable, List, Optional, Tuple
+
+from .db import get_conn
+
+COMPRAS_PARTICIONES_ADELANTE = int(os.getenv("COMPRAS_PARTICIONES_ADELANTE", "3"))
+# Meses que se quedan en `compras` (además del actual); 0 = no archivar nunca
+COMPRAS_RETENCION_MESES = int(os.getenv("COMPRAS_RETENCION_MESES", "24"))
+# Vacío: archivar en la tabla compras_archivo; con ruta: un compras-pAAAAMM.csv.gz por mes
+COMPRAS_ARCHIVE_DIR = os.getenv("COMPRAS_ARCHIVE_DIR", "")
+ARCHIVE_TABLE = "compras_archivo"
+
+Progress = Callable[[str, int, int], None]
+
+
+def _mes(d: date) -> date:
+    return d.replace(day=1)
+
+
+def sumar_meses(d: date, n: int) -> date:
+    y, m = divmod(d.year * 12 + d.month - 1 + n, 12)
+    return date(y, m + 1, 1)
+
+
+def nombre_particion(mes: date) -> str:
+    return f"p{mes:%Y%m}"
+
+
+def _mes_de(nombre: str) -> Optional[date]:
+    if len(nombre) == 7 and nombre[0] == "p" and nombre[1:].isdigit():
+        return date(int(nombre[1:5]), int(nombre[5:7]), 1)
+    return None
+
+
+def _definicion(mes: date) -> str:
+    fin = sumar_meses(mes, 1)
+    return f"PARTITION {nombre_particion(mes)} VALUES LESS THAN (UNIX_TIMESTAMP('{fin:%Y-%m-%d} 00:00:00'))"
+
+
+def particiones(c) -> List[str]:
+    """Nombres de las particiones de `compras` en orden ([] si no está particionada)."""
+    c.execute(
+        "SELECT PARTITION_NAME AS p FROM information_schema.PARTITIONS "
+        "WHERE TABLE_SCHEMA=DATABASE() AND TABLE_NAME='compras' AND PARTITION_NAME IS NOT NULL "
+        "ORDER BY PARTITION_ORDINAL_POSITION"
+    )
+    return [r["p"] for r in c.fetchall()]
+
+
+def _columnas(c, tabla: str) -> List[Tuple[str, str]]:
+    """(columna, tipo) de `tabla` en orden."""
+    c.execute(
+        "SELECT COLUMN_NAME AS col, COLUMN_TYPE AS tipo FROM information_schema.COLUMNS "
+        "WHERE TABLE_SCHEMA=DATABASE() AND TABLE_NAME=%s ORDER BY ORDINAL_POSITION",
+        (tabla,),
+    )
+    return [(r["col"], r["tipo"]) for r in c.fetchall()]
+
+
+def _tiene_indice(c, tabla: str, indice: str) -> bool:
+    c.execute(
+        "SELECT 1 FROM information_schema.STATISTICS "
+        "WHERE TABLE_SCHEMA=DATABASE() AND TABLE_NAME=%s AND INDEX_NAME=%s LIMIT 1",
+        (tabla, indice),
+    )
+    return c.fetchone() is not None
+
+
+def _exec(sql: str, dry_run: bool, progress: Optional[Progress], label: str) -> None:
+    if dry_run:
+        if progress:
+            progress(f"{label} (dry-run): {sql}", 0, 0)
+        return
+    conn = get_conn()
+    try:
+        with conn.cursor() as c:
+            c.execute(sql)
+        conn.commit()
+    finally:
+        conn.close()
+
+
+# ----------------------------
+# Migración inicial
+# ----------------------------
+def migrar(ahead: int = COMPRAS_PARTICIONES_ADELANTE, dry_run: bool = False,
+           progress: Optional[Progress] = None, hoy: Optional[date] = None) -> int:
+    """Convierte `compras` en tabla particionada por mes. Devuelve las particiones creadas.
+
+    Reescribe la tabla completa (ALTER con copia): correr en una ventana de
+    mantenimiento. Elimina todas las FKs de `compras` (no pueden coexistir con
+    el particionado) y no las recrea.
+
+    Todo lo que decide el DDL se consulta antes de tocar nada: si la tabla ya
+    está particionada no se elimina ninguna FK."""
+    hoy = hoy or date.today()
+    conn = get_conn()
+    try:
+        with conn.cursor() as c:
+            if particiones(c):
+                if progress:
+                    progress("compras ya está particionada", 0, 0)
+                return 0
+            c.execute("SELECT MIN(fecha) AS f FROM compras")
+            row = c.fetchone()
+            c.execute(
+                "SELECT CONSTRAINT_NAME AS fk FROM information_schema.REFERENTIAL_CONSTRAINTS "
+                "WHERE CONSTRAINT_SCHEMA=DATABASE() AND TABLE_NAME='compras'"
+            )
+            fks = [r["fk"] for r in c.fetchall()]
+            # el esquema de producción ya lo tiene; repetirlo haría fallar el ALTER con las FKs ya quitadas
+            falta_idx_fecha = not _tiene_indice(c, "compras", "idx_compras_fecha")
+        conn.commit()
+    finally:
+        conn.close()
+
+    primero = _mes(row["f"].date() if row and row["f"] else hoy)
+    ultimo = sumar_meses(_mes(hoy), ahead)
+    meses = []
+    m = primero
+    while m <= ultimo:
+        meses.append(m)
+        m = sumar_meses(m, 1)
+
+    for fk in fks:
+        if progress:
+            progress(f"compras: se elimina la FK {fk} (incompatible con el particionado)", 0, 0)
+        _exec(f"ALTER TABLE compras DROP FOREIGN KEY `{fk}`", dry_run, progress, "compras")
+    # filas sin fecha (columna NULL-able en el esquema original) van al primer mes
+    _exec(f"UPDATE compras SET fecha='{primero:%Y-%m-%d} 00:00:00' WHERE fecha IS NULL", dry_run, progress, "compras")
+    defs = ",\n  ".join([_definicion(m) for m in meses] + ["PARTITION pmax VALUES LESS THAN MAXVALUE"])
+    _exec(
+        "ALTER TABLE compras\n"
+        "  MODIFY fecha TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,\n"
+        "  DROP PRIMARY KEY, ADD PRIMARY KEY (id, fecha)"
+        + (",\n  ADD INDEX idx_compras_fecha (fecha)" if falta_idx_fecha else "")
+        + "\n"
+        f"PARTITION BY RANGE (UNIX_TIMESTAMP(fecha)) (\n  {defs}\n)",
+        dry_run, progress, "compras",
+    )
+    if progress:
+        progress("compras particionada", len(meses), len(meses))
+    return len(meses)
+
+
+# ----------------------------
+# Particiones futuras
+# ----------------------------
+def crear_adelantadas(ahead: int = COMPRAS_PARTICIONES_ADELANTE, dry_run: bool = False,
+                      progress: Optional[Progress] = None, hoy: Optional[date] = None) -> int:
+    """Asegura particiones hasta `ahead` meses después del actual. Devuelve cuántas creó."""
+    hoy = hoy or date.today()
+    conn = get_conn()
+    try:
+        with conn.cursor() as c:
+            nombres = particiones(c)
+        conn.commit()
+    finally:
+        conn.close()
+    if not nombres:
+        raise RuntimeError("compras no está particionada (ejecutar la tarea compras_particionar)")
+    meses = [m for m in map(_mes_de, nombres) if m is not None]
+    desde = sumar_meses(max(meses), 1) if meses else _mes(hoy)
+    hasta = sumar_meses(_mes(hoy), ahead)
+    nuevos = []
+    m = desde
+    while m <= hasta:
+        nuevos.append(m)
+        m = sumar_meses(m, 1)
+    if not nuevos:
+        return 0
+    defs = ", ".join([_definicion(m) for m in nuevos] + ["PARTITION pmax VALUES LESS THAN MAXVALUE"])
+    # Si el cron estuvo parado y pmax tiene filas, REORGANIZE las reparte (más lento, pero correcto)
+    _exec(f"ALTER TABLE compras REORGANIZE PARTITION pmax INTO ({defs})", dry_run, progress, "compras")
+    if progress:
+        progress("particiones nuevas " + ", ".join(nombre_particion(m) for m in nuevos), len(nuevos), len(nuevos))
+    return len(nuevos)
+
+
+# ----------------------------
+# Archivo
+# ----------------------------
+def _ensure_archive_table() -> None:
+    """`compras_archivo` con las mismas columnas que `compras` (incluida usuario_id), sin particiones."""
+    conn = get_conn()
+    try:
+        with conn.cursor() as c:
+            existe = bool(_columnas(c, ARCHIVE_TABLE))
+            if not existe:
+                c.execute(f"CREATE TABLE {ARCHIVE_TABLE} LIKE compras")
+                c.execute(
+                    "SELECT 1 FROM information_schema.PARTITIONS WHERE TABLE_SCHEMA=DATABASE() "
+                    "AND TABLE_NAME=%s AND PARTITION_NAME IS NOT NULL LIMIT 1", (ARCHIVE_TABLE,)
+                )
+                if c.fetchone():
+                    c.execute(f"ALTER TABLE {ARCHIVE_TABLE} REMOVE PARTITIONING")
+                c.execute(f"ALTER TABLE {ARCHIVE_TABLE} ROW_FORMAT=COMPRESSED")
+            else:
+                # archivo creado por una versión anterior con menos columnas: completar (NULL-ables)
+                actuales = {col for col, _ in _columnas(c, ARCHIVE_TABLE)}
+                for col, tipo in _columnas(c, "compras"):
+                    if col not in actuales:
+                        c.execute(f"ALTER TABLE {ARCHIVE_TABLE} ADD COLUMN `{col}` {tipo} NULL")
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def _lista_columnas(tabla: str) -> List[str]:
+    conn = get_conn()
+    try:
+        with conn.cursor() as c:
+            cols = [col for col, _ in _columnas(c, tabla)]
+        conn.commit()
+    finally:
+        conn.close()
+    return cols
+
+
+def _tablas_pendientes(c) -> List[str]:
+    """Tablas compras_pAAAAMM que quedaron de una corrida interrumpida."""
+    c.execute(
+        "SELECT TABLE_NAME AS t FROM information_schema.TABLES "
+        "WHERE TABLE_SCHEMA=DATABASE() AND TABLE_NAME LIKE 'compras\\_p______' ORDER BY TABLE_NAME"
+    )
+    return [r["t"] for r in c.fetchall() if _mes_de(r["t"][len("compras_"):])]
+
+
+def _copiar_a_tabla(tabla: str, batch_size: int, sleep_sec: float) -> int:
+    cols_sql = ", ".join(f"`{col}`" for col in _lista_columnas(tabla))
+    total = 0
+    ultimo = 0
+    while True:
+        conn = get_conn()
+        try:
+            with conn.cursor() as c:
+                c.execute(f"SELECT MAX(id) AS hasta, COUNT(*) AS n FROM (SELECT id FROM {tabla} WHERE id > %s "
+                          f"ORDER BY id LIMIT %s) t", (ultimo, batch_size))
+                r = c.fetchone()
+                if not r or not r["n"]:
+                    conn.commit()
+                    return total
+                c.execute(f"INSERT IGNORE INTO {ARCHIVE_TABLE} ({cols_sql}) SELECT {cols_sql} FROM {tabla} "
+                          "WHERE id > %s AND id <= %s", (ultimo, r["hasta"]))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+        total += int(r["n"])
+        ultimo = int(r["hasta"])
+        if sleep_sec > 0:
+            time.sleep(sleep_sec)
+
+
+def _copiar_a_archivo(tabla: str, destino: Path, batch_size: int) -> int:
+    destino.parent.mkdir(parents=True, exist_ok=True)
+    tmp = destino.with_name(destino.name + ".tmp")
+    cols = _lista_columnas(tabla)
+    cols_sql = ", ".join(f"`{col}`" for col in cols)
+    total = 0
+    ultimo = 0
+    conn = get_conn()
+    try:
+        with gzip.open(tmp, "wt", newline="") as f:
+            w = csv.writer(f)
+            w.writerow(cols)
+            with conn.cursor() as c:
+                while True:
+                    c.execute(f"SELECT {cols_sql} FROM {tabla} WHERE id > %s ORDER BY id LIMIT %s", (ultimo, batch_size))
+                    rows = c.fetchall()
+                    if not rows:
+                        break
+                    for r in rows:
+                        w.writerow([_csv_valor(r[col]) for col in cols])
+                    total += len(rows)
+                    ultimo = rows[-1]["id"]
+        conn.commit()
+    finally:
+        conn.close()
+    os.replace(tmp, destino)
+    return total
+
+
+def _csv_valor(v: Any) -> Any:
+    return v.strftime("%Y-%m-%d %H:%M:%S") if isinstance(v, datetime) else v
+
+
+def _faltantes(tabla: str) -> int:
+    conn = get_conn()
+    try:
+        with conn.cursor() as c:
+            c.execute(f"SELECT COUNT(*) AS n FROM {tabla} t LEFT JOIN {ARCHIVE_TABLE} a ON a.id=t.id WHERE a.id IS NULL")
+            n = int(c.fetchone()["n"])
+        conn.commit()
+    finally:
+        conn.close()
+    return n
+
+
+def archivar(retencion_meses: int = COMPRAS_RETENCION_MESES, archive_dir: str = COMPRAS_ARCHIVE_DIR,
+             batch_size: int = 500, sleep_sec: float = 0.2, dry_run: bool = False,
+             progress: Optional[Progress] = None, hoy: Optional[date] = None) -> int:
+    """Saca de `compras` los meses anteriores a la retención. Devuelve las filas archivadas."""
+    if retencion_meses <= 0:
+        return 0
+    hoy = hoy or date.today()
+    corte = sumar_meses(_mes(hoy), -retencion_meses)
+    conn = get_conn()
+    try:
+        with conn.cursor() as c:
+            nombres = particiones(c)
+            pendientes = _tablas_pendientes(c)
+        conn.commit()
+    finally:
+        conn.close()
+    viejas: List[Tuple[str, date]] = [
+        (p, m) for p, m in ((p, _mes_de(p)) for p in nombres) if m is not None and m < corte
+    ]
+    # nunca dejar la tabla sin particiones de meses
+    if viejas and len(viejas) == len([p for p in nombres if p != "pmax"]):
+        viejas = viejas[:-1]
+    if dry_run:
+        if progress:
+            for p, _ in viejas:
+                progress(f"archivar {p} (dry-run)", 0, 0)
+            for t in pendientes:
+                progress(f"retomar {t} (dry-run)", 0, 0)
+        return 0
+
+    if not archive_dir:
+        _ensure_archive_table()
+    # 1) separar las particiones (instantáneo: intercambio de metadatos)
+    for p, _ in viejas:
+        _exec(f"ALTER TABLE compras CONVERT PARTITION {p} TO TABLE compras_{p}", False, None, "compras")
+        pendientes.append(f"compras_{p}")
+    # 2) copiar cada mes fuera de la ruta caliente y borrar la tabla temporal
+    total = 0
+    for tabla in sorted(set(pendientes)):
+        if archive_dir:
+            n = _copiar_a_archivo(tabla, Path(archive_dir) / f"{tabla}.csv.gz", batch_size)
+        else:
+            n = _copiar_a_tabla(tabla, batch_size, sleep_sec)
+            faltan = _faltantes(tabla)
+            if faltan:
+                raise RuntimeError(f"{tabla}: {faltan} filas sin copiar a {ARCHIVE_TABLE}; no se borra")
+        _exec(f"DROP TABLE {tabla}", False, None, tabla)
+        total += n
+        if progress:
+            progress(f"{tabla} archivada", n, total)
+    return total
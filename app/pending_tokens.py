@@ -0,0 +1,129 @@
+import os
+import io
+import csv
+import atexit
+import threading
+import time
+import logging
+from collections import deque
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Deque, Dict, List, Optional, Tuple
+
+try:  # flock solo existe en POSIX (VM1 es Linux)
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
+logger = logging.getLogger("tienda-api")
+
+PENDING_TOKENS_DIR = os.getenv(
+    "PENDING_TOKENS_DIR",
+    str(Path(__file__).resolve().parent.parent / "docs" / "db"),
+)
+PENDING_TOKENS_FLUSH_SEC = float(os.getenv("PENDING_TOKENS_FLUSH_SEC", "1"))
+# Filas en memoria como máximo; al llenarse, quien escribe vacía el buffer él mismo
+PENDING_TOKENS_BUFFER_MAX = int(os.getenv("PENDING_TOKENS_BUFFER_MAX", "1000"))
+
+Row = Tuple[datetime, str, str]
+
+
+class PendingTokenWriter:
+    """Log append-only de tokens pendientes con un único escritor por proceso.
+
+    Las filas se acumulan en un buffer acotado y un hilo las vuelca cada
+    PENDING_TOKENS_FLUSH_SEC en una sola escritura por archivo diario
+    (`pending_reset_tokens_YYYYMMDD.csv`, según la fecha UTC de cada fila).
+    Cada volcado toma `flock` exclusivo sobre el archivo, así que varios
+    workers pueden escribir sin intercalar filas, y termina con fsync.
+    """
+
+    def __init__(self, outdir: str = PENDING_TOKENS_DIR, flush_sec: float = PENDING_TOKENS_FLUSH_SEC,
+                 buffer_max: int = PENDING_TOKENS_BUFFER_MAX):
+        self.outdir = Path(outdir)
+        self.flush_sec = flush_sec
+        self.buffer_max = max(1, buffer_max)
+        self._buf: Deque[Row] = deque()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    def append(self, to_email: str, token: str) -> None:
+        now = datetime.now(timezone.utc)
+        with self._lock:
+            self._buf.append((now, to_email, token))
+            full = len(self._buf) >= self.buffer_max
+        if full:
+            # buffer lleno: volcar en el hilo de la petición (contrapresión)
+            self.flush()
+        else:
+            self._ensure_started()
+
+    def flush(self) -> None:
+        """Vuelca el buffer a disco (una escritura + fsync por archivo diario)."""
+        with self._flush_lock:
+            with self._lock:
+                rows = list(self._buf)
+                self._buf.clear()
+            if not rows:
+                return
+            by_day: Dict[str, List[Row]] = {}
+            for r in rows:
+                by_day.setdefault(r[0].strftime("%Y%m%d"), []).append(r)
+            self.outdir.mkdir(parents=True, exist_ok=True)
+            for day, day_rows in by_day.items():
+                try:
+                    self._write(day, day_rows)
+                except Exception:
+                    logger.exception("No se pudieron volcar %d tokens pendientes", len(day_rows))
+                    with self._lock:
+                        # devolver al buffer para reintentar en el próximo volcado,
+                        # sin superar el tope de memoria (se descartan las más viejas)
+                        self._buf.extendleft(reversed(day_rows))
+                        dropped = len(self._buf) - self.buffer_max
+                        for _ in range(max(0, dropped)):
+                            self._buf.popleft()
+                    if dropped > 0:
+                        logger.error("Buffer de tokens pendientes lleno: %d filas descartadas", dropped)
+
+    def _write(self, day: str, rows: List[Row]) -> None:
+        buf = io.StringIO()
+        writer = csv.writer(buf)
+        for ts, email, token in rows:
+            writer.writerow([ts.isoformat(), email, token])
+        data = buf.getvalue().encode("utf-8")
+        fname = self.outdir / f"pending_reset_tokens_{day}.csv"
+        # token no se guarda en claro en BD, aquí queda como último recurso para operador
+        fd = os.open(fname, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        try:
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                os.write(fd, data)
+                os.fsync(fd)
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(fd, fcntl.LOCK_UN)
+        finally:
+            os.close(fd)
+
+    def _ensure_started(self) -> None:
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="pending-tokens", daemon=True)
+                self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            time.sleep(self.flush_sec)
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Error en el volcado de tokens pendientes")
+
+
+# Instancia compartida del proceso; se vacía al salir
+pending_tokens = PendingTokenWriter()
+atexit.register(pending_tokens.flush)
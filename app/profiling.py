@@ -0,0 +1,267 @@
+"""Perfilado bajo demanda del proceso en producción (endpoints /internal/profile/*).
+
+- `sampler`: profiler de muestreo. Un hilo lee `sys._current_frames()` cada
+  pocos ms y cuenta las pilas; el resultado sale en formato "collapsed stacks"
+  (una línea `marco;marco;marco N`), directo para flamegraph.pl o speedscope.
+- Perfilado por petición: las peticiones con la cabecera PROFILE_HEADER se
+  ejecutan bajo cProfile (ver `ProfiledRoute`) y el informe queda en
+  `request_profiles`. Solo una a la vez por proceso; las demás se atienden sin
+  perfilar.
+- `memory`: snapshots de tracemalloc y diferencia con el anterior.
+"""
+import io
+import os
+import asyncio
+import functools
+import sys
+import time
+import cProfile
+import pstats
+import secrets
+import threading
+import tracemalloc
+import itertools
+from collections import Counter, OrderedDict
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, List, Optional
+
+from fastapi.routing import APIRoute
+
+PROFILE_HEADER = "X-Debug-Profile"
+# Secreto que habilita la cabecera fuera de loopback; vacío = solo loopback
+PROFILE_TOKEN = os.getenv("PROFILE_TOKEN", "")
+# Tope de duración de una sesión de muestreo (se detiene sola)
+PROFILE_MAX_SEC = float(os.getenv("PROFILE_MAX_SEC", "300"))
+_REQUEST_PROFILES_MAX = 20
+_LOOPBACK = ("127.0.0.1", "::1", "localhost")
+
+
+# ----------------------------
+# Profiler de muestreo
+# ----------------------------
+class SamplingProfiler:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stacks: Counter = Counter()
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self._interval = 0.01
+        self._started_at = 0.0
+        self._samples = 0
+
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, interval_ms: float = 10.0, seconds: float = 60.0) -> bool:
+        """Arranca una sesión nueva; devuelve False si ya había una en curso."""
+        with self._lock:
+            if self.running():
+                return False
+            self._stacks = Counter()
+            self._samples = 0
+            self._interval = max(0.001, interval_ms / 1000.0)
+            self._started_at = time.monotonic()
+            self._stop.clear()
+            deadline = self._started_at + min(seconds, PROFILE_MAX_SEC)
+            self._thread = threading.Thread(target=self._run, args=(deadline,), name="sampling-profiler", daemon=True)
+            self._thread.start()
+            return True
+
+    def stop(self) -> str:
+        """Detiene la sesión (si sigue activa) y devuelve las pilas en formato collapsed."""
+        self._stop.set()
+        t = self._thread
+        if t is not None:
+            t.join(5.0)
+        return self.collapsed()
+
+    def collapsed(self) -> str:
+        with self._lock:
+            items = sorted(self._stacks.items(), key=lambda kv: -kv[1])
+        return "".join(f"{stack} {n}\n" for stack, n in items)
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            "running": self.running(),
+            "interval_ms": round(self._interval * 1000.0, 3),
+            "samples": self._samples,
+            "stacks": len(self._stacks),
+            "elapsed_sec": round(time.monotonic() - self._started_at, 1) if self._started_at else 0.0,
+        }
+
+    def _run(self, deadline: float) -> None:
+        me = threading.get_ident()
+        names = {}
+        while not self._stop.is_set() and time.monotonic() < deadline:
+            frames = sys._current_frames()
+            if len(names) != threading.active_count():
+                names = {t.ident: t.name for t in threading.enumerate()}
+            with self._lock:
+                for ident, frame in frames.items():
+                    if ident == me:
+                        continue
+                    self._stacks[_collapse(names.get(ident, str(ident)), frame)] += 1
+                self._samples += 1
+            self._stop.wait(self._interval)
+
+
+def _collapse(thread_name: str, frame) -> str:
+    parts: List[str] = []
+    while frame is not None:
+        code = frame.f_code
+        parts.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+        frame = frame.f_back
+    parts.append(thread_name)
+    parts.reverse()
+    # ';' separa marcos; el conteo va tras el último espacio (formato de py-spy)
+    return ";".join(p.replace(";", ":") for p in parts)
+
+
+# ----------------------------
+# cProfile por petición
+# ----------------------------
+_request_profiler: ContextVar[Optional[cProfile.Profile]] = ContextVar("request_profiler", default=None)
+_profile_ids = itertools.count(1)
+_profiles_lock = threading.Lock()
+# Un solo cProfile activo por proceso: en Python 3.12 (sys.monitoring) un segundo
+# enable() falla con "Another profiling tool is already active". Además el perfil
+# no aísla la petición: en un handler async incluye las otras corrutinas que el
+# loop ejecuta entre sus await (y en 3.12 el trabajo de otros hilos); con uno a
+# la vez al menos no se mezclan dos perfiles.
+_cprofile_busy = threading.Lock()
+request_profiles: "OrderedDict[int, Dict[str, Any]]" = OrderedDict()
+
+
+def profile_allowed(client_ip: str, header_value: Optional[str]) -> bool:
+    if not header_value:
+        return False
+    if client_ip in _LOOPBACK:
+        return True
+    return bool(PROFILE_TOKEN) and secrets.compare_digest(header_value, PROFILE_TOKEN)
+
+
+def begin_request_profile() -> Any:
+    """Activa cProfile para la petición actual; devuelve el token para `end_request_profile`,
+    o None si ya hay otra petición perfilándose (no se espera: se atiende sin perfil)."""
+    if not _cprofile_busy.acquire(blocking=False):
+        return None
+    return _request_profiler.set(cProfile.Profile())
+
+
+def end_request_profile(token: Any, method: str, path: str, dur_ms: int) -> int:
+    """Guarda el informe de la petición y devuelve su id."""
+    prof = _request_profiler.get()
+    _request_profiler.reset(token)
+    _cprofile_busy.release()
+    out = io.StringIO()
+    if prof is not None:
+        try:
+            pstats.Stats(prof, stream=out).sort_stats("cumulative").print_stats(40)
+        except TypeError:
+            # sin datos: el handler no pasó por ProfiledRoute (p. ej. estáticos)
+            out.write("Sin datos de perfil para esta ruta\n")
+    pid = next(_profile_ids)
+    with _profiles_lock:
+        request_profiles[pid] = {"id": pid, "method": method, "path": path, "ms": dur_ms,
+                                 "ts": time.time(), "report": out.getvalue()}
+        while len(request_profiles) > _REQUEST_PROFILES_MAX:
+            request_profiles.popitem(last=False)
+    return pid
+
+
+def list_request_profiles() -> List[Dict[str, Any]]:
+    with _profiles_lock:
+        return [{k: v for k, v in p.items() if k != "report"} for p in request_profiles.values()]
+
+
+def get_request_profile(pid: int) -> Optional[str]:
+    with _profiles_lock:
+        p = request_profiles.get(pid)
+    return p["report"] if p else None
+
+
+def _profiled(call: Callable) -> Callable:
+    # El handler sync corre en el threadpool; cProfile solo ve el hilo en el que
+    # está activo, por eso se activa aquí y no en el middleware.
+    if asyncio.iscoroutinefunction(call):
+        @functools.wraps(call)
+        async def async_wrapper(*args, **kwargs):
+            prof = _request_profiler.get()
+            if prof is None:
+                return await call(*args, **kwargs)
+            prof.enable()
+            try:
+                return await call(*args, **kwargs)
+            finally:
+                prof.disable()
+        return async_wrapper
+
+    @functools.wraps(call)
+    def wrapper(*args, **kwargs):
+        prof = _request_profiler.get()
+        if prof is None:
+            return call(*args, **kwargs)
+        return prof.runcall(call, *args, **kwargs)
+    return wrapper
+
+
+class ProfiledRoute(APIRoute):
+    """APIRoute cuyo endpoint se ejecuta bajo el cProfile de la petición, si lo hay."""
+
+    def get_route_handler(self):
+        if self.dependant.call is not None and not getattr(self.dependant.call, "_profiled", False):
+            self.dependant.call = _profiled(self.dependant.call)
+            self.dependant.call._profiled = True
+        return super().get_route_handler()
+
+
+# ----------------------------
+# tracemalloc
+# ----------------------------
+class MemoryProfiler:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._last: Optional[tracemalloc.Snapshot] = None
+
+    def start(self, frames: int = 10) -> None:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+
+    def stop(self) -> None:
+        with self._lock:
+            self._last = None
+        tracemalloc.stop()
+
+    def snapshot(self, top: int = 20) -> Dict[str, Any]:
+        """Snapshot actual; si hay uno previo, incluye el top de crecimiento respecto a él."""
+        if not tracemalloc.is_tracing():
+            raise RuntimeError("tracemalloc no está activo")
+        snap = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        ))
+        current, peak = tracemalloc.get_traced_memory()
+        result: Dict[str, Any] = {
+            "traced_kb": round(current / 1024, 1),
+            "peak_kb": round(peak / 1024, 1),
+            "top": [_stat_dict(s) for s in snap.statistics("lineno")[:top]],
+        }
+        with self._lock:
+            if self._last is not None:
+                result["diff"] = [_stat_dict(s) for s in snap.compare_to(self._last, "lineno")[:top]]
+            self._last = snap
+        return result
+
+
+def _stat_dict(stat) -> Dict[str, Any]:
+    frame = stat.traceback[0]
+    d = {"where": f"{frame.filename}:{frame.lineno}", "size_kb": round(stat.size / 1024, 1), "count": stat.count}
+    if hasattr(stat, "size_diff"):
+        d["size_diff_kb"] = round(stat.size_diff / 1024, 1)
+        d["count_diff"] = stat.count_diff
+    return d
+
+
+# Instancias compartidas del proceso
+sampler = SamplingProfiler()
+memory = MemoryProfiler()
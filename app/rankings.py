@@ -0,0 +1,272 @@
+import os
+import threading
+import logging
+from bisect import bisect_left, insort
+from datetime import date, timedelta
+from typing import Any, Dict, Hashable, List, Optional, Tuple
+
+from .db import get_conn, schema_has
+from .filas import tuplas
+from .group_commit import writer
+from .outbox import compras_externas, dispatcher
+
+logger = logging.getLogger("tienda-api")
+
+# Días de historia que se mantienen con ranking por día (los acumulados
+# globales y por categoría no se recortan).
+RANKING_DAYS = int(os.getenv("RANKING_DAYS", "120"))
+
+SIN_CATEGORIA = ""
+
+
+class _Ranking:
+    """Contador con orden descendente mantenido: top-k en O(k).
+
+    `_order` guarda tuplas (-valor, clave) ordenadas; cada actualización quita
+    la entrada anterior e inserta la nueva con bisect.
+    """
+    __slots__ = ("values", "_order")
+
+    def __init__(self):
+        self.values: Dict[Hashable, float] = {}
+        self._order: List[Tuple[float, Hashable]] = []
+
+    def add(self, key: Hashable, delta: float) -> None:
+        old = self.values.get(key)
+        if old is not None:
+            i = bisect_left(self._order, (-old, key))
+            del self._order[i]
+        new = (old or 0) + delta
+        self.values[key] = new
+        insort(self._order, (-new, key))
+
+    def top(self, k: int) -> List[Tuple[Hashable, float]]:
+        return [(key, -neg) for neg, key in self._order[:k]]
+
+
+class _Scope:
+    """Rankings de un ámbito (global, un día, una categoría, día+categoría)."""
+    __slots__ = ("prod_unidades", "prod_monto", "prod_compras", "cat_unidades", "cat_monto", "cat_compras")
+
+    def __init__(self):
+        self.prod_unidades = _Ranking()
+        self.prod_monto = _Ranking()
+        self.prod_compras: Dict[int, int] = {}
+        self.cat_unidades = _Ranking()
+        self.cat_monto = _Ranking()
+        self.cat_compras: Dict[str, int] = {}
+
+    def add(self, producto_id: int, categoria: str, compras: int, unidades: int, monto: float) -> None:
+        self.prod_unidades.add(producto_id, unidades)
+        self.prod_monto.add(producto_id, monto)
+        self.prod_compras[producto_id] = self.prod_compras.get(producto_id, 0) + compras
+        self.cat_unidades.add(categoria, unidades)
+        self.cat_monto.add(categoria, monto)
+        self.cat_compras[categoria] = self.cat_compras.get(categoria, 0) + compras
+
+
+class VentasRankings:
+    """Agregados de ventas mantenidos incrementalmente.
+
+    Se alimenta con las filas confirmadas por el escritor de group commit y se
+    puede reconstruir desde `compras`. Las lecturas top-k son O(k).
+    Las compras incrementales usan el precio de la compra; la reconstrucción,
+    igual que /admin/ventas/resumen, usa el precio actual de `productos`.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        # Una sola reconstrucción a la vez: dos en paralelo se vaciarían `_pending`
+        # y `_reset()` una a la otra, perdiendo compras
+        self._load_lock = threading.Lock()
+        self._loaded = False
+        self._rebuilding = False
+        self._pending: List[Dict[str, Any]] = []
+        self._reset()
+
+    def _reset(self) -> None:
+        self._global = _Scope()
+        self._by_day: Dict[date, _Scope] = {}
+        self._by_cat: Dict[str, _Scope] = {}
+        self._by_day_cat: Dict[Tuple[date, str], _Scope] = {}
+        self._productos: Dict[int, Tuple[str, str]] = {}  # id -> (nombre, categoria)
+
+    # -- Alimentación --
+    def _add(self, producto_id: int, dia: date, compras: int, unidades: int, monto: float) -> None:
+        categoria = self._productos.get(producto_id, ("", SIN_CATEGORIA))[1]
+        self._global.add(producto_id, categoria, compras, unidades, monto)
+        self._by_cat.setdefault(categoria, _Scope()).add(producto_id, categoria, compras, unidades, monto)
+        if dia >= date.today() - timedelta(days=RANKING_DAYS):
+            self._by_day.setdefault(dia, _Scope()).add(producto_id, categoria, compras, unidades, monto)
+            self._by_day_cat.setdefault((dia, categoria), _Scope()).add(producto_id, categoria, compras, unidades, monto)
+
+    def on_commit(self, rows: List[Dict[str, Any]]) -> None:
+        """Listener post-commit: aplica las compras recién confirmadas."""
+        with self._lock:
+            if self._rebuilding:
+                self._pending.extend(rows)
+                return
+            if not self._loaded:
+                # se incluirán en la reconstrucción inicial
+                return
+            missing = {r["producto_id"] for r in rows if r["producto_id"] not in self._productos}
+        if missing:
+            self._load_productos(missing)
+        with self._lock:
+            for r in rows:
+                self._add(r["producto_id"], r["fecha"].date(), 1, r["cantidad"], r["cantidad"] * r["precio"])
+            self._prune()
+
+    def _load_productos(self, ids: Optional[set] = None) -> None:
+        has_categoria = schema_has("productos", "categoria")
+        cols = "id, nombre" + (", categoria" if has_categoria else "")
+        sql = f"SELECT {cols} FROM productos"
+        args: List[Any] = []
+        if ids:
+            sql += " WHERE id IN (" + ",".join(["%s"] * len(ids)) + ")"
+            args = list(ids)
+        conn = get_conn(read=True)
+        try:
+            with conn.cursor() as c:
+                c.execute(sql, args)
+                rows = c.fetchall()
+            conn.commit()
+        finally:
+            conn.close()
+        with self._lock:
+            for r in rows:
+                self._productos[r["id"]] = (r["nombre"], r.get("categoria") or SIN_CATEGORIA)
+
+    def _prune(self) -> None:
+        limite = date.today() - timedelta(days=RANKING_DAYS)
+        for d in [d for d in self._by_day if d < limite]:
+            del self._by_day[d]
+        for key in [k for k in self._by_day_cat if k[0] < limite]:
+            del self._by_day_cat[key]
+
+    def rebuild(self) -> int:
+        """Reconstruye todos los agregados desde `compras`. Devuelve nº de compras.
+
+        Las compras confirmadas durante la reconstrucción se guardan aparte y se
+        aplican al final si su id es mayor que el máximo leído.
+        """
+        with self._load_lock:
+            return self._rebuild()
+
+    def _rebuild(self) -> int:
+        with self._lock:
+            self._rebuilding = True
+            self._pending = []
+        try:
+            # Primario: MAX(id) debe ser coherente con el flujo de commits del escritor
+            conn = get_conn()
+            try:
+                # Una fila por (producto, día) de todo el histórico: tuplas desempaquetadas por posición
+                with tuplas(conn) as c:
+                    c.execute("SELECT COALESCE(MAX(id),0) FROM compras")
+                    max_id = int(c.fetchone()[0])
+                    c.execute(
+                        """
+                        SELECT c.producto_id, DATE(c.fecha) AS f, COUNT(*) AS compras,
+                               COALESCE(SUM(c.cantidad),0) AS unidades,
+                               COALESCE(SUM(c.cantidad*p.precio),0) AS monto
+                        FROM compras c
+                        JOIN productos p ON p.id=c.producto_id
+                        WHERE c.id <= %s
+                        GROUP BY c.producto_id, DATE(c.fecha)
+                        """,
+                        (max_id,),
+                    )
+                    rows = c.fetchall()
+                conn.commit()
+            finally:
+                conn.close()
+            with self._lock:
+                self._reset()
+            self._load_productos()
+            with self._lock:
+                total = 0
+                for producto_id, f, compras, unidades, monto in rows:
+                    self._add(producto_id, f, int(compras), int(unidades), float(monto))
+                    total += int(compras)
+                for r in self._pending:
+                    if r["id"] > max_id:
+                        self._add(r["producto_id"], r["fecha"].date(), 1, r["cantidad"], r["cantidad"] * r["precio"])
+                        total += 1
+                self._loaded = True
+                return total
+        finally:
+            with self._lock:
+                self._rebuilding = False
+                self._pending = []
+
+    def ensure_loaded(self) -> None:
+        if self._loaded:
+            return
+        # las peticiones que llegan durante la carga inicial esperan a esa misma carga
+        with self._load_lock:
+            if not self._loaded:
+                self._rebuild()
+
+    # -- Lecturas --
+    def _scope(self, dia: Optional[date], categoria: Optional[str]) -> Optional[_Scope]:
+        if dia and categoria is not None:
+            return self._by_day_cat.get((dia, categoria))
+        if dia:
+            return self._by_day.get(dia)
+        if categoria is not None:
+            return self._by_cat.get(categoria)
+        return self._global
+
+    def top_productos(self, k: int, por: str = "unidades", dia: Optional[date] = None,
+                      categoria: Optional[str] = None) -> List[Dict[str, Any]]:
+        self.ensure_loaded()
+        with self._lock:
+            sc = self._scope(dia, categoria)
+            if sc is None:
+                return []
+            primary = sc.prod_monto if por == "monto" else sc.prod_unidades
+            out = []
+            for pid, _ in primary.top(k):
+                nombre, cat = self._productos.get(pid, ("", SIN_CATEGORIA))
+                out.append({
+                    "producto_id": pid,
+                    "nombre": nombre or None,
+                    "categoria": cat or None,
+                    "compras": sc.prod_compras.get(pid, 0),
+                    "unidades": int(sc.prod_unidades.values.get(pid, 0)),
+                    "monto_total": round(float(sc.prod_monto.values.get(pid, 0.0)), 2),
+                })
+            return out
+
+    def top_categorias(self, k: int, por: str = "unidades", dia: Optional[date] = None) -> List[Dict[str, Any]]:
+        self.ensure_loaded()
+        with self._lock:
+            sc = self._scope(dia, None)
+            if sc is None:
+                return []
+            primary = sc.cat_monto if por == "monto" else sc.cat_unidades
+            return [
+                {
+                    "categoria": cat or None,
+                    "compras": sc.cat_compras.get(cat, 0),
+                    "unidades": int(sc.cat_unidades.values.get(cat, 0)),
+                    "monto_total": round(float(sc.cat_monto.values.get(cat, 0.0)), 2),
+                }
+                for cat, _ in primary.top(k)
+            ]
+
+
+# Instancia compartida del proceso, alimentada por cada lote confirmado
+rankings = VentasRankings()
+writer.add_listener(rankings.on_commit)
+
+
+def _compras_de_otros_workers(eventos: List[Dict[str, Any]]) -> None:
+    rows = compras_externas(eventos)
+    if rows:
+        rankings.on_commit(rows)
+
+
+# Compras de otros workers (outbox): sin esto cada proceso solo ve las suyas hasta un rebuild
+dispatcher.subscribe(_compras_de_otros_workers)
@@ -1,42 +1,55 @@
 import csv
 import io
+import json
 import math
 import time
+import asyncio
 from datetime import datetime, date, timedelta
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Literal, Tuple
 
 import jwt  # PyJWT
-from fastapi import APIRouter, HTTPException, Query, Depends, Request
-from fastapi.responses import StreamingResponse
+from fastapi import APIRouter, HTTPException, Query, Depends, Request, Response
+from fastapi.responses import StreamingResponse, PlainTextResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+from starlette.concurrency import run_in_threadpool
 import logging
 
 from .db import (
     get_conn,
+    mark_write,
     schema_has,
     DBError,
     DBOperationalError,
     DBIntegrityError,
     DBProgrammingError,
+    db_timeout_status,
     JWT_SECRET,
     JWT_EXPIRE_MIN,
+    REFRESH_EXPIRE_DAYS,
     create_user,
     get_user_by_email,
     get_user_by_id,
     ensure_schema,
     create_password_reset_token,
     consume_password_reset_token,
+    create_refresh_token,
+    rotate_refresh_token,
+    revoke_refresh_token,
 )
 from .models import (
     CompraRequest,
     CompraResponse,
     Producto,
     ProductosResponse,
+    ProductosBatchRequest,
+    ProductosBatchResponse,
+    ProductosChangesResponse,
     CheckoutRequest,
     CheckoutResponse,
     CheckoutResultItem,
     RegisterRequest,
     LoginRequest,
+    RefreshRequest,
     TokenResponse,
     MeResponse,
     PasswordResetRequest,
@@ -44,15 +57,47 @@ from .models import (
     FechaFiltro,
     VentasResumen,
     VentasSerie,
-    SerieItem,
+    VentasTopProductos,
+    VentasCategorias,
+    VentasCrossTab,
+    VentasMediaMovil,
+    CartQuoteRequest,
+    CartQuoteResponse,
     StatsResponse,
 )
-from .metrics import APP_START_TIME, get_latency_percentiles, latency_store
-
-router = APIRouter()
+from .metrics import APP_START_TIME, get_latency_percentiles, latency_store, latency_snapshot, metrics_snapshot, incr
+from .group_commit import registrar_compras, CompraSinConfirmar, ProductoNoEncontrado, StockInsuficiente
+from .rankings import rankings
+from .cache import cache
+from .mailer import mail_queue, smtp_configured
+from .singleflight import catalog_flight, singleflight_snapshot
+from .catalogo import productos_por_ids, producto_select, cotizar, MAX_IDS_BATCH, PRODUCTO_JSON
+from .filas import tuplas
+from .analytics import analytics
+from .stream import broadcaster
+from .cambios import cambios_desde, MarcaInvalida, MarcaExpirada
+from .outbox import dispatcher as outbox, leer_desde
+from .ventas_serie import serie_cache, elegir_granularidad, agrupar
+from .admission import admission
+from .access_log import access_log
+from .breaker import db_breaker, last_good, CircuitOpenError
+from .profiling import ProfiledRoute, sampler, memory, list_request_profiles, get_request_profile
+
+router = APIRouter(route_class=ProfiledRoute)
 logger = logging.getLogger("tienda-api")
 
 
+# Util: filtro de fechas como rango semiabierto sobre la columna (sin DATE(col)),
+# así se usan el índice de fecha y la poda de particiones de `compras`
+def fecha_where(from_date: Optional[date], to_date: Optional[date], col: str = "c.fecha") -> Tuple[List[str], List[Any]]:
+    where: List[str] = []
+    args: List[Any] = []
+    if from_date:
+        where.append(f"{col} >= %s"); args.append(from_date)
+    if to_date:
+        where.append(f"{col} < %s"); args.append(to_date + timedelta(days=1))
+    return where, args
+
 # Util: validación de rangos de fecha (from/to)
 def validate_from_to(from_date: Optional[date], to_date: Optional[date]) -> None:
     if from_date and to_date and from_date > to_date:
@@ -98,10 +143,23 @@ def get_current_user(creds: Optional[HTTPAuthorizationCredentials] = Depends(sec
         raise HTTPException(status_code=401, detail="Falta token")
     data = decode_jwt(creds.credentials)
     uid = int(data["sub"])
-    user = get_user_by_id(uid)
+    # Principal cacheado solo en memoria; se invalida al registrar o resetear contraseña
+    user = cache.get_or_set(("usuario", uid), lambda: _load_principal(uid), ttl=60,
+                            tags=("usuarios", f"usuario:{uid}"), local_only=True)
     if not user:
         raise HTTPException(status_code=401, detail="Usuario no existe")
-    return {"id": user["id"], "email": user["email"], "nombre": user["nombre"], "rol": user["rol"]}
+    return user
+
+def _load_principal(uid: int) -> Optional[Dict[str, Any]]:
+    user = get_user_by_id(uid)
+    if not user:
+        return None
+    return {"id": user["id"], "email": user["email"], "nombre": user["nombre"], "rol": user["rol"],
+            "password_reset_required": bool(user.get("password_reset_required"))}
+
+def _token_response(uid: int, email: str, rol: str, refresh_token: str) -> Dict[str, Any]:
+    return {"access_token": create_jwt(uid, email, rol), "expires_in": JWT_EXPIRE_MIN * 60, "token_type": "bearer",
+            "refresh_token": refresh_token, "refresh_expires_in": REFRESH_EXPIRE_DAYS * 86400}
 
 def require_admin(user=Depends(get_current_user)):
     if user["rol"] != "admin":
@@ -133,7 +191,7 @@ def register(payload: RegisterRequest):
         raise HTTPException(status_code=400, detail="Solicitud inválida (SQL)") from e
     except (DBOperationalError, DBError) as e:
         logger.exception("Error operativo de la base de datos en /register")
-        raise HTTPException(status_code=500, detail="Error interno de base de datos") from e
+        raise db_http_error(e) from e
 
 @router.post("/login", response_model=TokenResponse, tags=["auth"])
 def login(payload: LoginRequest, request: Request):
@@ -148,8 +206,41 @@ def login(payload: LoginRequest, request: Request):
     from .db import verify_password
     if not verify_password(payload.password, user["password_hash"], user["salt"]):
         raise HTTPException(status_code=401, detail="Credenciales inválidas")
-    token = create_jwt(user["id"], user["email"], user["rol"])
-    return {"access_token": token, "expires_in": JWT_EXPIRE_MIN * 60, "token_type": "bearer"}
+    try:
+        refresh = create_refresh_token(user["id"])
+    except (DBOperationalError, DBError) as e:
+        raise db_http_error(e) from e
+    return _token_response(user["id"], user["email"], user["rol"], refresh)
+
+@router.post("/token/refresh", response_model=TokenResponse, tags=["auth"])
+def token_refresh(payload: RefreshRequest):
+    """Renueva el access token con un refresh token (que se rota: el anterior deja de valer).
+
+    Sin PBKDF2: un SHA-256, una fila por índice único y el principal cacheado.
+    """
+    try:
+        rotado = rotate_refresh_token(payload.refresh_token)
+    except (DBOperationalError, DBError) as e:
+        raise db_http_error(e) from e
+    if not rotado:
+        raise HTTPException(status_code=401, detail="Refresh token inválido o expirado")
+    uid = rotado["user_id"]
+    user = cache.get_or_set(("usuario", uid), lambda: _load_principal(uid), ttl=60,
+                            tags=("usuarios", f"usuario:{uid}"), local_only=True)
+    if not user:
+        raise HTTPException(status_code=401, detail="Usuario no existe")
+    if user.get("password_reset_required"):
+        raise HTTPException(status_code=403, detail="password_reset_required: debe restablecer su contraseña")
+    return _token_response(uid, user["email"], user["rol"], rotado["refresh_token"])
+
+@router.post("/logout", tags=["auth"])
+def logout(payload: RefreshRequest):
+    # Revoca la sesión (toda la cadena de rotaciones); el access token vence solo
+    try:
+        revoke_refresh_token(payload.refresh_token)
+    except (DBOperationalError, DBError) as e:
+        raise db_http_error(e) from e
+    return {"ok": True}
 
 
 @router.post("/request-password-reset", tags=["auth"])
@@ -165,15 +256,14 @@ def request_password_reset(payload: PasswordResetRequest):
         return {"ok": True}
     # crear token (se guarda hashed en BD)
     token = create_password_reset_token(user['id'])
-    # intentar enviar por SMTP; si falla, devolver ok pero sin token (no exponer)
-    sent = False
-    try:
-        from .db import send_reset_email
-        sent = send_reset_email(user['email'], user.get('nombre', ''), token)
-    except Exception:
-        sent = False
-    if sent:
-        return {"ok": True}
+    # Con SMTP configurado solo se encola: el despachador de app/mailer.py envía
+    # en segundo plano (reintentos y fallback a CSV incluidos).
+    if smtp_configured():
+        try:
+            mail_queue.enqueue_reset(user['email'], user.get('nombre', ''), token)
+            return {"ok": True}
+        except Exception:
+            logger.exception("No se pudo encolar el email de reseteo")
     # fallback: si SMTP no configurado/dev, NO devolver token en la API
     # Escribir token en CSV en repo `docs/db/` para que un operador lo gestione manualmente.
     try:
@@ -198,13 +288,16 @@ def me(user=Depends(get_current_user)):
 
 # CATÁLOGO
 @router.get("/categorias", response_model=List[str], tags=["catalogo"])
-def categorias():
-    conn = get_conn()
+def categorias(response: Response):
+    return serve_or_stale("categorias", response,
+                          lambda: cache.get_or_set("categorias", _categorias_db, ttl=300, tags=("categorias",)))
+
+def _categorias_db() -> List[str]:
+    # Si la columna 'categoria' no existe en el esquema, devolver lista vacía
+    if not schema_has("productos", "categoria"):
+        return []
+    conn = get_conn(read=True)
     try:
-        # Si la columna 'categoria' no existe en el esquema, devolver lista vacía
-        if not schema_has("productos", "categoria"):
-            conn.close()
-            return []
         with conn.cursor() as c:
             c.execute("SELECT DISTINCT categoria FROM productos WHERE categoria IS NOT NULL AND categoria<>'' ORDER BY categoria ASC")
             rows = [r["categoria"] for r in c.fetchall()]
@@ -214,12 +307,39 @@ def categorias():
         conn.close()
 
 
-# Endpoint interno para chequeo de DB (no en docs)
-@router.get("/internal/db-check", include_in_schema=False, tags=["internal"])
-def _internal_db_check(request: Request, creds: Optional[HTTPAuthorizationCredentials] = Depends(security)):
-    """Chequeo interno: verifica conexión a la DB y devuelve lista de tablas.
-    Permite acceso desde loopback sin token; fuera de loopback requiere token de admin.
-    """
+def db_http_error(e: Exception) -> HTTPException:
+    """Traduce un error de BD a HTTP: circuito abierto o presupuesto agotado -> 503,
+    timeout del cliente -> 504, resto -> 500."""
+    if isinstance(e, CircuitOpenError):
+        return HTTPException(status_code=503, detail="Base de datos no disponible",
+                             headers={"Retry-After": str(db_breaker.retry_after())})
+    status = db_timeout_status(e)
+    if status == 503:
+        return HTTPException(status_code=503, detail="La consulta excedió el tiempo máximo", headers={"Retry-After": "5"})
+    if status == 504:
+        return HTTPException(status_code=504, detail="La base de datos no respondió a tiempo")
+    return HTTPException(status_code=500, detail="Error interno de base de datos")
+
+def serve_or_stale(key: Any, response: Response, loader):
+    """Ejecuta `loader` y guarda el resultado como último bueno; si la BD falla
+    (o el circuito está abierto) devuelve ese último resultado marcado como viejo."""
+    try:
+        value = loader()
+    except DBOperationalError as e:
+        hit = last_good.get(key)
+        if hit is None:
+            raise db_http_error(e) from e
+        value, age = hit
+        response.headers["X-Stale"] = "1"
+        response.headers["Warning"] = '110 - "Response is Stale"'
+        response.headers["Age"] = str(int(age))
+        incr("breaker.stale_served")
+        return value
+    last_good.put(key, value)
+    return value
+
+def require_internal_access(request: Request, creds: Optional[HTTPAuthorizationCredentials]) -> None:
+    """Guard de endpoints internos: loopback sin token; fuera de loopback requiere admin."""
     client_ip = request.client.host if request.client else "-"
     # If not loopback, require token and admin role
     if client_ip not in ("127.0.0.1", "::1", "localhost"):
@@ -231,6 +351,14 @@ def _internal_db_check(request: Request, creds: Optional[HTTPAuthorizationCreden
         if not user or user.get("rol") != "admin":
             raise HTTPException(status_code=403, detail="Requiere rol admin")
 
+# Endpoint interno para chequeo de DB (no en docs)
+@router.get("/internal/db-check", include_in_schema=False, tags=["internal"])
+def _internal_db_check(request: Request, creds: Optional[HTTPAuthorizationCredentials] = Depends(security)):
+    """Chequeo interno: verifica conexión a la DB y devuelve lista de tablas.
+    Permite acceso desde loopback sin token; fuera de loopback requiere token de admin.
+    """
+    require_internal_access(request, creds)
+
     conn = get_conn()
     try:
         with conn.cursor() as c:
@@ -245,11 +373,151 @@ def _internal_db_check(request: Request, creds: Optional[HTTPAuthorizationCreden
     finally:
         conn.close()
 
+# Endpoint interno de métricas (group commit, contadores, latencias)
+@router.get("/internal/metrics", include_in_schema=False, tags=["internal"])
+def _internal_metrics(request: Request, creds: Optional[HTTPAuthorizationCredentials] = Depends(security)):
+    require_internal_access(request, creds)
+    snap = metrics_snapshot()
+    snap["latency"] = latency_snapshot()
+    snap["cache"] = cache.stats()
+    snap["mail"] = mail_queue.stats()
+    snap["singleflight"] = singleflight_snapshot()
+    snap["admission"] = admission.stats()
+    snap["access_log"] = access_log.stats()
+    snap["db_breaker"] = db_breaker.stats()
+    snap["analytics"] = analytics.stats()
+    snap["sse"] = broadcaster.stats()
+    snap["outbox"] = outbox.stats()
+    return snap
+
+# Feed de cambios del outbox (consumidores externos: réplicas de caché, ETL, webhooks)
+@router.get("/internal/events", include_in_schema=False, tags=["internal"])
+async def _internal_events(
+    request: Request,
+    after: int = Query(0, ge=0, description="último id procesado por el consumidor"),
+    limit: int = Query(500, ge=1, le=1000),
+    wait: float = Query(0, ge=0, le=30, description="long-poll: segundos a esperar si no hay eventos"),
+    format: Literal["json", "ndjson"] = Query("json"),
+    creds: Optional[HTTPAuthorizationCredentials] = Depends(security),
+):
+    """Eventos con id > after, en orden. El consumidor guarda `next` y lo manda como `after`.
+
+    Lo reciente sale del buffer del dispatcher; un `after` más viejo se lee de la tabla.
+    """
+    await run_in_threadpool(require_internal_access, request, creds)
+    limite = time.monotonic() + wait
+    while True:
+        eventos = outbox.desde(after, limit)
+        if eventos is None or not outbox.stats()["running"]:
+            try:
+                eventos = await run_in_threadpool(leer_desde, after, limit)
+            except (DBOperationalError, DBError) as e:
+                raise db_http_error(e) from e
+            if outbox.stats()["running"]:
+                # no adelantarse a un hueco que el dispatcher todavía busca
+                eventos = [e for e in eventos if e["id"] <= outbox.safe_id]
+        if eventos or time.monotonic() >= limite or await request.is_disconnected():
+            break
+        await asyncio.sleep(0.1)
+    siguiente = eventos[-1]["id"] if eventos else after
+    if format == "ndjson":
+        body = "".join(json.dumps(e, separators=(",", ":")) + "\n" for e in eventos)
+        return Response(body, media_type="application/x-ndjson", headers={"X-Next-After": str(siguiente)})
+    return {"events": eventos, "next": siguiente}
+
+# Perfilado bajo demanda (mismo guard que /internal/db-check)
+@router.post("/internal/profile/start", include_in_schema=False, tags=["internal"])
+def _internal_profile_start(
+    request: Request,
+    interval_ms: float = Query(10.0, ge=1.0, le=1000.0),
+    seconds: float = Query(60.0, gt=0),
+    creds: Optional[HTTPAuthorizationCredentials] = Depends(security),
+):
+    require_internal_access(request, creds)
+    if not sampler.start(interval_ms=interval_ms, seconds=seconds):
+        raise HTTPException(status_code=409, detail="Ya hay un perfilado en curso")
+    return sampler.status()
+
+@router.get("/internal/profile/status", include_in_schema=False, tags=["internal"])
+def _internal_profile_status(request: Request, creds: Optional[HTTPAuthorizationCredentials] = Depends(security)):
+    require_internal_access(request, creds)
+    return sampler.status()
+
+@router.post("/internal/profile/stop", include_in_schema=False, tags=["internal"])
+def _internal_profile_stop(request: Request, creds: Optional[HTTPAuthorizationCredentials] = Depends(security)):
+    """Detiene el muestreo y descarga las pilas (collapsed, apto para flamegraph.pl / speedscope)."""
+    require_internal_access(request, creds)
+    data = sampler.stop()
+    fname = f"profile_{datetime.now().strftime('%Y%m%d_%H%M%S')}.collapsed"
+    return PlainTextResponse(data, headers={"Content-Disposition": f'attachment; filename="{fname}"'})
+
+@router.get("/internal/profile/requests", include_in_schema=False, tags=["internal"])
+def _internal_profile_requests(request: Request, creds: Optional[HTTPAuthorizationCredentials] = Depends(security)):
+    require_internal_access(request, creds)
+    return {"items": list_request_profiles()}
+
+@router.get("/internal/profile/requests/{pid}", include_in_schema=False, tags=["internal"])
+def _internal_profile_request(pid: int, request: Request, creds: Optional[HTTPAuthorizationCredentials] = Depends(security)):
+    require_internal_access(request, creds)
+    report = get_request_profile(pid)
+    if report is None:
+        raise HTTPException(status_code=404, detail="Perfil no encontrado")
+    return PlainTextResponse(report)
+
+@router.post("/internal/tracemalloc/start", include_in_schema=False, tags=["internal"])
+def _internal_tracemalloc_start(
+    request: Request,
+    frames: int = Query(10, ge=1, le=50),
+    creds: Optional[HTTPAuthorizationCredentials] = Depends(security),
+):
+    require_internal_access(request, creds)
+    memory.start(frames)
+    return {"ok": True}
+
+@router.post("/internal/tracemalloc/snapshot", include_in_schema=False, tags=["internal"])
+def _internal_tracemalloc_snapshot(
+    request: Request,
+    top: int = Query(20, ge=1, le=200),
+    creds: Optional[HTTPAuthorizationCredentials] = Depends(security),
+):
+    """Top de asignaciones actuales y, desde el segundo snapshot, el crecimiento respecto al anterior."""
+    require_internal_access(request, creds)
+    try:
+        return memory.snapshot(top)
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+
+@router.post("/internal/tracemalloc/stop", include_in_schema=False, tags=["internal"])
+def _internal_tracemalloc_stop(request: Request, creds: Optional[HTTPAuthorizationCredentials] = Depends(security)):
+    require_internal_access(request, creds)
+    memory.stop()
+    return {"ok": True}
+
 @router.get("/productos", response_model=ProductosResponse, tags=["catalogo"])
-def productos(page: int = Query(1, ge=1), size: int = Query(12, ge=1, le=100),
+def productos(response: Response, page: int = Query(1, ge=1), size: int = Query(12, ge=1, le=100),
               q: Optional[str] = None, cat: Optional[str] = None):
+    # La búsqueda es case-insensitive: normalizar q en la clave de caché
+    key = ("productos.json", page, size, q.lower() if q else None, cat)
+    # En un miss, las peticiones idénticas concurrentes esperan a una sola consulta;
+    # si la BD no responde se sirve la última página buena (X-Stale: 1)
+    body = serve_or_stale(key, response, lambda: cache.get_or_set(
+        key,
+        lambda: catalog_flight.do(key, lambda: _productos_db(page, size, q, cat)),
+        tags=("catalogo",),
+    ))
+    # Se cachea el cuerpo ya serializado: un hit no valida ni re-serializa `size` modelos
+    return json_crudo(body, response)
+
+def json_crudo(body: str, response: Response) -> Response:
+    """Respuesta con JSON ya serializado, conservando las cabeceras puestas en `response`."""
+    out = Response(body, media_type="application/json")
+    out.headers.update({k: v for k, v in response.headers.items() if k != "content-length"})
+    return out
+
+def _productos_db(page: int, size: int, q: Optional[str], cat: Optional[str]) -> str:
+    """Cuerpo JSON de ProductosResponse armado desde tuplas (sin dict ni modelo por fila)."""
     offset = (page - 1) * size
-    conn = get_conn()
+    conn = get_conn(read=True)
     try:
         where = []
         args: List[Any] = []
@@ -271,119 +539,181 @@ def productos(page: int = Query(1, ge=1), size: int = Query(12, ge=1, le=100),
 
         where_sql = (" WHERE " + " AND ".join(where)) if where else ""
 
-        # Seleccionar solo las columnas que existen en la tabla
-        select_cols = ["id", "nombre", "precio", "stock"]
-        if has_categoria:
-            select_cols.append("categoria")
-        # Image columns: imagen_url is common; optionally include imagen_srcset, imagen_width, imagen_height
-        if schema_has("productos", "imagen_url"):
-            select_cols.append("imagen_url")
-        if schema_has("productos", "imagen_srcset"):
-            select_cols.append("imagen_srcset")
-        if schema_has("productos", "imagen_width"):
-            select_cols.append("imagen_width")
-        if schema_has("productos", "imagen_height"):
-            select_cols.append("imagen_height")
-        if has_descripcion:
-            select_cols.append("descripcion")
-
-        cols_sql = ",".join(select_cols)
+        # Campos de Producto en orden; NULL para las columnas que la tabla no tiene
+        cols_sql = producto_select()
 
-        with conn.cursor() as c:
-            c.execute(f"SELECT COUNT(*) AS total FROM productos{where_sql}", args)
-            total = c.fetchone()["total"]
+        with tuplas(conn) as c:
+            c.execute(f"SELECT COUNT(*) FROM productos{where_sql}", args)
+            total = c.fetchone()[0]
             c.execute(f"SELECT {cols_sql} FROM productos{where_sql} ORDER BY id ASC LIMIT %s OFFSET %s", args + [size, offset])
             items = c.fetchall()
 
         total_pages = math.ceil(total / size) if size else 1
-        return {"total_items": total, "total_pages": total_pages, "page": page, "size": size, "items": items}
+        return (f'{{"total_items":{total},"total_pages":{total_pages},"page":{page},"size":{size},'
+                f'"items":{PRODUCTO_JSON.filas(items)}}}')
     finally:
         conn.close()
 
+def _productos_batch(ids: List[int]) -> Dict[str, Any]:
+    if len(ids) > MAX_IDS_BATCH:
+        raise HTTPException(status_code=400, detail=f"Máximo {MAX_IDS_BATCH} ids por consulta")
+    try:
+        found = productos_por_ids(ids)
+    except (DBOperationalError, DBError) as e:
+        raise db_http_error(e) from e
+    ordered = list(dict.fromkeys(ids))
+    return {
+        "items": [found[i] for i in ordered if i in found],
+        "missing": [i for i in ordered if i not in found],
+    }
+
+@router.get("/productos/batch", response_model=ProductosBatchResponse, tags=["catalogo"])
+def productos_batch(ids: str = Query(..., description="ids separados por coma, p. ej. 1,5,9")):
+    """Productos por id en una sola consulta (o desde caché), en el orden pedido."""
+    try:
+        parsed = [int(x) for x in ids.split(",") if x.strip()]
+    except ValueError:
+        raise HTTPException(status_code=400, detail="ids debe ser una lista de enteros separados por coma")
+    if not parsed:
+        raise HTTPException(status_code=400, detail="ids vacío")
+    return _productos_batch(parsed)
+
+@router.post("/productos/batch", response_model=ProductosBatchResponse, tags=["catalogo"])
+def productos_batch_post(payload: ProductosBatchRequest):
+    # Variante POST para listas largas que no caben cómodas en la URL
+    return _productos_batch(payload.ids)
+
+@router.get("/productos/changes", response_model=ProductosChangesResponse, tags=["catalogo"])
+def productos_changes(
+    since: Optional[str] = Query(None, description="marca `next` de la respuesta anterior; vacío = catálogo completo"),
+    limit: int = Query(500, ge=1, le=1000),
+):
+    """Productos modificados e ids borrados desde `since`, con la marca nueva en `next`.
+
+    Con `more=true` hay otra página: volver a llamar enseguida con `since=next`.
+    410 si la marca es más vieja que la retención de borrados (recargar todo sin `since`).
+    """
+    try:
+        return cambios_desde(since, limit)
+    except MarcaInvalida:
+        raise HTTPException(status_code=400, detail="since inválido")
+    except MarcaExpirada:
+        raise HTTPException(status_code=410, detail="Marca expirada: sincronizar de nuevo sin since")
+    except (DBOperationalError, DBError) as e:
+        raise db_http_error(e) from e
+
+@router.get("/productos/stream", tags=["catalogo"])
+async def productos_stream(request: Request, ids: Optional[str] = Query(None, description="filtrar por ids separados por coma, p. ej. 1,5,9")):
+    """Deltas de stock/precio en vivo (Server-Sent Events).
+
+    Eventos `stock` con `[{"id","stock","precio"}, ...]` tras cada compra
+    confirmada; `resync` si el cliente se quedó atrás y debe recargar.
+    """
+    filtro = None
+    if ids:
+        try:
+            filtro = frozenset(int(x) for x in ids.split(",") if x.strip())
+        except ValueError:
+            raise HTTPException(status_code=400, detail="ids debe ser una lista de enteros separados por coma")
+        if len(filtro) > MAX_IDS_BATCH:
+            raise HTTPException(status_code=400, detail=f"Máximo {MAX_IDS_BATCH} ids por suscripción")
+    if broadcaster.lleno():
+        raise HTTPException(status_code=503, detail="Demasiadas suscripciones", headers={"Retry-After": "30"})
+    return StreamingResponse(
+        broadcaster.eventos(filtro or None, request.headers.get("last-event-id")),
+        media_type="text/event-stream",
+        # sin buffering en proxies (nginx) ni caché
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+# CARRITO
+@router.post("/cart/quote", response_model=CartQuoteResponse, tags=["ventas"])
+def cart_quote(payload: CartQuoteRequest):
+    """Revalida el carrito con precios/stock actuales (una sola consulta por ids)."""
+    if len(payload.items) > MAX_IDS_BATCH:
+        raise HTTPException(status_code=400, detail=f"Máximo {MAX_IDS_BATCH} ítems por cotización")
+    try:
+        return cotizar(payload.items)
+    except (DBOperationalError, DBError) as e:
+        raise db_http_error(e) from e
+
 # VENTAS
+def _compra_sin_confirmar(e: CompraSinConfirmar) -> HTTPException:
+    if e.en_curso:
+        # pudo confirmarse: reintentar a ciegas podría duplicar la compra
+        return HTTPException(status_code=504, detail="La compra no se confirmó a tiempo; revisa tus compras antes de reintentar")
+    return HTTPException(status_code=503, detail="La compra no se procesó a tiempo, reintenta", headers={"Retry-After": "1"})
+
+def _fail_fast_if_db_down() -> None:
+    # Con el circuito abierto no se encola nada en el escritor: 503 inmediato
+    if db_breaker.is_open():
+        raise HTTPException(status_code=503, detail="Base de datos no disponible",
+                            headers={"Retry-After": str(db_breaker.retry_after())})
+
 @router.post("/compras", response_model=CompraResponse, status_code=201, tags=["ventas"])
 def comprar(payload: CompraRequest):
-    conn = get_conn()
+    _fail_fast_if_db_down()
+    # La inserción pasa por el escritor de group commit: se agrupa con otras
+    # compras concurrentes en un solo COMMIT y devuelve id/fecha sin releer.
     try:
-        with conn.cursor() as c:
-            c.execute("SELECT id, stock, precio FROM productos WHERE id=%s FOR UPDATE", (payload.producto_id,))
-            prod = c.fetchone()
-            if not prod:
-                raise HTTPException(status_code=404, detail="Producto no encontrado")
-            if prod["stock"] < payload.cantidad:
-                raise HTTPException(status_code=409, detail="Stock insuficiente")
-            c.execute("UPDATE productos SET stock=stock-%s WHERE id=%s", (payload.cantidad, payload.producto_id))
-            c.execute("INSERT INTO compras (producto_id, cantidad) VALUES (%s,%s)", (payload.producto_id, payload.cantidad))
-            compra_id = c.lastrowid
-        conn.commit()
-        with conn.cursor() as c2:
-            c2.execute("SELECT id, producto_id, cantidad, fecha FROM compras WHERE id=%s", (compra_id,))
-            row = c2.fetchone()
-        return row
-    except HTTPException:
-        conn.rollback()
-        raise
+        rows = registrar_compras([(payload.producto_id, payload.cantidad)])
+        mark_write()
+        cache.invalidate("catalogo")
+        return rows[0]
+    except ProductoNoEncontrado:
+        raise HTTPException(status_code=404, detail="Producto no encontrado")
+    except StockInsuficiente:
+        raise HTTPException(status_code=409, detail="Stock insuficiente")
     except (DBIntegrityError, DBProgrammingError) as e:
-        conn.rollback()
         raise HTTPException(status_code=400, detail="Solicitud inválida (SQL)") from e
+    except CompraSinConfirmar as e:
+        raise _compra_sin_confirmar(e) from e
     except (DBOperationalError, DBError) as e:
-        conn.rollback()
-        raise HTTPException(status_code=500, detail="Error interno de base de datos") from e
-    finally:
-        conn.close()
+        raise db_http_error(e) from e
 
 @router.post("/checkout", response_model=CheckoutResponse, tags=["ventas"])
 def checkout(payload: CheckoutRequest):
     if not payload.items:
         raise HTTPException(status_code=400, detail="Carrito vacío")
-    conn = get_conn()
-    compras_realizadas: List[CheckoutResultItem] = []
+    _fail_fast_if_db_down()
     try:
-        total_unidades = 0
-        with conn.cursor() as c:
-            for it in payload.items:
-                c.execute("SELECT id, stock FROM productos WHERE id=%s FOR UPDATE", (it.producto_id,))
-                prod = c.fetchone()
-                if not prod:
-                    raise HTTPException(status_code=404, detail=f"Producto {it.producto_id} no existe")
-                if prod["stock"] < it.cantidad:
-                    raise HTTPException(status_code=409, detail=f"Stock insuficiente para producto {it.producto_id}")
-                c.execute("UPDATE productos SET stock=stock-%s WHERE id=%s", (it.cantidad, it.producto_id))
-                c.execute("INSERT INTO compras (producto_id, cantidad) VALUES (%s,%s)", (it.producto_id, it.cantidad))
-                compras_realizadas.append(CheckoutResultItem(compra_id=c.lastrowid, producto_id=it.producto_id, cantidad=it.cantidad))
-                total_unidades += it.cantidad
-        conn.commit()
-        return CheckoutResponse(
-            status="ok",
-            total_items=len(payload.items),
-            total_unidades=total_unidades,
-            compras=compras_realizadas,
-            detalle="Checkout completado; compras registradas y stock actualizado",
-        )
-    except HTTPException:
-        conn.rollback()
-        raise
+        rows = registrar_compras([(it.producto_id, it.cantidad) for it in payload.items])
+        mark_write()
+        cache.invalidate("catalogo")
+    except ProductoNoEncontrado as e:
+        raise HTTPException(status_code=404, detail=f"Producto {e.producto_id} no existe")
+    except StockInsuficiente as e:
+        raise HTTPException(status_code=409, detail=f"Stock insuficiente para producto {e.producto_id}")
     except (DBIntegrityError, DBProgrammingError) as e:
-        conn.rollback()
         raise HTTPException(status_code=400, detail="Solicitud inválida (SQL)") from e
+    except CompraSinConfirmar as e:
+        raise _compra_sin_confirmar(e) from e
     except (DBOperationalError, DBError) as e:
-        conn.rollback()
-        raise HTTPException(status_code=500, detail="Error interno de base de datos") from e
-    finally:
-        conn.close()
+        raise db_http_error(e) from e
+    compras_realizadas: List[CheckoutResultItem] = [
+        CheckoutResultItem(compra_id=r["id"], producto_id=r["producto_id"], cantidad=r["cantidad"]) for r in rows
+    ]
+    return CheckoutResponse(
+        status="ok",
+        total_items=len(payload.items),
+        total_unidades=sum(r["cantidad"] for r in rows),
+        compras=compras_realizadas,
+        detalle="Checkout completado; compras registradas y stock actualizado",
+    )
 
 # ADMIN (guard /admin/*)
 @router.get("/admin/ventas/resumen", response_model=VentasResumen, tags=["admin"])
 def admin_resumen(from_date: Optional[date] = Query(None), to_date: Optional[date] = Query(None), user=Depends(require_admin)):
     validate_from_to(from_date, to_date)
-    conn = get_conn()
+    # Rangos cerrados (terminan antes de hoy) no cambian: cachear 1 hora
+    if to_date and to_date < date.today():
+        return cache.get_or_set(("resumen", from_date, to_date), lambda: _resumen_db(from_date, to_date), ttl=3600)
+    return _resumen_db(from_date, to_date)
+
+def _resumen_db(from_date: Optional[date], to_date: Optional[date]) -> Dict[str, Any]:
+    conn = get_conn(read=True)
     try:
-        where = []
-        args: List[Any] = []
-        if from_date:
-            where.append("DATE(c.fecha) >= %s"); args.append(from_date)
-        if to_date:
-            where.append("DATE(c.fecha) <= %s"); args.append(to_date)
+        where, args = fecha_where(from_date, to_date)
         where_sql = (" WHERE " + " AND ".join(where)) if where else ""
         sql = f"""
             SELECT COUNT(*) AS compras,
@@ -401,66 +731,111 @@ def admin_resumen(from_date: Optional[date] = Query(None), to_date: Optional[dat
         conn.close()
 
 @router.get("/admin/ventas/serie", response_model=VentasSerie, tags=["admin"])
-def admin_serie(from_date: Optional[date] = Query(None), to_date: Optional[date] = Query(None), user=Depends(require_admin)):
+def admin_serie(from_date: Optional[date] = Query(None), to_date: Optional[date] = Query(None),
+                granularidad: Optional[Literal["dia", "semana", "mes"]] = Query(None),
+                user=Depends(require_admin)):
     today = date.today()
     if not to_date:
         to_date = today
     if not from_date:
         from_date = to_date - timedelta(days=6)  # default: últimos 7 días
     validate_from_to(from_date, to_date)
-    conn = get_conn()
+    # Días cerrados desde caché inmutable (app/ventas_serie.py); solo hoy se recalcula
+    gran = elegir_granularidad(from_date, to_date, granularidad)
     try:
-        sql = """
-            SELECT DATE(c.fecha) AS f, COUNT(*) AS compras,
-                   COALESCE(SUM(c.cantidad),0) AS unidades,
-                   COALESCE(SUM(c.cantidad*p.precio),0) AS monto
-            FROM compras c
-            JOIN productos p ON p.id=c.producto_id
-            WHERE DATE(c.fecha) BETWEEN %s AND %s
-            GROUP BY DATE(c.fecha)
-            ORDER BY 1
-        """
-        with conn.cursor() as cur:
-            cur.execute(sql, (from_date, to_date))
-            rows = cur.fetchall()
-        by_day = {r["f"]: r for r in rows}
-        items: List[SerieItem] = []
-        d = from_date
-        while d <= to_date:
-            r = by_day.get(d, {"compras":0,"unidades":0,"monto":0.0})
-            items.append(SerieItem(fecha=d, compras=int(r["compras"]), unidades=int(r["unidades"]), monto_total=float(r["monto"])))
-            d += timedelta(days=1)
-        return {"items": items}
-    finally:
-        conn.close()
+        dias = serie_cache.dias(from_date, to_date, today=today)
+    except (DBOperationalError, DBError) as e:
+        raise db_http_error(e) from e
+    return {"granularidad": gran, "items": agrupar(dias, gran)}
+
+@router.get("/admin/ventas/top", response_model=VentasTopProductos, tags=["admin"])
+def admin_top(k: int = Query(10, ge=1, le=100), por: Literal["unidades", "monto"] = Query("unidades"),
+              fecha: Optional[date] = Query(None), categoria: Optional[str] = Query(None),
+              user=Depends(require_admin)):
+    # Ranking mantenido en memoria (app/rankings.py): lectura O(k), sin GROUP BY
+    try:
+        items = rankings.top_productos(k, por=por, dia=fecha, categoria=categoria)
+    except (DBOperationalError, DBError) as e:
+        raise db_http_error(e) from e
+    return {"items": items}
+
+@router.get("/admin/ventas/categorias", response_model=VentasCategorias, tags=["admin"])
+def admin_categorias(k: int = Query(50, ge=1, le=500), por: Literal["unidades", "monto"] = Query("unidades"),
+                     fecha: Optional[date] = Query(None), user=Depends(require_admin)):
+    try:
+        items = rankings.top_categorias(k, por=por, dia=fecha)
+    except (DBOperationalError, DBError) as e:
+        raise db_http_error(e) from e
+    return {"items": items}
+
+Dimension = Literal["hora", "dia_semana", "dia", "mes", "categoria", "producto"]
+Medida = Literal["compras", "unidades", "monto"]
+
+def _require_analytics() -> None:
+    if not analytics.disponible():
+        raise HTTPException(status_code=503, detail="Analítica no disponible (falta numpy en el servidor)")
+
+@router.get("/admin/ventas/analitica", response_model=VentasCrossTab, tags=["admin"])
+def admin_analitica(filas: Dimension = Query("hora"), columnas: Optional[Dimension] = Query(None),
+                    medida: Medida = Query("unidades"),
+                    from_date: Optional[date] = Query(None), to_date: Optional[date] = Query(None),
+                    categoria: Optional[str] = Query(None), user=Depends(require_admin)):
+    # Cross-tab en memoria (app/analytics.py): bincount sobre columnas NumPy, sin GROUP BY
+    _require_analytics()
+    validate_from_to(from_date, to_date)
+    if columnas == filas:
+        raise HTTPException(status_code=400, detail="filas y columnas deben ser dimensiones distintas")
+    try:
+        return analytics.crosstab(filas, columnas, medida, from_date, to_date, categoria)
+    except (DBOperationalError, DBError) as e:
+        raise db_http_error(e) from e
+
+@router.get("/admin/ventas/media-movil", response_model=VentasMediaMovil, tags=["admin"])
+def admin_media_movil(ventana: int = Query(7, ge=1, le=90), medida: Medida = Query("unidades"),
+                      from_date: Optional[date] = Query(None), to_date: Optional[date] = Query(None),
+                      categoria: Optional[str] = Query(None), user=Depends(require_admin)):
+    _require_analytics()
+    to_date = to_date or date.today()
+    from_date = from_date or to_date - timedelta(days=29)
+    validate_from_to(from_date, to_date)
+    try:
+        items = analytics.media_movil(from_date, to_date, ventana, medida, categoria)
+    except (DBOperationalError, DBError) as e:
+        raise db_http_error(e) from e
+    return {"ventana": ventana, "medida": medida, "items": items}
+
+@router.post("/admin/ventas/top/rebuild", tags=["admin"])
+def admin_top_rebuild(user=Depends(require_admin)):
+    try:
+        n = rankings.rebuild()
+    except (DBOperationalError, DBError) as e:
+        raise db_http_error(e) from e
+    return {"ok": True, "compras": n}
 
 @router.get("/admin/ventas.csv", tags=["admin"])
 def admin_csv(from_date: Optional[date] = Query(None), to_date: Optional[date] = Query(None), user=Depends(require_admin)):
     validate_from_to(from_date, to_date)
-    conn = get_conn()
+    conn = get_conn(read=True)
     try:
-        where = []
-        args: List[Any] = []
-        if from_date:
-            where.append("DATE(c.fecha) >= %s"); args.append(from_date)
-        if to_date:
-            where.append("DATE(c.fecha) <= %s"); args.append(to_date)
+        where, args = fecha_where(from_date, to_date)
         where_sql = (" WHERE " + " AND ".join(where)) if where else ""
         sql = f"""
-            SELECT c.id, c.producto_id, p.nombre, c.cantidad, p.precio, (c.cantidad*p.precio) AS monto, c.fecha
+            SELECT c.id, c.producto_id, p.nombre, c.cantidad, p.precio,
+                   CAST(c.cantidad*p.precio AS DOUBLE) AS monto,
+                   DATE_FORMAT(c.fecha, '%%Y-%%m-%%d %%H:%%i:%%s') AS fecha
             FROM compras c
             JOIN productos p ON p.id=c.producto_id
             {where_sql}
             ORDER BY c.fecha DESC, c.id DESC
         """
-        with conn.cursor() as cur:
+        # Tuplas ya en el formato de salida (monto y fecha convertidos en SQL): van tal cual al csv
+        with tuplas(conn) as cur:
             cur.execute(sql, args)
             rows = cur.fetchall()
         buf = io.StringIO()
         writer = csv.writer(buf)
         writer.writerow(["id","producto_id","nombre","cantidad","precio","monto","fecha"])
-        for r in rows:
-            writer.writerow([r["id"], r["producto_id"], r["nombre"], r["cantidad"], r["precio"], float(r["monto"]), r["fecha"].strftime("%Y-%m-%d %H:%M:%S")])
+        writer.writerows(rows)
         buf.seek(0)
         headers = {"Content-Disposition": "attachment; filename=ventas.csv"}
         return StreamingResponse(iter([buf.getvalue()]), media_type="text/csv", headers=headers)
@@ -469,13 +844,17 @@ def admin_csv(from_date: Optional[date] = Query(None), to_date: Optional[date] =
 
 # /stats (público)
 @router.get("/stats", response_model=StatsResponse, tags=["util"])
-def stats():
-    conn = get_conn()
+def stats(response: Response):
+    return serve_or_stale("stats", response, _stats_db)
+
+def _stats_db() -> Dict[str, Any]:
+    conn = get_conn(read=True)
     try:
         with conn.cursor() as c:
             c.execute("SELECT COUNT(*) AS n, COALESCE(SUM(stock),0) AS stock_total FROM productos")
             prod = c.fetchone()
-            c.execute("SELECT COUNT(*) AS compras, COALESCE(SUM(cantidad),0) AS unidades FROM compras WHERE DATE(fecha)=CURRENT_DATE()")
+            c.execute("SELECT COUNT(*) AS compras, COALESCE(SUM(cantidad),0) AS unidades FROM compras "
+                      "WHERE fecha >= CURRENT_DATE() AND fecha < CURRENT_DATE() + INTERVAL 1 DAY")
             hoy = c.fetchone()
         uptime = int(time.time() - APP_START_TIME)
         lat = {}
@@ -0,0 +1,127 @@
+import asyncio
+import threading
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional, Tuple
+
+from .metrics import incr, counters
+
+
+class _Call:
+    __slots__ = ("done", "result", "error", "waiters")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+        # seguidores async: se despiertan en su propio loop al terminar el líder
+        self.waiters: List[Tuple[asyncio.AbstractEventLoop, "asyncio.Future[Any]"]] = []
+
+
+def _resolver(fut: "asyncio.Future[Any]", call: _Call) -> None:
+    if fut.done():
+        return  # el seguidor se canceló
+    if isinstance(call.error, asyncio.CancelledError):
+        fut.cancel()
+    elif call.error is not None:
+        fut.set_exception(call.error)
+    else:
+        fut.set_result(call.result)
+
+
+class SingleFlight:
+    """Coalescencia de peticiones idénticas en vuelo.
+
+    La primera llamada con una clave ejecuta la función; las que llegan con la
+    misma clave mientras tanto esperan y reciben el mismo resultado (o la misma
+    excepción). No guarda nada una vez terminada: para eso está la caché.
+
+    `do` sirve a handlers sync (hilos del threadpool) y `do_async` a handlers
+    async. Ambos comparten la llamada en vuelo y las métricas: un seguidor
+    async de un líder sync (o al revés) recibe el mismo resultado.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._lock = threading.Lock()
+        self._calls: Dict[Hashable, _Call] = {}
+        _registry.append(self)
+
+    def do(self, key: Hashable, fn: Callable[[], Any]) -> Any:
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+        if not leader:
+            incr(f"singleflight.{self.name}.coalesced")
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        incr(f"singleflight.{self.name}.executed")
+        try:
+            call.result = fn()
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            self._finish(key, call)
+
+    async def do_async(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Any:
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                fut = loop.create_future()
+                call.waiters.append((loop, fut))
+        if not leader:
+            incr(f"singleflight.{self.name}.coalesced")
+            # cancelar a un seguidor solo cancela su propio Future, no al líder
+            return await fut
+
+        incr(f"singleflight.{self.name}.executed")
+        try:
+            call.result = await fn()
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            self._finish(key, call)
+
+    def _finish(self, key: Hashable, call: _Call) -> None:
+        with self._lock:
+            self._calls.pop(key, None)
+            waiters, call.waiters = call.waiters, []
+        call.done.set()
+        for loop, fut in waiters:
+            try:
+                loop.call_soon_threadsafe(_resolver, fut, call)
+            except RuntimeError:
+                pass  # loop ya cerrado
+
+    def stats(self) -> Dict[str, Any]:
+        executed = counters.get(f"singleflight.{self.name}.executed", 0)
+        coalesced = counters.get(f"singleflight.{self.name}.coalesced", 0)
+        total = executed + coalesced
+        return {
+            "executed": executed,
+            "coalesced": coalesced,
+            "coalescing_ratio": round(coalesced / total, 3) if total else 0.0,
+            "in_flight": len(self._calls),
+        }
+
+
+_registry: List[SingleFlight] = []
+
+
+def singleflight_snapshot() -> Dict[str, Any]:
+    return {sf.name: sf.stats() for sf in _registry}
+
+
+# Coalescencia de consultas de catálogo (/productos)
+catalog_flight = SingleFlight("catalogo")
@@ -0,0 +1,121 @@
+"""Servido del frontend (/app) con archivos precomprimidos.
+
+`npm run build` deja en dist/ los assets con hash en el nombre y sus hermanos
+`.br`/`.gz`. Aquí se negocia `Accept-Encoding` y se envía el archivo ya
+comprimido tal cual (sin comprimir nada por petición); `FileResponse` usa
+`http.response.pathsend` (sendfile) si el servidor ASGI lo soporta. Las
+peticiones condicionales (If-None-Match / If-Modified-Since) responden 304.
+
+En producción lo ideal es que nginx sirva dist/ directamente
+(deploy/nginx-tienda.conf) y los workers de la API no toquen estos bytes.
+"""
+import os
+import re
+import stat
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from starlette.datastructures import Headers
+from starlette.responses import FileResponse, Response
+from starlette.staticfiles import NotModifiedResponse, StaticFiles
+from starlette.types import Scope
+
+FRONTEND_DIR = Path(__file__).parent / "frontend"
+# Salida de build.js; si no existe se sirve el código fuente sin empaquetar
+STATIC_DIST_DIR = Path(os.getenv("STATIC_DIST_DIR", str(Path(__file__).resolve().parent.parent / "dist")))
+
+# Orden de preferencia cuando el cliente acepta varias
+_ENCODINGS: List[Tuple[str, str]] = [("br", ".br"), ("gzip", ".gz")]
+# Solo la forma que emite build.js: main.4HQ2ZK7E.js (esbuild), main.4HQ2ZK7E.js.map,
+# css/style.3f9c2a1b7e.css; el contenido nunca cambia para ese nombre. Lo demás
+# (asset-manifest.json, index.html, imágenes) se revalida. Igual que el map de nginx.
+_HASHED = re.compile(r"\.[0-9A-Za-z]{8,}\.(?:js|css)(?:\.map)?$")
+CACHE_IMMUTABLE = "public, max-age=31536000, immutable"
+# index.html y archivos sin hash: siempre se revalidan (barato gracias al 304)
+CACHE_REVALIDATE = "no-cache"
+
+
+def _accepted(header: str) -> Dict[str, float]:
+    """Codificaciones aceptadas (q>0) de un Accept-Encoding, con su q."""
+    out: Dict[str, float] = {}
+    for part in header.split(","):
+        name, _, params = part.strip().partition(";")
+        name = name.strip().lower()
+        q = 1.0
+        params = params.strip().replace(" ", "")
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        if name and q > 0:
+            out[name] = q
+    return out
+
+
+def _precompressed(full_path: str, accept_encoding: str) -> Optional[Tuple[str, str, os.stat_result]]:
+    accepted = _accepted(accept_encoding)
+    if not accepted:
+        return None
+    # mayor q primero; a igual q manda el orden de _ENCODINGS (br antes que gzip)
+    candidatos = sorted(
+        ((accepted.get(enc, accepted.get("*", 0.0)), -i, enc, ext) for i, (enc, ext) in enumerate(_ENCODINGS)),
+        reverse=True,
+    )
+    for q, _, encoding, ext in candidatos:
+        if q <= 0:
+            break
+        try:
+            st = os.stat(full_path + ext)
+        except OSError:
+            continue
+        if stat.S_ISREG(st.st_mode):
+            return encoding, full_path + ext, st
+    return None
+
+
+def _has_siblings(full_path: str) -> bool:
+    return any(os.path.isfile(full_path + ext) for _, ext in _ENCODINGS)
+
+
+class PrecompressedStaticFiles(StaticFiles):
+    """StaticFiles que sirve el hermano `.br`/`.gz` si el cliente lo acepta.
+
+    Los ETag/Last-Modified salen del archivo enviado, así cada codificación
+    tiene su propio validador (como exige HTTP para representaciones distintas).
+    """
+
+    def __init__(self, *args, fallback_dirs: Optional[List[str]] = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        # p. ej. app/frontend para lo que build.js no copia (img/variants)
+        self.all_directories.extend(fallback_dirs or [])
+
+    def file_response(
+        self,
+        full_path,
+        stat_result: os.stat_result,
+        scope: Scope,
+        status_code: int = 200,
+    ) -> Response:
+        request_headers = Headers(scope=scope)
+        path = str(full_path)
+        media_type = FileResponse(path, stat_result=stat_result).media_type
+        encoded = _precompressed(path, request_headers.get("accept-encoding", ""))
+        if encoded is not None:
+            encoding, path, stat_result = encoded
+        response = FileResponse(path, status_code=status_code, stat_result=stat_result, media_type=media_type)
+        if encoded is not None:
+            response.headers["content-encoding"] = encoding
+        if encoded is not None or _has_siblings(str(full_path)):
+            response.headers["vary"] = "Accept-Encoding"
+        response.headers["cache-control"] = CACHE_IMMUTABLE if _HASHED.search(str(full_path)) else CACHE_REVALIDATE
+        if self.is_not_modified(response.headers, request_headers):
+            return NotModifiedResponse(response.headers)
+        return response
+
+
+def frontend_app() -> StaticFiles:
+    """dist/ si hay build (con app/frontend de respaldo); si no, app/frontend tal cual."""
+    if (STATIC_DIST_DIR / "index.html").is_file():
+        return PrecompressedStaticFiles(directory=str(STATIC_DIST_DIR), html=True, fallback_dirs=[str(FRONTEND_DIR)])
+    return PrecompressedStaticFiles(directory=str(FRONTEND_DIR), html=True)
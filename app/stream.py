@@ -0,0 +1,204 @@
+"""Difusión en vivo de stock/precio por Server-Sent Events (/productos/stream).
+
+El escritor de group commit avisa (listener post-COMMIT) con las filas de cada
+lote; de ahí sale un delta compacto por producto `{"id", "stock", "precio"}`
+que un único broadcaster reparte a los suscriptores del proceso.
+
+- Un índice por id de producto: un delta solo toca a los suscriptores que
+  filtran ese id (más los que no filtran), no a los miles que están ociosos.
+- Buffer acotado por cliente y con coalescencia: se guarda el último delta de
+  cada producto, así un cliente lento recibe el estado más reciente en vez de
+  una cola que crece. Si acumula más de SSE_CLIENT_BUFFER productos distintos
+  sin leer se descarta lo pendiente y se le manda `resync` (debe recargar).
+- La escritura al socket es la contrapresión natural: mientras el cliente no
+  lee, el generador queda bloqueado en el `yield` y solo crece su buffer.
+
+Las compras confirmadas por otros workers llegan por el outbox (`app.outbox`),
+con el retardo de su sondeo (OUTBOX_POLL_MS).
+"""
+import os
+import json
+import asyncio
+import threading
+from typing import Any, AsyncIterator, Dict, FrozenSet, List, Optional, Set
+
+from .metrics import incr
+from .group_commit import writer
+from .outbox import compras_externas, dispatcher
+
+SSE_MAX_SUBSCRIBERS = int(os.getenv("SSE_MAX_SUBSCRIBERS", "5000"))
+# Productos distintos pendientes por cliente antes de forzar un resync
+SSE_CLIENT_BUFFER = int(os.getenv("SSE_CLIENT_BUFFER", "256"))
+# Comentario periódico para mantener viva la conexión (proxies) y detectar cortes
+SSE_HEARTBEAT_SEC = float(os.getenv("SSE_HEARTBEAT_SEC", "15"))
+# Espera sugerida al navegador antes de reconectar (campo `retry:`)
+SSE_RETRY_MS = 3000
+
+
+class SuscriptoresAgotados(Exception):
+    """Se alcanzó SSE_MAX_SUBSCRIBERS en este proceso."""
+
+
+class _Suscriptor:
+    __slots__ = ("ids", "pendiente", "evento", "resync", "seq")
+
+    def __init__(self, ids: Optional[FrozenSet[int]]):
+        self.ids = ids
+        self.pendiente: Dict[int, Dict[str, Any]] = {}
+        self.evento = asyncio.Event()
+        self.resync = False
+        self.seq = 0
+
+    def push(self, pid: int, delta: Dict[str, Any], seq: int, max_buffer: int) -> None:
+        self.seq = seq
+        if self.resync:
+            # ya va a recargar todo; no tiene sentido acumular
+            return
+        if pid not in self.pendiente and len(self.pendiente) >= max_buffer:
+            self.pendiente.clear()
+            self.resync = True
+            incr("sse.overflow")
+        else:
+            self.pendiente[pid] = delta
+        self.evento.set()
+
+
+class StockBroadcaster:
+    def __init__(self, max_subscribers: int = SSE_MAX_SUBSCRIBERS, client_buffer: int = SSE_CLIENT_BUFFER):
+        self.max_subscribers = max_subscribers
+        self.client_buffer = max(1, client_buffer)
+        # Estado del loop: solo se toca desde el hilo del event loop
+        self._todos: Set[_Suscriptor] = set()
+        self._por_id: Dict[int, Set[_Suscriptor]] = {}
+        self._n = 0
+        self._seq = 0
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._lock = threading.Lock()
+
+    # -- hilo escritor --
+    def on_commit(self, rows: List[Dict[str, Any]]) -> None:
+        """Listener post-COMMIT del group commit (corre en el hilo escritor)."""
+        if not self._n:
+            return
+        deltas: Dict[int, Dict[str, Any]] = {}
+        for r in rows:
+            if "stock" not in r:
+                continue
+            # filas en orden de aplicación: la última de cada producto es el estado final
+            deltas[r["producto_id"]] = {"id": r["producto_id"], "stock": r["stock"], "precio": r["precio"]}
+        with self._lock:
+            loop = self._loop
+        if deltas and loop is not None and not loop.is_closed():
+            try:
+                loop.call_soon_threadsafe(self._publicar, deltas)
+            except RuntimeError:
+                # el loop se cerró entre la comprobación y la llamada (apagado)
+                pass
+
+    # -- event loop --
+    def _publicar(self, deltas: Dict[int, Dict[str, Any]]) -> None:
+        self._seq += 1
+        seq = self._seq
+        enviados = 0
+        for pid, delta in deltas.items():
+            for sub in self._todos:
+                sub.push(pid, delta, seq, self.client_buffer)
+                enviados += 1
+            for sub in self._por_id.get(pid, ()):
+                sub.push(pid, delta, seq, self.client_buffer)
+                enviados += 1
+        incr("sse.deltas", len(deltas))
+        incr("sse.deliveries", enviados)
+
+    def subscribe(self, ids: Optional[FrozenSet[int]] = None) -> _Suscriptor:
+        """Alta de un suscriptor (llamar desde el event loop)."""
+        if self.lleno():
+            incr("sse.rejected")
+            raise SuscriptoresAgotados()
+        with self._lock:
+            self._loop = asyncio.get_running_loop()
+        sub = _Suscriptor(ids)
+        sub.seq = self._seq
+        if ids is None:
+            self._todos.add(sub)
+        else:
+            for pid in ids:
+                self._por_id.setdefault(pid, set()).add(sub)
+        self._n += 1
+        return sub
+
+    def unsubscribe(self, sub: _Suscriptor) -> None:
+        if sub.ids is None:
+            if sub not in self._todos:
+                return
+            self._todos.discard(sub)
+        else:
+            for pid in sub.ids:
+                subs = self._por_id.get(pid)
+                if subs is not None:
+                    subs.discard(sub)
+                    if not subs:
+                        del self._por_id[pid]
+        self._n -= 1
+
+    def lleno(self) -> bool:
+        return self._n >= self.max_subscribers
+
+    async def eventos(
+        self,
+        ids: Optional[FrozenSet[int]] = None,
+        last_event_id: Optional[str] = None,
+        heartbeat: float = SSE_HEARTBEAT_SEC,
+    ) -> AsyncIterator[bytes]:
+        """Cuerpo SSE: alta al empezar a enviar y baja al terminar (desconexión).
+
+        La suscripción se crea aquí y no antes para que una respuesta que nunca
+        llega a enviarse no deje un suscriptor huérfano."""
+        sub = self.subscribe(ids)
+        try:
+            yield f"retry: {SSE_RETRY_MS}\n\n".encode()
+            # reconexión con deltas perdidos (o tras reiniciar el proceso): recargar
+            if last_event_id is not None and last_event_id != str(sub.seq):
+                sub.resync = True
+                sub.evento.set()
+            while True:
+                try:
+                    await asyncio.wait_for(sub.evento.wait(), heartbeat)
+                except asyncio.TimeoutError:
+                    yield b": ping\n\n"
+                    continue
+                sub.evento.clear()
+                if sub.resync:
+                    sub.resync = False
+                    sub.pendiente.clear()
+                    yield f"id: {sub.seq}\nevent: resync\ndata: {{}}\n\n".encode()
+                    continue
+                if sub.pendiente:
+                    lote = list(sub.pendiente.values())
+                    sub.pendiente = {}
+                    data = json.dumps(lote, separators=(",", ":"))
+                    yield f"id: {sub.seq}\nevent: stock\ndata: {data}\n\n".encode()
+        finally:
+            self.unsubscribe(sub)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "subscribers": self._n,
+            "unfiltered": len(self._todos),
+            "indexed_products": len(self._por_id),
+            "seq": self._seq,
+            "max_subscribers": self.max_subscribers,
+            "client_buffer": self.client_buffer,
+        }
+
+
+def _compras_de_otros_workers(eventos: List[Dict[str, Any]]) -> None:
+    rows = compras_externas(eventos)
+    if rows:
+        broadcaster.on_commit(rows)
+
+
+# Instancia compartida del proceso
+broadcaster = StockBroadcaster()
+writer.add_listener(broadcaster.on_commit)
+dispatcher.subscribe(_compras_de_otros_workers)
@@ -0,0 +1,133 @@
+import threading
+from datetime import date, timedelta
+from typing import Dict, List, Optional, Tuple
+
+from .db import get_conn
+from .filas import tuplas
+
+# (compras, unidades, monto) por día
+DiaAgg = Tuple[int, int, float]
+_CERO: DiaAgg = (0, 0, 0.0)
+
+# Umbrales (en días) para la selección automática de granularidad
+AUTO_DIA_MAX = 92
+AUTO_SEMANA_MAX = 730
+
+
+class SerieDiariaCache:
+    """Caché en memoria de agregados diarios de `compras`.
+
+    Los días anteriores a hoy están cerrados y se guardan de forma inmutable;
+    solo el día en curso se recalcula en cada llamada. Para los días cerrados
+    que faltan se lanza una única consulta agrupada sobre el tramo mínimo que
+    los cubre.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._dias: Dict[date, DiaAgg] = {}
+
+    def clear(self) -> None:
+        with self._lock:
+            self._dias.clear()
+
+    @staticmethod
+    def _consultar(desde: date, hasta: date) -> Dict[date, DiaAgg]:
+        # Rango semiabierto sobre `fecha` para que el índice idx_compras_fecha aplique
+        sql = """
+            SELECT DATE(c.fecha) AS f, COUNT(*) AS compras,
+                   COALESCE(SUM(c.cantidad),0) AS unidades,
+                   COALESCE(SUM(c.cantidad*p.precio),0) AS monto
+            FROM compras c
+            JOIN productos p ON p.id=c.producto_id
+            WHERE c.fecha >= %s AND c.fecha < %s
+            GROUP BY DATE(c.fecha)
+        """
+        conn = get_conn(read=True)
+        try:
+            with tuplas(conn) as cur:
+                cur.execute(sql, (desde, hasta + timedelta(days=1)))
+                rows = cur.fetchall()
+            conn.commit()
+        finally:
+            conn.close()
+        return {f: (int(compras), int(unidades), float(monto)) for f, compras, unidades, monto in rows}
+
+    def dias(self, from_date: date, to_date: date, today: Optional[date] = None) -> List[Tuple[date, DiaAgg]]:
+        """Agregados de cada día del rango [from_date, to_date], en orden."""
+        today = today or date.today()
+        ultimo_cerrado = min(to_date, today - timedelta(days=1))
+
+        with self._lock:
+            faltantes = [
+                from_date + timedelta(days=i)
+                for i in range((ultimo_cerrado - from_date).days + 1)
+                if (from_date + timedelta(days=i)) not in self._dias
+            ]
+        if faltantes:
+            desde, hasta = faltantes[0], faltantes[-1]
+            encontrados = self._consultar(desde, hasta)
+            with self._lock:
+                d = desde
+                while d <= hasta:
+                    self._dias.setdefault(d, encontrados.get(d, _CERO))
+                    d += timedelta(days=1)
+
+        abierto: Dict[date, DiaAgg] = {}
+        if from_date <= today <= to_date:
+            abierto = self._consultar(today, today)
+
+        out: List[Tuple[date, DiaAgg]] = []
+        with self._lock:
+            d = from_date
+            while d <= to_date:
+                if d < today:
+                    out.append((d, self._dias.get(d, _CERO)))
+                elif d == today:
+                    out.append((d, abierto.get(d, _CERO)))
+                else:
+                    out.append((d, _CERO))
+                d += timedelta(days=1)
+        return out
+
+
+def elegir_granularidad(from_date: date, to_date: date, granularidad: Optional[str] = None) -> str:
+    """Devuelve 'dia', 'semana' o 'mes'; si no se indica, según la longitud del rango."""
+    if granularidad:
+        return granularidad
+    dias = (to_date - from_date).days + 1
+    if dias <= AUTO_DIA_MAX:
+        return "dia"
+    if dias <= AUTO_SEMANA_MAX:
+        return "semana"
+    return "mes"
+
+
+def _inicio_bucket(d: date, granularidad: str) -> date:
+    if granularidad == "semana":
+        return d - timedelta(days=d.weekday())
+    if granularidad == "mes":
+        return d.replace(day=1)
+    return d
+
+
+def agrupar(dias: List[Tuple[date, DiaAgg]], granularidad: str) -> List[dict]:
+    """Reduce la serie diaria a buckets (la fecha de cada bucket es su primer día,
+    lunes para semanas)."""
+    out: List[dict] = []
+    for d, (compras, unidades, monto) in dias:
+        inicio = _inicio_bucket(d, granularidad)
+        if out and out[-1]["fecha"] == inicio:
+            b = out[-1]
+            b["compras"] += compras
+            b["unidades"] += unidades
+            b["monto_total"] += monto
+        else:
+            out.append({"fecha": inicio, "compras": compras, "unidades": unidades, "monto_total": monto})
+    for b in out:
+        b["monto_total"] = round(b["monto_total"], 2)
+    return out
+
+
+# Instancia compartida del proceso
+serie_cache = SerieDiariaCache()
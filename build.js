@@ -1,26 +1,87 @@
 // Minimal build script: bundle frontend JS with esbuild and copy static files to dist/
+// Los assets llevan hash de contenido en el nombre (cache immutable) y cada
+// archivo de texto tiene hermanos .br/.gz para servirlos precomprimidos
+// (app/static_assets.py o nginx con gzip_static/brotli_static).
 const { build } = require('esbuild');
 const fs = require('fs');
 const path = require('path');
+const zlib = require('zlib');
+const crypto = require('crypto');
 
 const root = path.resolve(__dirname);
 const frontend = path.join(root, 'app', 'frontend');
 const out = path.join(root, 'dist');
 
+const COMPRESSIBLE = new Set(['.html', '.css', '.js', '.map', '.json', '.svg', '.txt']);
+// Por debajo de esto la cabecera de compresión se come la ganancia
+const MIN_COMPRESS_BYTES = 256;
+
+function contentHash(buf){
+  return crypto.createHash('sha256').update(buf).digest('hex').slice(0, 10);
+}
+
+function walk(dir){
+  return fs.readdirSync(dir, { withFileTypes: true }).flatMap(e => {
+    const p = path.join(dir, e.name);
+    return e.isDirectory() ? walk(p) : [p];
+  });
+}
+
+function compressAll(){
+  let n = 0;
+  for(const file of walk(out)){
+    if(!COMPRESSIBLE.has(path.extname(file))) continue;
+    const raw = fs.readFileSync(file);
+    if(raw.length < MIN_COMPRESS_BYTES) continue;
+    const br = zlib.brotliCompressSync(raw, {
+      params: {
+        [zlib.constants.BROTLI_PARAM_QUALITY]: zlib.constants.BROTLI_MAX_QUALITY,
+        [zlib.constants.BROTLI_PARAM_SIZE_HINT]: raw.length,
+      },
+    });
+    const gz = zlib.gzipSync(raw, { level: zlib.constants.Z_BEST_COMPRESSION });
+    // solo se dejan las variantes que realmente ahorran bytes
+    if(br.length < raw.length) { fs.writeFileSync(file + '.br', br); n++; }
+    if(gz.length < raw.length) { fs.writeFileSync(file + '.gz', gz); n++; }
+  }
+  return n;
+}
+
 async function run(){
-  if(!fs.existsSync(out)) fs.mkdirSync(out);
-  // copy static files (html, css)
-  fs.copyFileSync(path.join(frontend,'index.html'), path.join(out,'index.html'));
-  fs.copyFileSync(path.join(frontend,'css','style.css'), path.join(out,'style.css'));
-  // bundle JS
-  await build({
+  // limpiar: los nombres con hash cambian en cada build
+  fs.rmSync(out, { recursive: true, force: true });
+  fs.mkdirSync(path.join(out, 'css'), { recursive: true });
+
+  // css con hash
+  const css = fs.readFileSync(path.join(frontend,'css','style.css'));
+  const cssName = `css/style.${contentHash(css)}.css`;
+  fs.writeFileSync(path.join(out, cssName), css);
+
+  // bundle JS ([hash] de esbuild)
+  const result = await build({
     entryPoints: [path.join(frontend,'js','main.js')],
     bundle:true,
     minify:true,
     sourcemap:true,
+    format:'esm',
+    entryNames:'[name].[hash]',
+    metafile:true,
     outdir: path.join(out,'js')
   });
-  console.log('Built frontend ->', out);
+  const jsOut = Object.keys(result.metafile.outputs).find(f => f.endsWith('.js'));
+  const jsName = 'js/' + path.basename(jsOut);
+
+  // index.html apuntando a los nombres con hash (él mismo no lleva hash: se revalida con 304)
+  const html = fs.readFileSync(path.join(frontend,'index.html'), 'utf8')
+    .replace('href="css/style.css"', `href="${cssName}"`)
+    .replace('src="js/main.js"', `src="${jsName}"`);
+  fs.writeFileSync(path.join(out,'index.html'), html);
+
+  fs.writeFileSync(path.join(out,'asset-manifest.json'),
+    JSON.stringify({ 'css/style.css': cssName, 'js/main.js': jsName }, null, 1));
+
+  const n = compressAll();
+  console.log('Built frontend ->', out, `(${cssName}, ${jsName}, ${n} precompressed)`);
 }
 
 run().catch(e=>{ console.error(e); process.exit(1); });
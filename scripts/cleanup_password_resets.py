@@ -1,20 +1,19 @@
 #!/usr/bin/env python3
 """Script para limpiar tokens expirados o usados en la tabla password_resets.
 Se puede ejecutar via cron o systemd timer.
+Borra en lotes con pausa entre ellos (ver `app/maintenance.py`).
 """
-import os
-from app.db import get_conn
+import argparse
+from app.maintenance import run_task, MAINT_BATCH_SIZE, MAINT_SLEEP_SEC
 
-def cleanup():
-    conn = get_conn()
-    try:
-        with conn.cursor() as c:
-            c.execute("DELETE FROM password_resets WHERE used = 1 OR expires_at < UTC_TIMESTAMP()")
-            deleted = c.rowcount
-        conn.commit()
-        print(f"cleanup: deleted {deleted} rows")
-    finally:
-        conn.close()
+def cleanup(batch_size: int = MAINT_BATCH_SIZE, sleep_sec: float = MAINT_SLEEP_SEC, dry_run: bool = False):
+    deleted = run_task("password_resets", batch_size=batch_size, sleep_sec=sleep_sec, dry_run=dry_run)
+    print(f"cleanup: deleted {deleted} rows" if not dry_run else f"cleanup: would delete {deleted} rows")
 
 if __name__ == '__main__':
-    cleanup()
+    ap = argparse.ArgumentParser(description=__doc__)
+    ap.add_argument("--batch-size", type=int, default=MAINT_BATCH_SIZE)
+    ap.add_argument("--sleep", type=float, default=MAINT_SLEEP_SEC, help="pausa (s) entre lotes")
+    ap.add_argument("--dry-run", action="store_true")
+    a = ap.parse_args()
+    cleanup(a.batch_size, a.sleep, a.dry_run)
@@ -0,0 +1,33 @@
+#!/usr/bin/env python3
+"""Genera variantes WebP/JPEG de las imágenes de productos y rellena
+imagen_srcset / imagen_width / imagen_height (ver `app/imagenes.py`).
+
+Uso: python3 scripts/image_variants.py [--ids 1,2,3] [--jobs 4] [--force] [--dry-run]
+Requiere Pillow. Las imágenes sin cambios (mismo hash) se saltan.
+"""
+import argparse
+import sys
+from app.imagenes import generar_variantes, IMAGES_SRC_DIR, IMAGES_OUT_DIR, IMAGES_URL_PREFIX, IMAGES_WIDTHS, IMAGES_FORMATS
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser(description="Variantes de imágenes de productos")
+    ap.add_argument("--ids", type=lambda s: [int(x) for x in s.split(",") if x.strip()], default=None)
+    ap.add_argument("--jobs", type=int, default=0, help="procesos (0 = nº de CPUs)")
+    ap.add_argument("--force", action="store_true", help="reprocesar aunque el hash no haya cambiado")
+    ap.add_argument("--dry-run", action="store_true")
+    ap.add_argument("--src-dir", default=IMAGES_SRC_DIR)
+    ap.add_argument("--out-dir", default=IMAGES_OUT_DIR)
+    ap.add_argument("--url-prefix", default=IMAGES_URL_PREFIX)
+    ap.add_argument("--widths", type=lambda s: [int(x) for x in s.split(",")], default=IMAGES_WIDTHS)
+    ap.add_argument("--formats", type=lambda s: [x.strip() for x in s.split(",")], default=IMAGES_FORMATS)
+    a = ap.parse_args()
+    try:
+        cont = generar_variantes(
+            ids=a.ids, jobs=a.jobs, force=a.force, dry_run=a.dry_run,
+            src_dir=a.src_dir, out_dir=a.out_dir, url_prefix=a.url_prefix,
+            widths=a.widths, formats=a.formats,
+        )
+    except RuntimeError as e:
+        print(f"error: {e}", file=sys.stderr)
+        sys.exit(2)
+    sys.exit(1 if cont["errores"] else 0)
@@ -0,0 +1,24 @@
+#!/usr/bin/env python3
+"""Ejecuta tareas de mantenimiento registradas en `app/maintenance.py`.
+
+Uso: python3 scripts/maintenance.py password_resets [--batch-size 500] [--sleep 0.2] [--dry-run]
+     python3 scripts/maintenance.py refresh_tokens
+     python3 scripts/maintenance.py outbox
+     python3 scripts/maintenance.py productos_tombstones
+     python3 scripts/maintenance.py analytics_snapshot
+     python3 scripts/maintenance.py compras_particionar --dry-run   # una vez, en ventana de mantenimiento
+     python3 scripts/maintenance.py compras_particiones             # semanal (deploy/compras-particiones.timer)
+"""
+import argparse
+from app.maintenance import TASKS, run_task, MAINT_BATCH_SIZE, MAINT_SLEEP_SEC
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser(description="Tareas de mantenimiento por lotes")
+    ap.add_argument("tasks", nargs="+", choices=sorted(TASKS))
+    ap.add_argument("--batch-size", type=int, default=MAINT_BATCH_SIZE)
+    ap.add_argument("--sleep", type=float, default=MAINT_SLEEP_SEC, help="pausa (s) entre lotes")
+    ap.add_argument("--dry-run", action="store_true")
+    a = ap.parse_args()
+    for name in a.tasks:
+        n = run_task(name, batch_size=a.batch_size, sleep_sec=a.sleep, dry_run=a.dry_run)
+        print(f"{name}: {n} filas{' (dry-run)' if a.dry_run else ''}")
@@ -0,0 +1,43 @@
+"""Alimentación incremental de VentasColumnar con compras desordenadas por id.
+
+Uso: python -m pytest tests/test_analytics.py
+"""
+from datetime import datetime
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from app.analytics import VentasColumnar, _Tail
+
+
+def _cargada(tmp_path, max_id=100):
+    a = VentasColumnar(snapshot_dir=str(tmp_path))
+    a._tail = _Tail()
+    a._precio = np.full(10, 5.0)
+    a._cat = np.zeros(10, dtype="int32")
+    a._max_id = max_id
+    a._loaded = True
+    return a
+
+
+def _compra(id_, producto_id=1):
+    return {"id": id_, "producto_id": producto_id, "cantidad": 2,
+            "fecha": datetime(2026, 10, 19, 12, 0), "precio": 5.0, "stock": 3}
+
+
+def test_compra_externa_con_id_menor_no_se_pierde(tmp_path):
+    a = _cargada(tmp_path)
+    # la local (id alto) llega por el escritor; la de otro worker después por el outbox
+    a.on_commit([_compra(110)])
+    a.on_commit([_compra(105, producto_id=2)])
+    assert sorted(a._tail.view()["id"].tolist()) == [105, 110]
+
+
+def test_duplicados_y_filas_bajo_la_marca_se_descartan(tmp_path):
+    a = _cargada(tmp_path)
+    a.on_commit([_compra(99), _compra(101), _compra(101)])
+    a.on_commit([_compra(101), _compra(102)])
+    assert a._tail.view()["id"].tolist() == [101, 102]
+    # ids contiguos: la marca avanza y el conjunto se vacía
+    assert a._max_id == 102 and not a._vistos
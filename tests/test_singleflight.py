@@ -0,0 +1,66 @@
+"""SingleFlight: coalescencia en handlers async y mezcla sync/async.
+
+Uso: python -m pytest tests/test_singleflight.py
+"""
+import asyncio
+import threading
+import time
+
+from app.singleflight import SingleFlight
+
+
+def test_do_async_coalesce_llamadas_concurrentes():
+    sf = SingleFlight("test_async")
+    ejecuciones = []
+
+    async def cargar():
+        ejecuciones.append(1)
+        await asyncio.sleep(0.05)
+        return {"ok": True}
+
+    async def main():
+        return await asyncio.gather(*[sf.do_async("k", cargar) for _ in range(5)])
+
+    resultados = asyncio.run(main())
+    assert len(ejecuciones) == 1
+    assert all(r is resultados[0] for r in resultados)
+    stats = sf.stats()
+    assert (stats["executed"], stats["coalesced"], stats["in_flight"]) == (1, 4, 0)
+
+
+def test_do_async_propaga_la_excepcion_del_lider():
+    sf = SingleFlight("test_async_error")
+
+    async def fallar():
+        await asyncio.sleep(0.02)
+        raise ValueError("bd caída")
+
+    async def main():
+        return await asyncio.gather(*[sf.do_async("k", fallar) for _ in range(3)], return_exceptions=True)
+
+    errores = asyncio.run(main())
+    assert all(isinstance(e, ValueError) for e in errores)
+
+
+def test_seguidor_async_comparte_la_llamada_de_un_lider_sync():
+    sf = SingleFlight("test_mixto")
+    empezo = threading.Event()
+    ejecuciones = []
+
+    def cargar_sync():
+        ejecuciones.append("sync")
+        empezo.set()
+        time.sleep(0.1)
+        return 42
+
+    async def cargar_async():
+        ejecuciones.append("async")
+        return -1
+
+    lider = threading.Thread(target=sf.do, args=("k", cargar_sync))
+    lider.start()
+    empezo.wait(1)
+    assert asyncio.run(sf.do_async("k", cargar_async)) == 42
+    lider.join()
+    assert ejecuciones == ["sync"]
+    assert sf.stats()["coalesced"] == 1
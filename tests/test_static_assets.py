@@ -0,0 +1,43 @@
+"""Cache-Control de /app: solo los assets con hash de build.js son immutable.
+
+Uso: python -m pytest tests/test_static_assets.py
+"""
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from app.static_assets import CACHE_IMMUTABLE, CACHE_REVALIDATE, PrecompressedStaticFiles
+
+
+def _cliente(tmp_path):
+    (tmp_path / "js").mkdir()
+    (tmp_path / "css").mkdir()
+    archivos = {
+        "index.html": "<html></html>",
+        "asset-manifest.json": '{"js/main.js": "js/main.4HQ2ZK7E.js"}',
+        "js/main.4HQ2ZK7E.js": "console.log(1)",
+        "js/main.4HQ2ZK7E.js.map": "{}",
+        "css/style.3f9c2a1b7e.css": "body{}",
+        "productos-original.jpg": "x",
+        "7-9a86ba4d0d94-640.webp": "x",
+    }
+    for nombre, contenido in archivos.items():
+        (tmp_path / nombre).write_text(contenido)
+    app = FastAPI()
+    app.mount("/app", PrecompressedStaticFiles(directory=str(tmp_path), html=True))
+    return TestClient(app)
+
+
+def test_assets_con_hash_son_immutable(tmp_path):
+    cliente = _cliente(tmp_path)
+    for ruta in ("js/main.4HQ2ZK7E.js", "js/main.4HQ2ZK7E.js.map", "css/style.3f9c2a1b7e.css"):
+        r = cliente.get(f"/app/{ruta}")
+        assert r.status_code == 200
+        assert r.headers["cache-control"] == CACHE_IMMUTABLE, ruta
+
+
+def test_manifest_y_archivos_sin_hash_se_revalidan(tmp_path):
+    cliente = _cliente(tmp_path)
+    for ruta in ("asset-manifest.json", "index.html", "productos-original.jpg", "7-9a86ba4d0d94-640.webp"):
+        r = cliente.get(f"/app/{ruta}")
+        assert r.status_code == 200
+        assert r.headers["cache-control"] == CACHE_REVALIDATE, ruta